@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+'''
+Disk throughput and latency of a guest for the disk modes of VmImage: bus,
+cache mode, AIO backend, discard and iothread. The fio jobs of disk_modes.fio
+run inside a VM reached over SSH (fio has to be installed in the guest).
+
+Recipe: set the disk fields of the image (admin or shell), start a VM of it,
+then run e.g.
+
+  python benchmarks/bench_disk_modes.py run virtio-blk-none-native \
+      --ssh 'ssh -p 10022 root@localhost'
+
+for every mode to compare, restarting the VM in between. Results are kept in
+a JSON file and all modes measured so far are printed side by side.
+
+  python benchmarks/bench_disk_modes.py modes   # QEMU disk arguments of modes
+  python benchmarks/bench_disk_modes.py report  # table of the kept results
+'''
+import os
+import sys
+import json
+import argparse
+import subprocess
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from picostack.vm_manager import DebianKvm
+
+
+JOB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'disk_modes.fio')
+# Modes worth comparing, named as bus-cache-aio[-discard][-iothread].
+MODES = (
+    ('ide-writeback-threads', dict()),
+    ('virtio-blk-writeback-threads', dict(disk_bus='virtio-blk')),
+    ('virtio-blk-none-native', dict(disk_bus='virtio-blk', disk_cache='none',
+                                    disk_aio='native')),
+    ('virtio-blk-none-native-iothread', dict(
+        disk_bus='virtio-blk', disk_cache='none', disk_aio='native',
+        disk_iothread=True)),
+    ('virtio-blk-none-io_uring-iothread', dict(
+        disk_bus='virtio-blk', disk_cache='none', disk_aio='io_uring',
+        disk_iothread=True)),
+    ('virtio-scsi-none-native-discard-iothread', dict(
+        disk_bus='virtio-scsi', disk_cache='none', disk_aio='native',
+        disk_discard=True, disk_iothread=True)),
+)
+
+
+class Image(object):
+    disk_bus = 'ide'
+    disk_cache = 'writeback'
+    disk_aio = 'threads'
+    disk_discard = False
+    disk_iothread = False
+
+    def __init__(self, **settings):
+        self.__dict__.update(settings)
+
+
+def print_modes():
+    call_builder = DebianKvm()
+    for name, settings in MODES:
+        parameters = call_builder.get_disk_params(Image(**settings), 'qcow2')
+        if not parameters:
+            parameters = {'hda': call_builder.parameters['hda']}
+        print name
+        print '   ', call_builder.build_params(parameters) % {
+            'disk_path': 'vm.img'}
+
+
+def run_jobs(label, ssh_command, results_path):
+    with open(JOB_FILE) as job_file:
+        output = subprocess.check_output(
+            ssh_command.split() + ['fio', '--output-format=json', '-'],
+            stdin=job_file)
+    # Anything printed before the JSON (e.g. by the login shell) is skipped.
+    report = json.loads(output[output.index('{'):])
+    jobs = dict()
+    for job in report['jobs']:
+        side = job['read'] if job['read']['io_bytes'] else job['write']
+        jobs[job['jobname']] = {
+            'iops': side['iops'],
+            'bw_kb': side['bw'],
+            'p99_us': side['clat_ns']['percentile'].get(
+                '99.000000', 0) / 1000.0,
+        }
+    results = load_results(results_path)
+    results[label] = jobs
+    with open(results_path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+
+def load_results(results_path):
+    if not os.path.exists(results_path):
+        return dict()
+    with open(results_path) as results_file:
+        return json.load(results_file)
+
+
+def print_report(results_path):
+    results = load_results(results_path)
+    print '%-42s %-14s %10s %10s %10s' % ('mode', 'job', 'iops', 'MB/s',
+                                          'p99 us')
+    for label in sorted(results):
+        for job_name in sorted(results[label]):
+            job = results[label][job_name]
+            print '%-42s %-14s %10.0f %10.1f %10.0f' % (
+                label, job_name, job['iops'], job['bw_kb'] / 1024.0,
+                job['p99_us'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('command', choices=('modes', 'run', 'report'))
+    parser.add_argument('label', nargs='?',
+                        help='Name of the measured mode, for "run".')
+    parser.add_argument('--ssh', default='ssh root@localhost',
+                        help='Command to log into the guest.')
+    parser.add_argument('--results', default='disk_modes.json')
+    args = parser.parse_args()
+    if args.command == 'modes':
+        print_modes()
+    elif args.command == 'run':
+        if args.label is None:
+            parser.error('"run" needs the label of the mode.')
+        run_jobs(args.label, args.ssh, args.results)
+        print_report(args.results)
+    else:
+        print_report(args.results)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+Throughput of the logging server in records per second. Clients send batches
+of records in frames, the way BatchingSocketHandler does, as fast as they
+can. Records are counted instead of being written anywhere.
+
+Usage: python benchmarks/bench_log_receiver.py [--clients 8] [--unix]
+'''
+import os
+import sys
+import time
+import shutil
+import socket
+import struct
+import logging
+import argparse
+import tempfile
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from picostack.logging_util import serialize_records, SERIALIZERS
+from picostack.socket_logger import LogRecordSocketReceiver
+
+
+class CountingReceiver(LogRecordSocketReceiver):
+
+    def __init__(self, *args, **kwargs):
+        LogRecordSocketReceiver.__init__(self, *args, **kwargs)
+        self.count = 0
+        self.done = threading.Event()
+        self.expected = None
+
+    def handleLogRecord(self, record):
+        self.count += 1
+        if self.count == self.expected:
+            self.done.set()
+
+
+def make_frame(batch_size, serializer):
+    record = logging.LogRecord('picostack.vm_manager', logging.INFO,
+                               __file__, 1, 'VM %s has changed state to %s',
+                               ('vm-042', 'R'), None)
+    prepared = dict(record.__dict__)
+    prepared['msg'] = record.getMessage()
+    prepared['args'] = None
+    payload = serialize_records([dict(prepared) for _ in xrange(batch_size)],
+                                serializer)
+    return struct.pack('>L', len(payload)) + payload
+
+
+def send_frames(address, frame, num_of_frames):
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    for _ in xrange(num_of_frames):
+        sock.sendall(frame)
+    sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--records', type=int, default=100000,
+                        help='Records sent by every client.')
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--serializer', choices=SERIALIZERS, default='json')
+    parser.add_argument('--unix', action='store_true', default=False,
+                        help='Use unix domain socket instead of TCP.')
+    args = parser.parse_args()
+
+    state_path = tempfile.mkdtemp(prefix='bench_log_receiver')
+    socket_path = os.path.join(state_path, 'logging.sock')
+    receiver = CountingReceiver(port=0, socket_path=socket_path,
+                                serializer=args.serializer)
+    receiver.timeout = 0.1
+    num_of_frames = args.records // args.batch_size
+    receiver.expected = args.clients * num_of_frames * args.batch_size
+    server = threading.Thread(target=receiver.serve_until_stopped)
+    server.start()
+    address = socket_path if args.unix else receiver.server_address
+    frame = make_frame(args.batch_size, args.serializer)
+    clients = [threading.Thread(target=send_frames,
+                                args=(address, frame, num_of_frames))
+               for _ in xrange(args.clients)]
+    started_at = time.time()
+    for client in clients:
+        client.start()
+    receiver.done.wait()
+    elapsed = time.time() - started_at
+    receiver.abort = 1
+    server.join()
+    for client in clients:
+        client.join()
+    shutil.rmtree(state_path, ignore_errors=True)
+    print '%d records from %d clients (%s, %s, %d per frame) in %.2f s' % (
+        receiver.count, args.clients, 'unix' if args.unix else 'tcp',
+        args.serializer, args.batch_size, elapsed)
+    print '%.0f records/s' % (receiver.count / elapsed)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+'''
+Time-to-spawn of VM processes for 1, 10 and 100 concurrent starts, with the
+supervisor and with the detached helper processes of ProcessUtil.exec_process.
+A stand-in command is spawned instead of QEMU, so only the overhead of
+picostack is measured.
+
+Usage: python benchmarks/bench_spawn.py [--command 'sleep 60'] [1 10 100]
+'''
+import os
+import sys
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from picostack.process_spawn import ProcessUtil
+from picostack.supervisor import Supervisor
+
+
+def spawn_detached(work_path, index, command):
+    pidfile_path = os.path.join(work_path, '%d.pid' % index)
+    ProcessUtil.exec_process(command, os.path.join(work_path, '%d.log' %
+                                                   index), pidfile_path)
+    return ['%s_proc' % pidfile_path, pidfile_path]
+
+
+def make_spawn_supervised(supervisor):
+    def spawn_supervised(work_path, index, command):
+        pidfile_path = os.path.join(work_path, '%d.pid' % index)
+        supervisor.spawn(index, command, os.path.join(work_path, '%d.log' %
+                                                      index), pidfile_path)
+        return [pidfile_path]
+    return spawn_supervised
+
+
+def run_starts(spawn, num_of_starts, command):
+    '''Spawn concurrently, return latencies of the single starts.'''
+    work_path = tempfile.mkdtemp(prefix='bench_spawn')
+    latencies = [None] * num_of_starts
+    pidfiles = list()
+    lock = threading.Lock()
+
+    def start(index):
+        started_at = time.time()
+        spawned_pidfiles = spawn(work_path, index, command)
+        latencies[index] = time.time() - started_at
+        with lock:
+            pidfiles.extend(spawned_pidfiles)
+
+    threads = [threading.Thread(target=start, args=(index,))
+               for index in xrange(num_of_starts)]
+    started_at = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.time() - started_at
+    for pidfile_path in pidfiles:
+        if ProcessUtil.process_runs(pidfile_path):
+            os.kill(ProcessUtil.read_pid(pidfile_path), signal.SIGTERM)
+    shutil.rmtree(work_path, ignore_errors=True)
+    return total, [latency for latency in latencies if latency is not None]
+
+
+def report(mode, num_of_starts, total, latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        print '%-10s %5d   all starts failed' % (mode, num_of_starts)
+        return
+    print '%-10s %5d %10.1f %10.1f %10.1f %10d' % (
+        mode, num_of_starts, total * 1000,
+        latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000,
+        (num_of_starts - len(latencies)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--command', default='sleep 60',
+                        help='Stand-in for the QEMU command line.')
+    parser.add_argument('--skip-detached', action='store_true',
+                        default=False)
+    parser.add_argument('counts', nargs='*', type=int, default=[1, 10, 100])
+    args = parser.parse_args()
+
+    supervisor = Supervisor()
+    supervisor.start()
+    modes = [('supervisor', make_spawn_supervised(supervisor))]
+    if not args.skip_detached:
+        modes.append(('detached', spawn_detached))
+    print '%-10s %5s %10s %10s %10s %10s' % (
+        'mode', 'starts', 'total ms', 'p50 ms', 'max ms', 'failed')
+    for num_of_starts in args.counts:
+        for mode, spawn in modes:
+            total, latencies = run_starts(spawn, num_of_starts, args.command)
+            report(mode, num_of_starts, total, latencies)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+'''
+Latency of web reads while the daemon writes heavily to the shared SQLite DB,
+with the default rollback journal and with the settings of sqlite_tuning.py.
+Readers run the query of the status endpoint, the writer changes states and
+port mappings of instances in short transactions. All of them are separate
+processes like the web workers and the daemon.
+
+Usage: python benchmarks/bench_sqlite_concurrency.py [--readers 4]
+'''
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import multiprocessing
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from picostack.sqlite_tuning import apply_pragmas, SQLITE_BUSY_TIMEOUT
+
+
+STATUS_QUERY = ('SELECT id, name, current_state, ssh_mapping, rdp_mapping, '
+                'vnc_mapping FROM instances ORDER BY name')
+# Timeout of python's sqlite3 module, Django used it as it was.
+DEFAULT_TIMEOUT = 5.0
+
+
+def connect(db_path, tuned):
+    if not tuned:
+        return sqlite3.connect(db_path, timeout=DEFAULT_TIMEOUT)
+    connection = sqlite3.connect(db_path, timeout=SQLITE_BUSY_TIMEOUT)
+    apply_pragmas(connection.cursor())
+    return connection
+
+
+def create_db(db_path, num_of_instances):
+    connection = sqlite3.connect(db_path)
+    connection.execute(
+        'CREATE TABLE instances (id INTEGER PRIMARY KEY, name TEXT UNIQUE, '
+        'current_state TEXT, ssh_mapping INTEGER, rdp_mapping INTEGER, '
+        'vnc_mapping INTEGER, last_error TEXT)')
+    connection.executemany(
+        'INSERT INTO instances (name, current_state) VALUES (?, ?)',
+        [('vm-%03d' % index, 'S') for index in xrange(num_of_instances)])
+    connection.commit()
+    connection.close()
+
+
+def write(db_path, tuned, duration, num_of_instances, results):
+    connection = connect(db_path, tuned)
+    num_of_writes = num_of_errors = 0
+    started_at = time.time()
+    while time.time() - started_at < duration:
+        pk = num_of_writes % num_of_instances + 1
+        try:
+            # Same as change_state() followed by map_port().
+            connection.execute('UPDATE instances SET current_state = ? '
+                               'WHERE id = ?', ('LR'[num_of_writes % 2], pk))
+            connection.commit()
+            connection.execute('UPDATE instances SET ssh_mapping = ? '
+                               'WHERE id = ?', (10000 + num_of_writes, pk))
+            connection.commit()
+            num_of_writes += 1
+        except sqlite3.OperationalError:
+            connection.rollback()
+            num_of_errors += 1
+    results.put(('writer', num_of_writes, num_of_errors, []))
+
+
+def read(db_path, tuned, duration, results):
+    connection = connect(db_path, tuned)
+    latencies = list()
+    num_of_errors = 0
+    started_at = time.time()
+    while time.time() - started_at < duration:
+        read_at = time.time()
+        try:
+            connection.execute(STATUS_QUERY).fetchall()
+            # Django commits after every read in autocommit mode.
+            connection.commit()
+            latencies.append(time.time() - read_at)
+        except sqlite3.OperationalError:
+            num_of_errors += 1
+    results.put(('reader', len(latencies), num_of_errors, latencies))
+
+
+def run(tuned, with_writer, args):
+    work_path = tempfile.mkdtemp(prefix='bench_sqlite')
+    db_path = os.path.join(work_path, 'picostk.sqlite3')
+    create_db(db_path, args.instances)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(
+        target=read, args=(db_path, tuned, args.duration, results))
+        for _ in xrange(args.readers)]
+    if with_writer:
+        processes.append(multiprocessing.Process(
+            target=write, args=(db_path, tuned, args.duration,
+                                args.instances, results)))
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    shutil.rmtree(work_path, ignore_errors=True)
+    latencies = sorted(latency for role, _, _, role_latencies in outcomes
+                       for latency in role_latencies)
+    reads = sum(count for role, count, _, _ in outcomes if role == 'reader')
+    read_errors = sum(errors for role, _, errors, _ in outcomes
+                      if role == 'reader')
+    writes = sum(count for role, count, _, _ in outcomes if role == 'writer')
+    write_errors = sum(errors for role, _, errors, _ in outcomes
+                       if role == 'writer')
+
+    def percentile(fraction):
+        if not latencies:
+            return float('nan')
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * fraction))] * 1000
+
+    print '%-8s %-7s %9.0f %8.2f %8.2f %8.1f %7d %9.0f %7d' % (
+        'wal' if tuned else 'default', 'yes' if with_writer else 'no',
+        reads / args.duration, percentile(0.5), percentile(0.99),
+        percentile(1.0), read_errors, writes / args.duration, write_errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--instances', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='Seconds per run.')
+    args = parser.parse_args()
+    print '%-8s %-7s %9s %8s %8s %8s %7s %9s %7s' % (
+        'journal', 'writer', 'reads/s', 'p50 ms', 'p99 ms', 'max ms',
+        'r-errs', 'writes/s', 'w-errs')
+    for tuned in (False, True):
+        for with_writer in (False, True):
+            run(tuned, with_writer, args)
@@ -0,0 +1,237 @@
+'''
+Placement of the vCPUs of VMs whose flavour asks for pinning. The host
+topology is read from sysfs once. Every pinned VM gets its own logical CPUs,
+whole cores first, all from a single NUMA node if any node has enough of
+them free, and its vCPU threads are bound to them. Memory of the guest then
+tends to come from the same node, since the pinned threads touch it first.
+VMs that are not pinned are kept off the assigned CPUs.
+'''
+import os
+import re
+import threading
+import psutil
+from picostack.errors import PicoStackError
+
+
+SYS_CPU_PATH = '/sys/devices/system/cpu'
+SYS_NODE_PATH = '/sys/devices/system/node'
+# Name of vCPU threads of QEMU/KVM, e.g. "CPU 1/KVM".
+VCPU_THREAD_NAME = re.compile(r'^CPU (\d+)/KVM$')
+
+
+class CpuPlacementError(PicoStackError):
+    '''Raised if there are not enough free CPUs to pin a VM to.'''
+
+
+def parse_cpu_list(text):
+    '''"0-3,8" to [0, 1, 2, 3, 8].'''
+    cpus = list()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(xrange(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    '''[0, 1, 2, 3, 8] to "0-3,8".'''
+    ranges = list()
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else '%d-%d' % (first, last)
+                    for first, last in ranges)
+
+
+def read_sys_value(path, default=None):
+    try:
+        with open(path) as sys_file:
+            return sys_file.read().strip()
+    except IOError:
+        return default
+
+
+def read_cpu_topology(cpu_path=SYS_CPU_PATH, node_path=SYS_NODE_PATH):
+    '''
+    Get {node: [[cpu, sibling, ...], ...]} of the online CPUs: cores of the
+    node with their hyperthreads.
+    '''
+    online = set(parse_cpu_list(read_sys_value(
+        os.path.join(cpu_path, 'online'), '0')))
+    nodes = dict()
+    if os.path.isdir(node_path):
+        for entry in os.listdir(node_path):
+            match = re.match(r'^node(\d+)$', entry)
+            if match is None:
+                continue
+            cpus = parse_cpu_list(read_sys_value(
+                os.path.join(node_path, entry, 'cpulist'), ''))
+            cpus = [cpu for cpu in cpus if cpu in online]
+            if cpus:
+                nodes[int(match.group(1))] = cpus
+    if not nodes:
+        # Kernel without NUMA support.
+        nodes[0] = list(online)
+
+    def get_core(cpu):
+        topology_path = os.path.join(cpu_path, 'cpu%d' % cpu, 'topology')
+        return (int(read_sys_value(os.path.join(
+                    topology_path, 'physical_package_id'), 0)),
+                int(read_sys_value(os.path.join(topology_path, 'core_id'),
+                                   cpu)))
+
+    topology = dict()
+    for node, cpus in nodes.items():
+        cores = dict()
+        for cpu in sorted(cpus):
+            cores.setdefault(get_core(cpu), list()).append(cpu)
+        topology[node] = [cores[core] for core in sorted(cores)]
+    return topology
+
+
+class CpuPlacement(object):
+
+    def __init__(self, topology, excluded_cpus=()):
+        '''Excluded CPUs are left to the host.'''
+        self.lock = threading.Lock()
+        self.order = dict()
+        self.node_of = dict()
+        self.core_of = dict()
+        self.free = dict()
+        for node, cores in topology.items():
+            for core in cores:
+                for cpu in core:
+                    self.order[cpu] = len(self.order)
+                    self.node_of[cpu] = node
+                    self.core_of[cpu] = tuple(core)
+            self.free[node] = [cpu for core in cores for cpu in core
+                               if cpu not in excluded_cpus]
+        # All CPUs but those of the host, whether assigned or not.
+        self.num_of_pinnable = self.num_of_free
+        self.assignments = dict()
+
+    @property
+    def num_of_free(self):
+        return sum(len(cpus) for cpus in self.free.values())
+
+    def can_assign(self, num_of_cpus):
+        with self.lock:
+            return num_of_cpus <= self.num_of_free
+
+    def assign(self, key, num_of_cpus):
+        '''Get CPUs for the VM: from the fullest node that has enough.'''
+        with self.lock:
+            if key in self.assignments:
+                return self.assignments[key]
+            if num_of_cpus > self.num_of_free:
+                raise CpuPlacementError(
+                    'Only %d CPUs are free, %d needed.' %
+                    (self.num_of_free, num_of_cpus))
+            fitting_nodes = [node for node, cpus in self.free.items()
+                             if len(cpus) >= num_of_cpus]
+            if fitting_nodes:
+                node = min(fitting_nodes,
+                           key=lambda node: (len(self.free[node]), node))
+                cpus = self.pick(node, num_of_cpus)
+            else:
+                # Spread over the nodes with most free CPUs.
+                cpus = list()
+                for node in sorted(self.free, key=lambda node: (
+                        -len(self.free[node]), node)):
+                    cpus.extend(self.pick(node, num_of_cpus - len(cpus)))
+            self.take(cpus)
+            self.assignments[key] = sorted(cpus)
+            return self.assignments[key]
+
+    def pick(self, node, num_of_cpus):
+        '''
+        Take whole free cores of the node, so VMs do not share caches of a
+        core. A core is split only for the rest, cores split already first.
+        '''
+        free_cores = list()
+        split_cores = list()
+        for cpu in self.free[node]:
+            core = self.core_of[cpu]
+            cpus = [sibling for sibling in core
+                    if sibling in self.free[node]]
+            if cpus[0] != cpu:
+                continue
+            if len(cpus) == len(core):
+                free_cores.append(cpus)
+            else:
+                split_cores.append(cpus)
+        picked = list()
+        for cpus in free_cores:
+            if len(cpus) <= num_of_cpus - len(picked):
+                picked.extend(cpus)
+        for cpus in split_cores + free_cores:
+            for cpu in cpus:
+                if len(picked) == num_of_cpus:
+                    return picked
+                if cpu not in picked:
+                    picked.append(cpu)
+        return picked
+
+    def take(self, cpus):
+        for cpu in cpus:
+            self.free[self.node_of[cpu]].remove(cpu)
+
+    def restore(self, key, cpus):
+        '''Mark CPUs of a VM that was pinned before (e.g. by a daemon).'''
+        with self.lock:
+            cpus = [cpu for cpu in cpus if cpu in self.node_of and
+                    cpu in self.free[self.node_of[cpu]]]
+            self.take(cpus)
+            self.assignments[key] = sorted(cpus)
+
+    def get_shared_cpus(self):
+        '''CPUs not assigned to any VM, those of the host included.'''
+        with self.lock:
+            assigned = set(cpu for cpus in self.assignments.values()
+                           for cpu in cpus)
+            return sorted(cpu for cpu in self.order if cpu not in assigned)
+
+    def release(self, key):
+        with self.lock:
+            cpus = self.assignments.pop(key, [])
+            for cpu in cpus:
+                node_cpus = self.free[self.node_of[cpu]]
+                node_cpus.append(cpu)
+                node_cpus.sort(key=self.order.get)
+            return cpus
+
+
+def find_vcpu_threads(pid):
+    '''Get {vcpu index: thread id} by the names of the threads.'''
+    threads = dict()
+    task_path = '/proc/%d/task' % pid
+    for tid in os.listdir(task_path):
+        match = VCPU_THREAD_NAME.match(read_sys_value(
+            os.path.join(task_path, tid, 'comm'), ''))
+        if match is not None:
+            threads[int(match.group(1))] = int(tid)
+    return threads
+
+
+def apply_affinity(pid, cpus, vcpu_threads):
+    '''
+    Bind vCPU threads one to a CPU, the rest of the threads of the VM process
+    (I/O, emulation) may run on any of the CPUs of the VM.
+    '''
+    vcpu_tids = dict((tid, index) for index, tid in vcpu_threads.items())
+    for thread in psutil.Process(pid).threads():
+        if thread.id in vcpu_tids:
+            affinity = [cpus[vcpu_tids[thread.id] % len(cpus)]]
+        else:
+            affinity = cpus
+        try:
+            psutil.Process(thread.id).cpu_affinity(affinity)
+        except psutil.NoSuchProcess:
+            # Thread has just exited.
+            continue
@@ -1,8 +1,11 @@
 import ConfigParser
 import os
-import time
 import logging
-from picostack.vm_manager import VmManager
+from picostack.vm_manager import VmManager, VM_MANAGER_DEFAULTS
+from picostack.vms.models import InstanceTableVersion
+from picostack.wakeup import WakeupChannel, WORK_DONE_MESSAGE
+from picostack.metrics import MetricsCollector
+from picostack.settings import DAEMON_WAKEUP_SOCKET, METRICS_SNAPSHOT
 
 
 logger = logging.getLogger(__name__)
@@ -55,13 +58,31 @@ class PicoStackApp(object):
         self.config.set('daemon', 'pidfile_path',
                         '%(default_statepath)s/' + self.name + '.pid')
         self.config.set('daemon', 'pidfile_timeout', '5')
-        self.config.set('daemon', 'sleeping_pause', '10')
+        # Web interface and CLI wake the daemon up on every change, so it
+        # only has to look around by itself once in a while.
+        self.config.set('daemon', 'idle_pause', '60')
+        # Sampling of VM resource usage, zero interval turns it off.
+        self.config.set('daemon', 'metrics_interval', '5')
+        self.config.set('daemon', 'metrics_snapshot_path', METRICS_SNAPSHOT)
+        # Records are queued and shipped to the logging server in batches.
+        # Once the queue is full: drop_debug, drop_oldest or drop_newest.
+        self.config.set('daemon', 'log_queue_size', '10000')
+        self.config.set('daemon', 'log_overflow', 'drop_debug')
+        # json or pickle. The logging server refuses pickled records unless
+        # set to pickle, which lets any local process run code in it.
+        self.config.set('daemon', 'log_serializer', 'json')
+        # Logging server listens on TCP and on this unix domain socket.
+        self.config.set('daemon', 'log_socket_path',
+                        '%(default_statepath)s/logging.sock')
         # Init/set VM manager options.
         self.config.add_section('vm_manager')
         self.config.set('vm_manager', 'vm_image_path',
                         '%(default_statepath)s/images')
         self.config.set('vm_manager', 'vm_disk_path',
                         '%(default_statepath)s/disks')
+        # Shared with VmManager, which falls back to them as well.
+        for option, value in sorted(VM_MANAGER_DEFAULTS.items()):
+            self.config.set('vm_manager', option, value)
 
     def load_config_file(self, config_name, config_dir):
         '''
@@ -131,19 +152,55 @@ class PicoStackApp(object):
 
     def step(self):
         '''A single step of actual work, done by daemon'''
+        # All checks within the step share one scan of the process table.
+        self.vm_manager.process_table.invalidate()
         self.vm_manager.build_machines()
         self.vm_manager.start_machines()
         self.vm_manager.stop_machines()
         self.vm_manager.destory_machines()
         self.vm_manager.check_heartbeat()
+        self.vm_manager.refill_spare_pools()
+
+    def start_metrics(self):
+        metrics_interval = self.config.getfloat('daemon', 'metrics_interval')
+        if metrics_interval <= 0:
+            return
+        MetricsCollector(
+            self.vm_manager.get_running_processes,
+            interval=metrics_interval,
+            snapshot_path=self.config.get('daemon', 'metrics_snapshot_path'),
+        ).start()
 
     def run(self):
-        while True:
-            self.step()
-            # Sleep x seconds.
-            sleeping_pause = self.config.getint('daemon', 'sleeping_pause')
-            logger.info('Sleeping for %d (sec)..' % sleeping_pause)
-            time.sleep(sleeping_pause)
+        # Web server and CLI find the socket in the settings too.
+        wakeup_channel = WakeupChannel(DAEMON_WAKEUP_SOCKET)
+        wakeup_channel.open()
+        self.vm_manager.start_watching()
+        self.start_metrics()
+        last_version = None
+        messages = set()
+        try:
+            while True:
+                # Being woken up without any change of the instances (or of
+                # their images and flavours) means there is nothing to do.
+                # Idle ticks always do a full pass to check the heartbeat,
+                # so do wakeups by workers: their follow-up work may be due,
+                # e.g. a queued launch once a machine has stopped.
+                if messages and WORK_DONE_MESSAGE not in messages and \
+                        InstanceTableVersion.get_current().version == \
+                        last_version:
+                    logger.debug('Instance table has not changed. Skipping..')
+                else:
+                    # Read before the step, so changes made meanwhile by the
+                    # workers are not mistaken for the ones seen.
+                    last_version = InstanceTableVersion.get_current().version
+                    self.step()
+                idle_pause = self.config.getint('daemon', 'idle_pause')
+                logger.info('Waiting for changes up to %d (sec)..' %
+                            idle_pause)
+                messages = wakeup_channel.wait(idle_pause)
+        finally:
+            wakeup_channel.close()
 
 
 def get_picostack_app(app_name, config_vars, config_dir,
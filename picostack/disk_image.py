@@ -0,0 +1,87 @@
+'''
+Helpers to deal with VM disk files, e.g. thin copy-on-write qcow2 overlays
+backed by the registered images.
+'''
+import os
+import stat
+import struct
+import logging
+from subprocess import Popen, PIPE
+from picostack.errors import PicoStackError
+
+
+logger = logging.getLogger(__name__)
+QCOW2_MAGIC = 'QFI\xfb'
+# magic, version, backing_file_offset, backing_file_size
+QCOW2_HEADER = struct.Struct('>4sIQI')
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+class DiskImageError(PicoStackError):
+    '''Raised if disk file can not be created or inspected.'''
+
+
+def get_backing_file(disk_path):
+    '''
+    Return an absolute path to the backing file of a qcow2 overlay or None if
+    disk is standalone. Reads the qcow2 header directly, see
+    https://github.com/qemu/qemu/blob/master/docs/interop/qcow2.txt
+    '''
+    with open(disk_path, 'rb') as disk:
+        header = disk.read(QCOW2_HEADER.size)
+        if len(header) < QCOW2_HEADER.size:
+            return None
+        magic, version, offset, size = QCOW2_HEADER.unpack(header)
+        if magic != QCOW2_MAGIC or offset == 0 or size == 0:
+            return None
+        disk.seek(offset)
+        backing_file = disk.read(size)
+    if not os.path.isabs(backing_file):
+        # Relative paths are relative to the overlay itself.
+        backing_file = os.path.join(os.path.dirname(disk_path), backing_file)
+    return os.path.normpath(backing_file)
+
+
+def get_image_format(image_path):
+    '''
+    Tell qcow2 from raw by the header. Only for images of the admin, a guest
+    can write any header into its own raw disk.
+    '''
+    with open(image_path, 'rb') as image:
+        if image.read(len(QCOW2_MAGIC)) == QCOW2_MAGIC:
+            return 'qcow2'
+    return 'raw'
+
+
+def create_overlay(qemu_img, backing_file, backing_format, disk_path):
+    '''Create a qcow2 disk that only stores differences to backing_file.'''
+    command = [qemu_img, 'create', '-f', 'qcow2',
+               '-b', os.path.abspath(backing_file), '-F', backing_format,
+               disk_path]
+    logger.debug('Creating overlay with: %s' % ' '.join(command))
+    try:
+        process = Popen(command, stdout=PIPE, stderr=PIPE)
+    except OSError as error:
+        raise DiskImageError('Failed to run %s: %s' % (qemu_img, error))
+    output, errors = process.communicate()
+    if process.returncode != 0:
+        if os.path.exists(disk_path):
+            os.unlink(disk_path)
+        raise DiskImageError('Failed to create overlay %s: %s' %
+                             (disk_path, errors.strip()))
+
+
+def protect_image(image_path):
+    '''Make image read-only. Overlays depend on it to stay unchanged.'''
+    mode = os.stat(image_path).st_mode
+    if mode & WRITE_BITS:
+        logger.info('Protecting image from modification: %s' % image_path)
+        os.chmod(image_path, stat.S_IMODE(mode) & ~WRITE_BITS)
+
+
+def unprotect_image(image_path):
+    '''Give the owner write access back once no overlay depends on it.'''
+    mode = os.stat(image_path).st_mode
+    if not mode & stat.S_IWUSR:
+        logger.info('Image is not used by overlays anymore: %s' % image_path)
+        os.chmod(image_path, stat.S_IMODE(mode) | stat.S_IWUSR)
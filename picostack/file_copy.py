@@ -0,0 +1,135 @@
+'''
+Fast copying of big disk images. The engine tries (in this order) a reflink
+clone sharing all blocks with the source, kernel-side copy_file_range() and
+finally a chunked copy in user space. Latter two copy only the data extents
+of the source (SEEK_DATA/SEEK_HOLE), so sparse images stay sparse.
+'''
+import io
+import os
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+import logging
+
+
+logger = logging.getLogger(__name__)
+# _IOW(0x94, 9, int), see man 2 ioctl_ficlone
+FICLONE = 0x40049409
+SEEK_DATA = 3
+SEEK_HOLE = 4
+CHUNK_SIZE = 8 * 1024 * 1024
+COPY_METHODS = ('reflink', 'copy_file_range', 'chunked')
+# Errors that only mean "not supported here, try something else".
+UNSUPPORTED_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP,
+                      errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.EPERM)
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = [
+        ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_size_t, ctypes.c_uint,
+    ]
+
+
+def reflink(src_fd, dst_fd):
+    '''Clone all blocks of src into dst (btrfs, XFS). Return success.'''
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except (IOError, OSError) as error:
+        if error.errno not in UNSUPPORTED_ERRORS:
+            raise
+        return False
+    return True
+
+
+def iter_data_extents(fd, size):
+    '''Yield (start, end) of all regions of the file that are not holes.'''
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:
+                # Nothing but a hole till the end of file.
+                return
+            if error.errno in UNSUPPORTED_ERRORS:
+                yield offset, size
+                return
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        yield start, end
+        offset = end
+
+
+def kernel_copy(src_fd, dst_fd, start, end):
+    '''
+    Copy the range with copy_file_range(). Return the offset reached, which
+    is less than end if the kernel refused to continue.
+    '''
+    if _copy_file_range is None:
+        return start
+    src_offset = ctypes.c_int64(start)
+    dst_offset = ctypes.c_int64(start)
+    while src_offset.value < end:
+        copied = _copy_file_range(src_fd, ctypes.byref(src_offset),
+                                  dst_fd, ctypes.byref(dst_offset),
+                                  end - src_offset.value, 0)
+        if copied < 0:
+            error_number = ctypes.get_errno()
+            if error_number == errno.EINTR:
+                continue
+            if error_number not in UNSUPPORTED_ERRORS:
+                raise OSError(error_number, os.strerror(error_number))
+            break
+        if copied == 0:
+            break
+    return src_offset.value
+
+
+def chunked_copy(src, dst, start, end, buf):
+    '''Copy the range through a preallocated buffer, chunks are aligned.'''
+    view = memoryview(buf)
+    src.seek(start)
+    dst.seek(start)
+    offset = start
+    while offset < end:
+        length = min(CHUNK_SIZE - offset % CHUNK_SIZE, end - offset)
+        length = src.readinto(view[:length])
+        if not length:
+            break
+        written = 0
+        while written < length:
+            written += dst.write(view[written:length])
+        offset += length
+
+
+def copy_file(src_path, dst_path, methods=COPY_METHODS):
+    '''Copy src into dst with the fastest available method, return its name.'''
+    with io.open(src_path, 'rb', buffering=0) as src, \
+            io.open(dst_path, 'wb', buffering=0) as dst:
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        size = os.fstat(src_fd).st_size
+        if 'reflink' in methods and reflink(src_fd, dst_fd):
+            return 'reflink'
+        used_method = 'copy_file_range'
+        if 'copy_file_range' not in methods or _copy_file_range is None:
+            used_method = 'chunked'
+        buf = None
+        for start, end in iter_data_extents(src_fd, size):
+            if used_method == 'copy_file_range':
+                start = kernel_copy(src_fd, dst_fd, start, end)
+                if start < end:
+                    logger.debug('copy_file_range() gave up at %d. Falling '
+                                 'back to chunked copy.' % start)
+                    used_method = 'chunked'
+            if start < end:
+                if buf is None:
+                    buf = bytearray(CHUNK_SIZE)
+                chunked_copy(src, dst, start, end, buf)
+        # Trailing hole (if any) is produced by extending the file.
+        dst.truncate(size)
+        return used_method
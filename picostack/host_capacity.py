@@ -0,0 +1,62 @@
+'''
+How much memory and how many cores the VMs of this host may have together.
+Limits come from /proc/meminfo and the CPU count: a reserve is kept for the
+host itself and the rest is multiplied by the overcommit ratio.
+'''
+import os
+
+
+MEMINFO_PATH = '/proc/meminfo'
+
+
+def read_total_memory(meminfo_path=MEMINFO_PATH):
+    '''MemTotal in MB.'''
+    with open(meminfo_path) as meminfo:
+        for line in meminfo:
+            if line.startswith('MemTotal:'):
+                # In kB.
+                return int(line.split()[1]) // 1024
+    raise ValueError('No MemTotal in %s' % meminfo_path)
+
+
+class HostCapacity(object):
+
+    def __init__(self, memory_reserve=1024, cpu_reserve=0,
+                 memory_overcommit=1.0, cpu_overcommit=1.0,
+                 total_memory=None, num_of_cpus=None):
+        '''Reserves are in MB and in cores.'''
+        if total_memory is None:
+            total_memory = read_total_memory()
+        if num_of_cpus is None:
+            num_of_cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+        self.memory_limit = max(0, total_memory - memory_reserve) * \
+            memory_overcommit
+        self.cores_limit = max(0, num_of_cpus - cpu_reserve) * cpu_overcommit
+        self.used_memory = 0
+        self.used_cores = 0
+
+    def __repr__(self):
+        return 'Host capacity: <%d/%d MB, %d/%d cores>' % (
+            self.used_memory, self.memory_limit, self.used_cores,
+            self.cores_limit)
+
+    def reserve(self, memory_size, num_of_cores):
+        '''Account for a VM that has already started.'''
+        self.used_memory += memory_size
+        self.used_cores += num_of_cores
+
+    def exceeds_host(self, memory_size, num_of_cores):
+        '''Such VM would not fit even if nothing else ran.'''
+        return memory_size > self.memory_limit \
+            or num_of_cores > self.cores_limit
+
+    def fits(self, memory_size, num_of_cores):
+        return self.used_memory + memory_size <= self.memory_limit \
+            and self.used_cores + num_of_cores <= self.cores_limit
+
+    def admit(self, memory_size, num_of_cores):
+        '''Reserve resources of a VM to be started, if they fit.'''
+        if not self.fits(memory_size, num_of_cores):
+            return False
+        self.reserve(memory_size, num_of_cores)
+        return True
@@ -0,0 +1,82 @@
+'''
+Hugepage pool of the host as seen in /sys/kernel/mm/hugepages. QEMU maps the
+guest memory from a hugetlbfs mount (-mem-path), the kernel reserves the
+pages at that moment. Until then, pages of VMs being started are counted
+here, so concurrent starts do not promise the same pages twice.
+'''
+import os
+import threading
+
+
+HUGEPAGES_PATH = '/sys/kernel/mm/hugepages'
+MOUNTS_PATH = '/proc/mounts'
+
+
+def read_hugepage_counters(page_size, hugepages_path=HUGEPAGES_PATH):
+    '''Get nr/free/resv counters of the pool of given page size (in kB).'''
+    pool_path = os.path.join(hugepages_path, 'hugepages-%dkB' % page_size)
+    counters = dict()
+    for name in ('nr_hugepages', 'free_hugepages', 'resv_hugepages'):
+        try:
+            with open(os.path.join(pool_path, name)) as counter:
+                counters[name] = int(counter.read())
+        except IOError:
+            counters[name] = 0
+    return counters
+
+
+def is_hugetlbfs_mounted(mount_path, mounts_path=MOUNTS_PATH):
+    try:
+        with open(mounts_path) as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) > 2 and fields[1] == mount_path \
+                        and fields[2] == 'hugetlbfs':
+                    return True
+    except IOError:
+        pass
+    return False
+
+
+class HugepagePool(object):
+
+    def __init__(self, page_size=2048, mount_path='/dev/hugepages',
+                 hugepages_path=HUGEPAGES_PATH, mounts_path=MOUNTS_PATH):
+        '''Page size is in kB.'''
+        self.page_size = page_size
+        self.mount_path = mount_path
+        self.hugepages_path = hugepages_path
+        self.mounts_path = mounts_path
+        self.lock = threading.Lock()
+        self.pending = dict()
+
+    def pages_needed(self, memory_size):
+        '''Pages for memory_size MB of guest memory.'''
+        return -(-memory_size * 1024 // self.page_size)
+
+    def get_shortage(self, memory_size):
+        '''Tell why memory_size MB cannot be backed right now, or None.'''
+        if not is_hugetlbfs_mounted(self.mount_path, self.mounts_path):
+            return 'hugetlbfs is not mounted at %s' % self.mount_path
+        counters = read_hugepage_counters(self.page_size,
+                                          self.hugepages_path)
+        available = counters['free_hugepages'] - \
+            counters['resv_hugepages'] - sum(self.pending.values())
+        needed = self.pages_needed(memory_size)
+        if needed > available:
+            return '%d hugepages of %d kB needed, %d of %d available' % (
+                needed, self.page_size, max(available, 0),
+                counters['nr_hugepages'])
+        return None
+
+    def reserve(self, key, memory_size):
+        '''Count the pages as taken until release(), or tell the shortage.'''
+        with self.lock:
+            shortage = self.get_shortage(memory_size)
+            if shortage is None:
+                self.pending[key] = self.pages_needed(memory_size)
+            return shortage
+
+    def release(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
@@ -1,6 +1,14 @@
 import os
+import json
+import time
+import pickle
+import struct
+import socket
 import logging
+import logging.handlers
 import textwrap
+import threading
+from collections import deque
 from picostack.socket_logger import LogRecordSocketReceiver
 
 
@@ -23,6 +31,13 @@ VERBOSITY_TO_LEVELS = {
     3: 'DEBUG',
     4: 'NOTSET',
 }
+# What to do once the queue of records to ship is full.
+OVERFLOW_POLICIES = ('drop_debug', 'drop_oldest', 'drop_newest')
+SERIALIZERS = ('json', 'pickle')
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 200
+LOG_FLUSH_INTERVAL = 0.2
+MAX_RETRY_DELAY = 30
 
 
 class Whitelist(logging.Filter):
@@ -43,36 +58,229 @@ def set_interactive_logging(verbosity_level):
         handler.addFilter(Whitelist(*WHITE_LIST))
 
 
-def set_logging_as_socket_client():
+def serialize_records(records, serializer):
+    '''
+    Payload of a frame with a batch of records. Receiver tells JSON from
+    pickle by the first byte, see socket_logger.decode_records().
+    '''
+    if serializer == 'json':
+        return json.dumps(records, default=str)
+    return pickle.dumps(records, pickle.HIGHEST_PROTOCOL)
+
+
+class BatchingSocketHandler(logging.Handler):
+    '''
+    Ships records to the log server without ever blocking the caller.
+    Records go into a bounded queue. A listener thread sends them in batches,
+    one length-prefixed frame per batch, and reconnects when needed.
+    '''
+
+    def __init__(self, host, port, queue_size=LOG_QUEUE_SIZE,
+                 overflow='drop_debug', serializer='json',
+                 batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL,
+                 socket_path=None):
+        '''Unix domain socket_path is used instead of TCP if given.'''
+        logging.Handler.__init__(self)
+        assert overflow in OVERFLOW_POLICIES
+        assert serializer in SERIALIZERS
+        self.address = (host, port)
+        self.socket_path = socket_path
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.serializer = serializer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sock = None
+        self.listener_pid = None
+        self.reset()
+
+    def reset(self):
+        # Threads do not survive fork(), e.g. by DaemonContext. Records of the
+        # parent are left to the parent.
+        self.condition = threading.Condition(threading.Lock())
+        self.records = deque()
+        # Queued DEBUG records, drop_debug looks for one only if there is.
+        self.num_of_debug = 0
+        self.num_of_dropped = 0
+        self.closing = False
+        self.listener = None
+        self.sock = None
+
+    def ensure_listener(self):
+        if self.listener_pid == os.getpid():
+            return
+        self.reset()
+        self.listener_pid = os.getpid()
+        self.listener = threading.Thread(target=self.run,
+                                         name='log-shipping')
+        self.listener.daemon = True
+        self.listener.start()
+
+    def prepare(self, record):
+        '''Same as SocketHandler.makePickle() does, but keep it a dict.'''
+        if record.exc_info:
+            # Puts the traceback into record.exc_text.
+            self.format(record)
+        prepared = dict(record.__dict__)
+        prepared['msg'] = record.getMessage()
+        prepared['args'] = None
+        prepared['exc_info'] = None
+        return prepared
+
+    def make_room(self, levelno):
+        '''Apply the overflow policy. False means drop the new record.'''
+        if self.overflow == 'drop_newest':
+            return False
+        if self.overflow == 'drop_debug':
+            if levelno <= logging.DEBUG:
+                return False
+            if self.num_of_debug:
+                for index, (queued_levelno, _) in enumerate(self.records):
+                    if queued_levelno <= logging.DEBUG:
+                        del self.records[index]
+                        self.num_of_debug -= 1
+                        self.num_of_dropped += 1
+                        return True
+        self.pop_record()
+        self.num_of_dropped += 1
+        return True
+
+    def pop_record(self):
+        '''Take the oldest queued record, the lock has to be held.'''
+        levelno, prepared = self.records.popleft()
+        if levelno <= logging.DEBUG:
+            self.num_of_debug -= 1
+        return prepared
+
+    def emit(self, record):
+        try:
+            prepared = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.ensure_listener()
+        with self.condition:
+            if len(self.records) >= self.queue_size \
+                    and not self.make_room(record.levelno):
+                self.num_of_dropped += 1
+                return
+            self.records.append((record.levelno, prepared))
+            if record.levelno <= logging.DEBUG:
+                self.num_of_debug += 1
+            if len(self.records) >= self.batch_size:
+                self.condition.notify()
+
+    def take_batch(self):
+        with self.condition:
+            # Let a batch fill up, records wait at most flush_interval.
+            if len(self.records) < self.batch_size and not self.closing:
+                self.condition.wait(self.flush_interval)
+            batch = [self.pop_record() for index
+                     in xrange(min(len(self.records), self.batch_size))]
+            num_of_dropped = self.num_of_dropped
+            self.num_of_dropped = 0
+        if num_of_dropped:
+            batch.append(self.prepare(logging.makeLogRecord({
+                'name': __name__,
+                'levelno': logging.WARN,
+                'levelname': 'WARNING',
+                'msg': 'Log queue was full, %d records were dropped.' %
+                       num_of_dropped,
+            })))
+        return batch
+
+    def connect(self):
+        if self.socket_path is None:
+            return socket.create_connection(self.address, timeout=5)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(5)
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def send(self, batch):
+        payload = serialize_records(batch, self.serializer)
+        frame = struct.pack('>L', len(payload)) + payload
+        retry_delay = 0.1
+        while True:
+            try:
+                if self.sock is None:
+                    self.sock = self.connect()
+                self.sock.sendall(frame)
+                return
+            except socket.error:
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                if self.closing:
+                    return
+                # Log server is (re)starting. Queue keeps the callers safe.
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            if batch:
+                self.send(batch)
+            elif self.closing:
+                return
+
+    def close(self):
+        '''Send what is queued (if the log server is there).'''
+        if self.listener is not None and self.listener_pid == os.getpid():
+            with self.condition:
+                self.closing = True
+                self.condition.notify()
+            self.listener.join(1.0)
+        if self.sock is not None:
+            self.sock.close()
+        logging.Handler.close(self)
+
+
+def set_logging_as_socket_client(queue_size=LOG_QUEUE_SIZE,
+                                 overflow='drop_debug', serializer='json',
+                                 socket_path=None):
     rootLogger = logging.getLogger('')
     rootLogger.setLevel(logging.DEBUG)
-    socketHandler = logging.handlers.SocketHandler(
-        'localhost', logging.handlers.DEFAULT_TCP_LOGGING_PORT)
+    socketHandler = BatchingSocketHandler(
+        'localhost', logging.handlers.DEFAULT_TCP_LOGGING_PORT,
+        queue_size=queue_size, overflow=overflow, serializer=serializer,
+        socket_path=socket_path)
     socketHandler.addFilter(Whitelist(*WHITE_LIST))
     rootLogger.addHandler(socketHandler)
 
 
-def set_logging_as_socket_server(logging_config_filename):
+def set_logging_as_socket_server(logging_config_filename, socket_path=None,
+                                 serializer='json'):
     logging.config.fileConfig(logging_config_filename,
                               disable_existing_loggers=False)
     # logging.basicConfig(
     #     format='%(relativeCreated)5d %(name)-15s %(levelname)-8s %(message)s')
-    tcpserver = LogRecordSocketReceiver()
+    tcpserver = LogRecordSocketReceiver(socket_path=socket_path,
+                                        serializer=serializer)
     tcpserver.serve_until_stopped()
 
 
-def fork_me_socket_logging(logging_config_filename):
+def fork_me_socket_logging(logging_config_filename, socket_path=None,
+                           **client_options):
     # Fork me a server
     try:
         pid = os.fork()
         if pid == 0:
             # I am a child and will become a server.
-            set_logging_as_socket_server(logging_config_filename)
+            set_logging_as_socket_server(
+                logging_config_filename, socket_path,
+                client_options.get('serializer', 'json'))
             # Exit child and another after work is done.
             exit(0)
         else:
             # I am a parent and will emit as a client.
-            set_logging_as_socket_client()
+            set_logging_as_socket_client(socket_path=socket_path,
+                                         **client_options)
             return pid
     except OSError, exc:
         exc_errno = exc.errno
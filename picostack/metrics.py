@@ -0,0 +1,237 @@
+'''
+Resource usage of the VMs. The daemon samples /proc/<pid>/{stat,status,io} of
+every running VM process on a fixed cadence. Samples are kept in fixed-size
+ring buffers backed by arrays. Older samples survive only as averages in the
+coarser tiers, so memory stays bounded however long the daemon runs.
+
+The history is written into a JSON snapshot for the web interface and CLI,
+which do not share memory with the daemon.
+'''
+import os
+import json
+import time
+import logging
+import threading
+from array import array
+
+
+logger = logging.getLogger(__name__)
+METRIC_FIELDS = ('cpu_percent', 'rss_bytes', 'read_rate', 'write_rate')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+# (collection intervals per sample, number of samples) of every tier. With the
+# default 5 sec interval: 30 min of raw samples, 6 hours of 1 min averages and
+# 3 days of 12 min averages.
+DEFAULT_TIERS = ((1, 360), (12, 360), (144, 360))
+
+
+class RingBuffer(object):
+    '''Fixed-size buffer of floats. Oldest values get overwritten.'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = array('d', [0.0]) * capacity
+        # Next position to write to.
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, value):
+        self.data[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def last(self):
+        if not self.size:
+            return None
+        return self.data[self.head - 1]
+
+    def values(self):
+        '''Oldest first.'''
+        start = (self.head - self.size) % self.capacity
+        if start + self.size <= self.capacity:
+            return self.data[start:start + self.size].tolist()
+        return (self.data[start:] + self.data[:self.head]).tolist()
+
+
+class Tier(object):
+    '''History of samples averaged over `factor` collection intervals.'''
+
+    def __init__(self, factor, capacity):
+        self.factor = factor
+        self.timestamps = RingBuffer(capacity)
+        self.series = dict((field, RingBuffer(capacity))
+                           for field in METRIC_FIELDS)
+        self.sums = dict.fromkeys(METRIC_FIELDS, 0.0)
+        self.count = 0
+
+    def add(self, timestamp, sample):
+        self.count += 1
+        for field in METRIC_FIELDS:
+            self.sums[field] += sample[field]
+        if self.count < self.factor:
+            return
+        self.timestamps.append(timestamp)
+        for field in METRIC_FIELDS:
+            self.series[field].append(self.sums[field] / self.count)
+            self.sums[field] = 0.0
+        self.count = 0
+
+    def as_dict(self, interval):
+        result = {
+            'step': self.factor * interval,
+            'timestamps': self.timestamps.values(),
+        }
+        for field in METRIC_FIELDS:
+            result[field] = self.series[field].values()
+        return result
+
+
+class MetricHistory(object):
+
+    def __init__(self, tiers=DEFAULT_TIERS):
+        self.tiers = [Tier(factor, capacity) for factor, capacity in tiers]
+
+    def add(self, timestamp, sample):
+        for tier in self.tiers:
+            tier.add(timestamp, sample)
+
+    def latest(self):
+        if not self.tiers[0].timestamps:
+            return None
+        latest = dict((field, self.tiers[0].series[field].last())
+                      for field in METRIC_FIELDS)
+        latest['timestamp'] = self.tiers[0].timestamps.last()
+        return latest
+
+    def as_dict(self, interval):
+        return {
+            'latest': self.latest(),
+            'tiers': [tier.as_dict(interval) for tier in self.tiers],
+        }
+
+
+def read_counters(pid):
+    '''Cumulative counters of the process as found in /proc.'''
+    with open('/proc/%d/stat' % pid) as stat:
+        # Skip "pid (comm)", comm can contain spaces. utime and stime are the
+        # 14th and 15th field, see man 5 proc.
+        fields = stat.read().rsplit(')', 1)[1].split()
+    counters = {
+        'cpu_ticks': int(fields[11]) + int(fields[12]),
+        'rss_bytes': 0,
+        'read_bytes': 0,
+        'write_bytes': 0,
+    }
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                counters['rss_bytes'] = int(line.split()[1]) * 1024
+                break
+    try:
+        with open('/proc/%d/io' % pid) as io:
+            for line in io:
+                key, value = line.split(':', 1)
+                if key in ('read_bytes', 'write_bytes'):
+                    counters[key] = int(value)
+    except IOError:
+        # Readable only by the owner of the process.
+        pass
+    return counters
+
+
+def make_sample(previous, current, elapsed):
+    return {
+        'cpu_percent': 100.0 * (current['cpu_ticks'] -
+                                previous['cpu_ticks']) / CLOCK_TICKS / elapsed,
+        'rss_bytes': float(current['rss_bytes']),
+        'read_rate': max(0, current['read_bytes'] -
+                         previous['read_bytes']) / elapsed,
+        'write_rate': max(0, current['write_bytes'] -
+                          previous['write_bytes']) / elapsed,
+    }
+
+
+def load_snapshot(snapshot_path):
+    '''Read the snapshot written by the daemon. None if there is none.'''
+    try:
+        with open(snapshot_path) as snapshot:
+            return json.load(snapshot)
+    except (IOError, ValueError):
+        return None
+
+
+class MetricsCollector(object):
+
+    def __init__(self, get_processes, interval=5.0, snapshot_path=None,
+                 tiers=DEFAULT_TIERS):
+        '''get_processes() returns {vm_name: pid} of the running VMs.'''
+        self.get_processes = get_processes
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.tiers = tiers
+        self.histories = dict()
+        self.previous = dict()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def collect(self, now=None):
+        if now is None:
+            now = time.time()
+        processes = self.get_processes()
+        for vm_name in set(self.previous) - set(processes):
+            # Forget machines that are gone.
+            self.previous.pop(vm_name)
+            self.histories.pop(vm_name, None)
+        for vm_name, pid in processes.items():
+            try:
+                counters = read_counters(pid)
+            except (IOError, IndexError, ValueError):
+                continue
+            previous = self.previous.get(vm_name)
+            self.previous[vm_name] = (pid, now, counters)
+            if previous is None or previous[0] != pid:
+                # Rates need two samples of the same process.
+                continue
+            elapsed = now - previous[1]
+            if elapsed <= 0:
+                continue
+            if vm_name not in self.histories:
+                self.histories[vm_name] = MetricHistory(self.tiers)
+            self.histories[vm_name].add(
+                now, make_sample(previous[2], counters, elapsed))
+
+    def as_dict(self):
+        return {
+            'interval': self.interval,
+            'collected_at': time.time(),
+            'instances': dict(
+                (vm_name, history.as_dict(self.interval))
+                for vm_name, history in self.histories.items()),
+        }
+
+    def write_snapshot(self):
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'w') as snapshot:
+            json.dump(self.as_dict(), snapshot)
+        # Web server runs under a different user.
+        os.chmod(temp_path, 0644)
+        # Readers never see a half-written file.
+        os.rename(temp_path, self.snapshot_path)
+
+    def run(self):
+        while True:
+            started_at = time.time()
+            try:
+                self.collect(started_at)
+                if self.snapshot_path is not None:
+                    self.write_snapshot()
+            except Exception:
+                logger.exception('Failed to collect VM metrics')
+            time.sleep(max(0, self.interval - (time.time() - started_at)))
@@ -0,0 +1,100 @@
+'''
+Allocation of host ports that guest services are mapped to. The allocator is
+seeded once from the DB and from the sockets listening on the host and keeps
+the state in memory, so both allocation and release are constant time.
+Reservations themselves are persisted by the VM manager as PortReservation
+rows with a unique port, which catches any collision with other processes.
+'''
+import logging
+import threading
+from collections import deque
+from picostack.errors import PicoStackError
+
+
+logger = logging.getLogger(__name__)
+TCP_TABLES = ('/proc/net/tcp', '/proc/net/tcp6')
+TCP_LISTEN = '0A'
+
+
+class PortAllocationError(PicoStackError):
+    '''Raised if all ports of the mapping range are taken.'''
+
+
+def parse_listening_ports(lines):
+    '''Get local ports of listening sockets from /proc/net/tcp lines.'''
+    ports = set()
+    for line in lines:
+        fields = line.split()
+        # Skip the header and anything malformed.
+        if len(fields) < 4 or ':' not in fields[1]:
+            continue
+        if fields[3] != TCP_LISTEN:
+            continue
+        try:
+            ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+        except ValueError:
+            continue
+    return ports
+
+
+def get_listening_ports():
+    ports = set()
+    for table in TCP_TABLES:
+        try:
+            with open(table) as tcp_table:
+                ports.update(parse_listening_ports(tcp_table))
+        except IOError:
+            logger.debug('Can not read %s. Skipping..' % table)
+    return ports
+
+
+class PortAllocator(object):
+    '''
+    Hands out ports from [first_port, last_port). Free ports are queued in a
+    FIFO free-list, while a bytemap answers whether a port is taken. Released
+    ports go to the end of the list, so they are reused as late as possible.
+    '''
+
+    def __init__(self, first_port, last_port, occupied_ports=()):
+        assert last_port > first_port
+        self.first_port = first_port
+        self.last_port = last_port
+        self.lock = threading.Lock()
+        self.taken = bytearray(last_port - first_port)
+        for port in occupied_ports:
+            if self.in_range(port):
+                self.taken[port - first_port] = 1
+        self.free = deque(port for port in xrange(first_port, last_port)
+                          if not self.taken[port - first_port])
+
+    def in_range(self, port):
+        return self.first_port <= port < self.last_port
+
+    def allocate(self):
+        with self.lock:
+            # Ports marked as taken from outside are still queued. Skip them.
+            while self.free:
+                port = self.free.popleft()
+                if not self.taken[port - self.first_port]:
+                    self.taken[port - self.first_port] = 1
+                    return port
+        raise PortAllocationError('All ports in range %d..%d are taken.' %
+                                  (self.first_port, self.last_port - 1))
+
+    def mark_taken(self, port):
+        if not self.in_range(port):
+            return
+        with self.lock:
+            self.taken[port - self.first_port] = 1
+
+    def release(self, port):
+        if not self.in_range(port):
+            return
+        with self.lock:
+            if self.taken[port - self.first_port]:
+                self.taken[port - self.first_port] = 0
+                self.free.append(port)
+
+    def is_taken(self, port):
+        return self.in_range(port) and \
+            bool(self.taken[port - self.first_port])
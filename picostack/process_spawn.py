@@ -3,11 +3,13 @@ Run on a local linux machine a subprocess in a daemon mode. Log the result.
 '''
 import os
 import sys
-import time
+import fcntl
+import select
 import signal
 import logging
 from StringIO import StringIO
 from datetime import datetime
+from collections import deque
 from daemoncxt.daemon import DaemonContext
 import errno
 from daemoncxt.lockfile import LockTimeout
@@ -25,7 +27,17 @@ class ExecProcessError(Exception):
 NEW_LINE = '\n'
 NUM_SECTION_LINES = 1000
 HZ = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
-SPAWN_TRIES = 3
+# Message of the spawning helper followed by the pid, see exec_process.
+SPAWN_STARTED = 'started '
+# Boot time and process start time are known with 1 sec precision.
+BIRTHTIME_TOLERANCE = 2
+REPORT_MAX_SIZE = 1024 * 1024
+REPORT_BACKUPS = 3
+# Last lines of the output repeated at the end of the report on failure.
+REPORT_TAIL_LINES = 100
+# Output without new lines is cut into lines of this length.
+MAX_LINE_LENGTH = 64 * 1024
+READ_SIZE = 65536
 
 
 def invoke(command, _in=None):
@@ -48,6 +60,127 @@ def strfdelta(tdelta, fmt):
 LOCAL_TIME_FMT = '{days} days {hours}:{minutes}:{seconds}'
 
 
+class RotatingReport(object):
+    '''
+    Report file capped at max_size bytes. Once full, it is moved to
+    <report>.1 (older ones to .2 and so on) and a fresh one is started.
+    '''
+
+    def __init__(self, filename, max_size=REPORT_MAX_SIZE,
+                 backups=REPORT_BACKUPS):
+        self.filename = filename
+        self.max_size = max_size
+        self.backups = backups
+        self.report = open(filename, 'a')
+        self.size = os.fstat(self.report.fileno()).st_size
+
+    def rotate(self):
+        self.report.close()
+        for index in xrange(self.backups - 1, 0, -1):
+            backup = '%s.%d' % (self.filename, index)
+            if os.path.exists(backup):
+                os.rename(backup, '%s.%d' % (self.filename, index + 1))
+        if self.backups > 0:
+            os.rename(self.filename, '%s.1' % self.filename)
+            self.report = open(self.filename, 'a')
+        else:
+            self.report = open(self.filename, 'w')
+        self.size = 0
+
+    def write(self, text):
+        if self.size > 0 and self.size + len(text) > self.max_size:
+            self.rotate()
+        self.report.write(text)
+        # Keep the report current in case the VM crashes.
+        self.report.flush()
+        self.size += len(text)
+
+    def close(self):
+        self.report.close()
+
+
+class LineSplitter(object):
+    '''
+    Cuts the output stream into lines which go to the report as well as to
+    the bounded tail.
+    '''
+
+    def __init__(self, report, tail):
+        self.report = report
+        self.tail = tail
+        self.pending = ''
+
+    def write_lines(self, lines):
+        for line in lines:
+            self.report.write(line + NEW_LINE)
+            self.tail.append(line)
+
+    def feed(self, data):
+        lines = (self.pending + data).split(NEW_LINE)
+        self.pending = lines.pop()
+        if len(self.pending) > MAX_LINE_LENGTH:
+            lines.append(self.pending)
+            self.pending = ''
+        self.write_lines(lines)
+
+    def flush(self):
+        '''Stream is closed. Write what is left of the last line.'''
+        if self.pending:
+            self.write_lines([self.pending])
+            self.pending = ''
+
+
+def stream_output(proc, report, tail):
+    '''
+    Copy stdout and stderr of the process line by line into the report until
+    both are closed.
+    '''
+    splitters = {
+        proc.stdout.fileno(): LineSplitter(report, tail),
+        proc.stderr.fileno(): LineSplitter(report, tail),
+    }
+    while splitters:
+        try:
+            readable, _, _ = select.select(list(splitters), [], [])
+        except select.error as error:
+            if error.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in readable:
+            data = os.read(fd, READ_SIZE)
+            if data:
+                splitters[fd].feed(data)
+            else:
+                splitters.pop(fd).flush()
+    return proc.wait()
+
+
+def describe_returncode(returncode):
+    '''Return (success, explanation) of the exit of VM process.'''
+    if returncode < 0:
+        # That is how VMs are stopped.
+        return True, 'killed by signal %d' % -returncode
+    if returncode > 0:
+        return False, 'exit status %d' % returncode
+    return True, ''
+
+
+def write_report_footer(report, shell_command, started_at, success,
+                        process_error, tail):
+    elapsed = datetime.now() - started_at
+    # TODO: gather /proc stats for current process
+    report.write('Elapsed time: %s \n' % strfdelta(elapsed, LOCAL_TIME_FMT))
+    report.write('Your job looked like:\n')
+    report.write(shell_command + '\n')
+    if success:
+        report.write('Successfully completed. %s\n' % process_error)
+    else:
+        report.write('Job failed with an error: %s.\n' % process_error)
+        # Output before the failure could have been rotated away.
+        report.write('Last %d lines of the output:\n' % len(tail))
+        report.write(''.join(line + NEW_LINE for line in tail))
+
+
 class ProcessUtil(object):
 
     __boot_time = None
@@ -63,43 +196,43 @@ class ProcessUtil(object):
 
     @classmethod
     def get_birthtime_secs(cls, pid):
-        process_stats = open('/proc/%d/stat' % int(pid)).read().split()
-        age_from_boot_jiffies = int(process_stats[21])
+        # Skip "pid (comm)" - comm can contain spaces. Start time is the 22nd
+        # field, see man 5 proc.
+        process_stats = open('/proc/%d/stat' % int(pid)).read()
+        process_stats = process_stats.rsplit(')', 1)[1].split()
+        age_from_boot_jiffies = int(process_stats[19])
         age_from_boot_timestamp = age_from_boot_jiffies / HZ
         age_timestamp = cls.get_boot_time() + age_from_boot_timestamp
         return age_timestamp
 
-    @classmethod
-    def list_processes(cls):
-        '''See also man 5 proc'''
-        pids = [pid for pid in os.listdir('/proc') if pid.isdigit() \
-                and os.access(os.path.join('/proc', pid, 'status'), os.R_OK) \
-                and os.access(os.path.join('/proc', pid, 'cmdline'), os.R_OK)]
-        for pid in pids:
-            proc_info = dict(id=pid)
-            try:
-                proc_info['cmdline'] = open(os.path.join('/proc', pid, 'cmdline'), 'rb').read()
-                #proc_info['cwd'] = os.readlink(os.path.join('/proc', pid, 'cwd'))
-                proc_info['running_since'] = ProcessUtil.get_birthtime_secs(pid)
-                # Read process status
-                proc_status = open(os.path.join('/proc', pid, 'status'), 'rb').read()
-                for line in proc_status.split('\n'):
-                    if not ':' in line:
-                        continue
-                    key, value = line.split(':', 1)
-                    proc_info[key.strip()] = value.strip()
-                yield proc_info
-            except IOError:
-                logger.debug('Can not read process (%d). Skipping..', pid)
+    @staticmethod
+    def split_command(shell_command):
+        '''Commands are simple, no quoting is supported.'''
+        return [arg for arg in shell_command.split(' ') if len(arg) > 0]
+
+    @staticmethod
+    def read_cmdline(pid):
+        with open('/proc/%d/cmdline' % int(pid), 'rb') as cmdline:
+            return cmdline.read().split('\0')[:-1]
 
     @classmethod
-    def exec_process(cls, shell_command, report_filename, pidfile_path):
+    def exec_process(cls, shell_command, report_filename, pidfile_path,
+                     max_report_size=REPORT_MAX_SIZE,
+                     report_backups=REPORT_BACKUPS):
 
-        def report_contains_error(report_filename):
-            # Implement parsing. If no error happend file will exists but will
-            # be empty. If things happens very fast but still ok  than the
-            # section after 'Process stderror was:\n' token will be empty.
-            return False
+        def read_status(status_r):
+            '''Block until the spawning helper reports back or dies.'''
+            status = ''
+            while True:
+                try:
+                    data = os.read(status_r, 4096)
+                except OSError as error:
+                    if error.errno == errno.EINTR:
+                        continue
+                    raise
+                if not data:
+                    return status.strip()
+                status += data
 
         def fork_parent(shell_command, report_filename, pidfile_path,
                         error_message):
@@ -109,63 +242,61 @@ class ProcessUtil(object):
                 with ``error_message``.
                 """
             try:
+                # The helper reports the outcome of the spawn through the pipe
+                # and closes it. Nothing is inherited by the spawned process.
+                status_r, status_w = os.pipe()
+                fcntl.fcntl(status_w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
                 pid = os.fork()
                 if pid > 0:
-                    logger.debug('Waiting for pidfile which means process '
-                                 'was spawned.')
+                    os.close(status_w)
+                    # Helper detaches right away, see DaemonContext.
                     os.waitpid(pid, 0)
-                    if os.path.exists(pidfile_path) \
-                            and os.path.exists(report_filename):
-                        logger.debug('Giving it another try while waiting '
-                                     'for pidfile..')
-                        # Wait and parse stderr output in the log file.
-                        # Assume process spawn only if such output is empty.
-                        if not report_contains_error(report_filename):
-                            logger.debug(
-                                'Process was successfully spawned as %d' %
-                                pid
-                            )
-                            return pid
-                    # Give it even more chances.. Waiting for the pidfile.
-                    for try_num in xrange(SPAWN_TRIES):
-                        logger.debug('..retrying')
-                        if os.path.exists(pidfile_path) \
-                                and os.path.exists(report_filename):
-                            # Repeat parsing effort of the log file.
-                            if not report_contains_error(report_filename):
-                                logger.debug(
-                                    'Process was successfully spawned as %d' %
-                                    pid
-                                )
-                                return pid
-                        time.sleep(1)
-                    raise ExecProcessError('Failed to spawn process '
-                                           'after (%d) retries..' %
-                                           SPAWN_TRIES)
+                    try:
+                        status = read_status(status_r)
+                    finally:
+                        os.close(status_r)
+                    if status.startswith(SPAWN_STARTED):
+                        proc_pid = int(status[len(SPAWN_STARTED):])
+                        logger.debug('Process was successfully spawned as %d'
+                                     % proc_pid)
+                        return proc_pid
+                    raise ExecProcessError('Failed to spawn process: %s' %
+                                           (status or 'helper has died'))
                 else:
+                    os.close(status_r)
                     with DaemonContext(
                         pidfile=ProcessUtil.get_pidfile(pidfile_path),
                         stdout=sys.stdout,
                         stderr=sys.stderr,
                         detach_process=True,
+                        files_preserve=[status_w],
                     ) as process:
                         process_error = ''
-                        # Write report file.
-                        report = open(report_filename, 'a+')
+                        # Output is streamed into the report as it comes.
+                        report = RotatingReport(report_filename,
+                                                max_report_size,
+                                                report_backups)
+                        tail = deque(maxlen=REPORT_TAIL_LINES)
                         started_at = datetime.now()
+                        report.write('Started at %s, the output follows:\n' %
+                                     started_at)
                         success = True
                         try:
-                            cmd_args = [arg for arg in shell_command.split(' ')
-                                        if len(arg) > 0]
+                            cmd_args = ProcessUtil.split_command(
+                                shell_command)
                             proc = Popen(cmd_args, stdout=PIPE, stderr=PIPE)
                             # Second pid of submissive process, that does the
                             # actual work. Save it so it can be killed as well
                             proc_pidfile_path = '%s_proc' % pidfile_path
                             with open(proc_pidfile_path, 'w+') as proc_pidfile:
                                 proc_pidfile.write('%d' % proc.pid)
+                            os.write(status_w, SPAWN_STARTED + str(proc.pid))
+                            os.close(status_w)
+                            status_w = None
                             # Do actual call.
-                            process_output, process_error = proc.communicate()
-                            # TODO: check return code?
+                            returncode = stream_output(proc, report, tail)
+                            success, process_error = describe_returncode(
+                                returncode)
                         except Exception as exception:
                             stderr = StringIO()
                             process_error = repr(exception)
@@ -176,23 +307,11 @@ class ProcessUtil(object):
                             process_error += '\n' + stderr.getvalue().strip()
                             print process_error
                             success = False
-                        time.sleep(5)
-                        elapsed = datetime.now() - started_at
-                        # TODO: gather /proc stats for current process
-                        report.write('Elapsed time: %s \n' %
-                                     strfdelta(elapsed, LOCAL_TIME_FMT))
-                        report.write('Your job looked like:\n')
-                        report.write(shell_command + '\n')
-                        if success:
-                            report.write('Successfully completed.\n')
-                        else:
-                            report.write('Job failed with an error: %s.\n' %
-                                         process_error)
-                        report.write('The output (if any) follows:\n')
-                        report.write('Process output was:\n')
-                        report.write(process_output)
-                        report.write('Process stderror was:\n')
-                        report.write(process_error)
+                            if status_w is not None:
+                                os.write(status_w, process_error)
+                        write_report_footer(report, shell_command,
+                                            started_at, success,
+                                            process_error, tail)
                         report.close()
                     # Exit child after work is done.
                     exit(0)
@@ -216,6 +335,16 @@ class ProcessUtil(object):
             raise ExecProcessError('Process pidfile is locked: ' +
                                    pidfile_path)
 
+    @staticmethod
+    def read_report_tail(report_filename, num_of_lines):
+        try:
+            with open(report_filename) as report:
+                report.seek(0, os.SEEK_END)
+                report.seek(max(0, report.tell() - READ_SIZE))
+                return report.read().splitlines()[-num_of_lines:]
+        except IOError:
+            return list()
+
     @staticmethod
     def get_pidfile(pidfile_path):
         '''Note that pidfile_path must be absolute'''
@@ -236,15 +365,28 @@ class ProcessUtil(object):
         else:
             return True
 
+    @classmethod
+    def started_before(cls, pid, timestamp):
+        '''
+        Process that was started after its pidfile had been written is not
+        the one from the pidfile, but a different one that reused the pid.
+        '''
+        return cls.get_birthtime_secs(pid) <= timestamp + BIRTHTIME_TOLERANCE
+
+    @staticmethod
+    def read_pid(pidfile_path):
+        return int(open(pidfile_path).read().strip())
+
     @classmethod
     def process_runs(cls, pidfile_path):
         logger.debug('Process runs? ' + pidfile_path)
         if os.path.exists(pidfile_path):
             try:
-                pid = int(open(pidfile_path).read().strip())
-                if cls.pid_exists(pid):
+                pid = cls.read_pid(pidfile_path)
+                if cls.pid_exists(pid) and cls.started_before(
+                        pid, os.path.getmtime(pidfile_path)):
                     return True
-            except ValueError:
+            except (ValueError, IOError, OSError):
                 return False
         return False
 
@@ -0,0 +1,116 @@
+'''
+Snapshot of the host process table shared by the heartbeat check, adoption of
+running VMs and cleanup. /proc is scanned once per daemon tick (or once per
+max_age seconds) and indexed by pid, VM name and disk path. Only cmdline is
+read for every process.
+'''
+import os
+import time
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessInfo(object):
+
+    __slots__ = ('pid', 'argv')
+
+    def __init__(self, pid, argv):
+        self.pid = pid
+        self.argv = argv
+
+    @property
+    def cmdline(self):
+        return ' '.join(self.argv)
+
+    def get_option(self, option):
+        '''Value of "-option value" in argv or None.'''
+        try:
+            return self.argv[self.argv.index(option) + 1]
+        except (ValueError, IndexError):
+            return None
+
+    @property
+    def vm_name(self):
+        name = self.get_option('-name')
+        if name is not None:
+            # e.g. -name guest=foo,process=bar
+            name = name.split(',')[0]
+            if name.startswith('guest='):
+                name = name[len('guest='):]
+        return name
+
+    @property
+    def disk_paths(self):
+        disk_paths = list()
+        for index, arg in enumerate(self.argv[:-1]):
+            if arg == '-hda':
+                disk_paths.append(self.argv[index + 1])
+            elif arg == '-drive':
+                for drive_option in self.argv[index + 1].split(','):
+                    if drive_option.startswith('file='):
+                        disk_paths.append(drive_option[len('file='):])
+        return disk_paths
+
+
+class ProcessTable(object):
+
+    def __init__(self, max_age=1.0):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.taken_at = None
+        self.by_pid = dict()
+        self.by_name = dict()
+        self.by_disk = dict()
+
+    def invalidate(self):
+        with self.lock:
+            self.taken_at = None
+
+    def refresh(self):
+        by_pid = dict()
+        by_name = dict()
+        by_disk = dict()
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            pid = int(entry)
+            try:
+                with open('/proc/%d/cmdline' % pid, 'rb') as cmdline:
+                    argv = cmdline.read().split('\0')[:-1]
+            except IOError:
+                # Gone in the meantime or not ours to read.
+                continue
+            process = ProcessInfo(pid, argv)
+            by_pid[pid] = process
+            vm_name = process.vm_name
+            if vm_name is not None:
+                by_name[vm_name] = process
+            for disk_path in process.disk_paths:
+                by_disk[os.path.normpath(disk_path)] = process
+        self.by_pid = by_pid
+        self.by_name = by_name
+        self.by_disk = by_disk
+        self.taken_at = time.time()
+        logger.debug('Process table snapshot with %d processes' % len(by_pid))
+
+    def snapshot(self):
+        '''Get the table, refreshed if older than max_age.'''
+        with self.lock:
+            if self.taken_at is None \
+                    or time.time() - self.taken_at > self.max_age:
+                self.refresh()
+        return self
+
+    def find_by_name(self, vm_name):
+        return self.snapshot().by_name.get(vm_name)
+
+    def find_by_disk(self, disk_path):
+        return self.snapshot().by_disk.get(os.path.normpath(disk_path))
+
+    def find_matching(self, needle):
+        '''All processes with needle anywhere in their command line.'''
+        return [process for process in self.snapshot().by_pid.values()
+                if needle in process.cmdline]
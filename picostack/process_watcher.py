@@ -0,0 +1,110 @@
+'''
+Watch VM processes and report their exit the moment it happens. Relies on
+pidfd_open(2) (Linux 5.3+): a pidfd refers to one particular process, so a
+reused PID can never be mistaken for the watched one. The exit status is only
+known for our own children, other (adopted) processes report None.
+'''
+import os
+import time
+import errno
+import ctypes
+import select
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+# Same syscall number on all architectures.
+NR_PIDFD_OPEN = 434
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def pidfd_open(pid):
+    fd = _libc.syscall(NR_PIDFD_OPEN, ctypes.c_int(pid), ctypes.c_uint(0))
+    if fd < 0:
+        error_number = ctypes.get_errno()
+        raise OSError(error_number, os.strerror(error_number))
+    return fd
+
+
+def reap(pid):
+    '''Collect exit status of own child. None if it is not our child.'''
+    try:
+        reaped_pid, status = os.waitpid(pid, os.WNOHANG)
+    except OSError as error:
+        if error.errno == errno.ECHILD:
+            return None
+        raise
+    if reaped_pid == 0:
+        return None
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class ProcessWatcher(object):
+
+    def __init__(self, on_exit):
+        '''on_exit(key, pid, exit_status, exited_at) is called by a thread.'''
+        self.on_exit = on_exit
+        self.poller = select.epoll()
+        self.watched = dict()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @staticmethod
+    def is_supported():
+        try:
+            os.close(pidfd_open(os.getpid()))
+        except OSError:
+            return False
+        return True
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='process-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self, key, pid):
+        '''Start watching the process. Return False if it is already gone.'''
+        try:
+            fd = pidfd_open(pid)
+        except OSError as error:
+            if error.errno == errno.ESRCH:
+                return False
+            raise
+        with self.lock:
+            self.watched[fd] = (key, pid)
+            self.poller.register(fd, select.EPOLLIN)
+        logger.debug('Watching process %d of %s' % (pid, key))
+        return True
+
+    def is_watched(self, key):
+        with self.lock:
+            return any(watched_key == key
+                       for watched_key, pid in self.watched.values())
+
+    def run(self):
+        while True:
+            try:
+                events = self.poller.poll(-1)
+            except IOError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                with self.lock:
+                    entry = self.watched.pop(fd, None)
+                    if entry is not None:
+                        self.poller.unregister(fd)
+                if entry is None:
+                    continue
+                os.close(fd)
+                key, pid = entry
+                exit_status = reap(pid)
+                logger.info('Process %d of %s has exited with status %s' %
+                            (pid, key, exit_status))
+                try:
+                    self.on_exit(key, pid, exit_status, time.time())
+                except Exception:
+                    logger.exception('Failed to handle exit of %d' % pid)
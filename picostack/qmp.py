@@ -0,0 +1,297 @@
+'''
+Client of the QEMU Machine Protocol (QMP), see
+https://wiki.qemu.org/Documentation/QMP
+
+Every VM listens on its own unix socket. The daemon keeps one connection per
+running VM in a QmpPool, which reconnects when needed and pushes events
+(SHUTDOWN, STOP, RESET, ...) to subscribers from a single thread.
+'''
+import os
+import json
+import time
+import errno
+import fcntl
+import select
+import socket
+import logging
+import threading
+from collections import deque
+from picostack.errors import PicoStackError
+
+
+logger = logging.getLogger(__name__)
+RECV_SIZE = 65536
+RECONNECT_PAUSE = 5
+
+
+class QmpError(PicoStackError):
+    '''Raised if QMP command fails or VM can not be reached.'''
+
+
+class QmpConnection(object):
+    '''
+    Connection to a single VM. Commands are synchronous. Events that arrive
+    in the meantime are queued and picked up by the pool.
+    '''
+
+    def __init__(self, socket_path, timeout=5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = ''
+        self.events = deque()
+        self.lock = threading.Lock()
+        self.command_id = 0
+
+    @property
+    def is_connected(self):
+        return self.sock is not None
+
+    def connect(self):
+        with self.lock:
+            if self.sock is not None:
+                return
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except socket.error as error:
+                sock.close()
+                raise QmpError('Failed to connect to %s: %s' %
+                               (self.socket_path, error))
+            self.sock = sock
+            self.buffer = ''
+            try:
+                greeting = self.read_message()
+                if 'QMP' not in greeting:
+                    raise QmpError('Unexpected greeting: %s' % greeting)
+                self.send_command('qmp_capabilities')
+            except Exception:
+                self.disconnect()
+                raise
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+    def has_buffered_message(self):
+        return '\n' in self.buffer
+
+    def parse_message(self):
+        line, self.buffer = self.buffer.split('\n', 1)
+        return json.loads(line)
+
+    def read_message(self):
+        '''Block (up to timeout) until a whole message is received.'''
+        while '\n' not in self.buffer:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except socket.error as error:
+                self.disconnect()
+                raise QmpError('Lost connection to %s: %s' %
+                               (self.socket_path, error))
+            if not data:
+                self.disconnect()
+                raise QmpError('VM closed connection %s' % self.socket_path)
+            self.buffer += data
+        return self.parse_message()
+
+    def send_command(self, command, arguments=None):
+        self.command_id += 1
+        request = {'execute': command, 'id': self.command_id}
+        if arguments:
+            request['arguments'] = arguments
+        try:
+            self.sock.sendall(json.dumps(request) + '\n')
+        except socket.error as error:
+            self.disconnect()
+            raise QmpError('Lost connection to %s: %s' %
+                           (self.socket_path, error))
+        while True:
+            message = self.read_message()
+            if 'event' in message:
+                self.events.append(message)
+            elif message.get('id') != self.command_id:
+                continue
+            elif 'error' in message:
+                raise QmpError('%s failed: %s' % (
+                    command, message['error'].get('desc', message['error'])))
+            else:
+                return message.get('return')
+
+    def execute(self, command, arguments=None):
+        if self.sock is None:
+            self.connect()
+        with self.lock:
+            if self.sock is None:
+                raise QmpError('Not connected to %s' % self.socket_path)
+            return self.send_command(command, arguments)
+
+    def poll_events(self):
+        '''Collect events that have arrived so far without blocking.'''
+        with self.lock:
+            if self.sock is None:
+                return list()
+            # A command could have read the data since the pool's select(),
+            # so check again while holding the lock.
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if readable:
+                try:
+                    data = self.sock.recv(RECV_SIZE)
+                except socket.error as error:
+                    if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self.disconnect()
+                    data = None
+                if data == '':
+                    self.disconnect()
+                elif data:
+                    self.buffer += data
+            while self.has_buffered_message():
+                message = self.parse_message()
+                if 'event' in message:
+                    self.events.append(message)
+            events = list(self.events)
+            self.events.clear()
+            return events
+
+
+class QmpPool(object):
+    '''Connections to all running VMs plus the thread dispatching events.'''
+
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self.connections = dict()
+        self.subscribers = dict()
+        self.lock = threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        fcntl.fcntl(self.wakeup_r, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='qmp-events')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        self.thread.join()
+        with self.lock:
+            connections = self.connections.values()
+            self.connections.clear()
+        for connection in connections:
+            connection.close()
+
+    def wake(self):
+        os.write(self.wakeup_w, 'w')
+
+    def drain(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def add(self, key, socket_path):
+        '''Start talking to a VM. Connects lazily.'''
+        with self.lock:
+            old_connection = self.connections.get(key)
+            self.connections[key] = QmpConnection(socket_path, self.timeout)
+        if old_connection is not None:
+            old_connection.close()
+        self.wake()
+
+    def remove(self, key):
+        with self.lock:
+            connection = self.connections.pop(key, None)
+        if connection is not None:
+            connection.close()
+
+    def has(self, key):
+        with self.lock:
+            return key in self.connections
+
+    def subscribe(self, event_name, callback):
+        '''callback(key, event) is called from the event thread.'''
+        self.subscribers.setdefault(event_name, list()).append(callback)
+
+    def execute(self, key, command, arguments=None):
+        with self.lock:
+            connection = self.connections.get(key)
+        if connection is None:
+            raise QmpError('No QMP connection for %s' % key)
+        try:
+            return connection.execute(command, arguments)
+        finally:
+            if connection.events:
+                # Let the event thread dispatch what came with the reply.
+                self.wake()
+
+    def query_status(self, key):
+        '''e.g. {"running": true, "status": "running"}'''
+        return self.execute(key, 'query-status')
+
+    def system_powerdown(self, key):
+        return self.execute(key, 'system_powerdown')
+
+    def set_balloon(self, key, memory_size):
+        '''Set the target size of the guest memory in MB.'''
+        return self.execute(key, 'balloon',
+                            {'value': memory_size * 1024 * 1024})
+
+    def query_balloon(self, key):
+        return self.execute(key, 'query-balloon')
+
+    def query_blockstats(self, key):
+        return self.execute(key, 'query-blockstats')
+
+    def dispatch(self, key, events):
+        for event in events:
+            logger.debug('QMP event of %s: %s' % (key, event['event']))
+            for callback in self.subscribers.get(event['event'], list()):
+                try:
+                    callback(key, event)
+                except Exception:
+                    logger.exception('Failed to handle QMP event %s' % event)
+
+    def reconnect(self, connections):
+        for key, connection in connections:
+            if connection.is_connected:
+                continue
+            try:
+                connection.connect()
+            except QmpError as error:
+                logger.debug('QMP of %s is not available: %s' % (key, error))
+
+    def run(self):
+        last_reconnect = 0
+        while self.running:
+            with self.lock:
+                connections = self.connections.items()
+            if time.time() - last_reconnect > RECONNECT_PAUSE:
+                self.reconnect(connections)
+                last_reconnect = time.time()
+            sockets = [connection.sock for key, connection in connections]
+            try:
+                select.select(
+                    [self.wakeup_r] + [sock for sock in sockets
+                                       if sock is not None],
+                    [], [], RECONNECT_PAUSE)
+            except (select.error, socket.error, ValueError):
+                # Connection was closed under our hands. Just look again.
+                continue
+            # Drain the wakeups before looking for events. An event queued
+            # by a command after this point comes with another wakeup.
+            self.drain()
+            with self.lock:
+                connections = self.connections.items()
+            for key, connection in connections:
+                self.dispatch(key, connection.poll_events())
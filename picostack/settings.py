@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+from picostack.sqlite_tuning import SQLITE_BUSY_TIMEOUT
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 
@@ -66,9 +67,29 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': DATABASE_LOCATION,
+        # Wait for the lock held by the daemon instead of failing right away.
+        # Connections are set to WAL mode, see sqlite_tuning.py.
+        'OPTIONS': {
+            'timeout': SQLITE_BUSY_TIMEOUT,
+        },
+        # Web workers keep their connection across requests.
+        'CONN_MAX_AGE': 600,
     }
 }
 
+# Unix datagram socket the daemon listens on for wakeups from the web interface
+# and command line. It lives next to the DB since both the daemon and the web
+# server user already have access to that folder.
+DAEMON_WAKEUP_SOCKET = os.path.join(os.path.dirname(DATABASE_LOCATION),
+                                    'picostk.wakeup')
+# Resource usage history of the VMs written by the daemon, see metrics.py.
+METRICS_SNAPSHOT = os.path.join(os.path.dirname(DATABASE_LOCATION),
+                                'picostk.metrics.json')
+# Instance event streams (/events/) open at once in one web server process.
+# Each holds a WSGI thread for minutes, so keep this well below the threads
+# of the process. Browsers over the limit poll /status/ instead.
+EVENTS_MAX_STREAMS = 8
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
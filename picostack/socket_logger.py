@@ -1,47 +1,183 @@
 '''
 Picked up from https://docs.python.org/2/howto/logging-cookbook.html#sending-
 and-receiving-logging-events-across-a-network
+The receiver serves all the clients from an event loop in a single thread.
 '''
+import os
+import json
+import errno
 import pickle
+import select
+import socket
 import logging
 import logging.handlers
-import SocketServer
 import struct
 
 
-class LogRecordStreamHandler(SocketServer.StreamRequestHandler):
-    """Handler for a streaming logging request.
+# Received data of a client goes into a buffer of this size (at first).
+RECV_BUFFER_SIZE = 256 * 1024
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+LISTEN_BACKLOG = 128
 
-    This basically logs the record using whatever logging policy is
-    configured locally.
+
+def decode_records(data, serializer='json'):
+    '''
+    Frame holds a single record of logging.handlers.SocketHandler or a batch
+    of records of BatchingSocketHandler, pickled or as JSON. Unpickling runs
+    code of whoever connects, so pickles are only taken if configured.
+    '''
+    if data[:1] in ('[', '{'):
+        obj = json.loads(data)
+    elif serializer == 'pickle':
+        obj = pickle.loads(data)
+    else:
+        raise ValueError('Log frame is not JSON')
+    if isinstance(obj, dict):
+        return [obj]
+    return obj
+
+
+class FrameReader(object):
     """
+    Receives length-prefixed frames into a preallocated buffer. Parsed data
+    is only moved once the buffer is full, the buffer grows for big frames
+    and shrinks back once they are consumed.
+    """
+
+    def __init__(self, size=RECV_BUFFER_SIZE):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
 
-    def handle(self):
-        """
-        Handle multiple requests - each expected to be a 4-byte length,
-        followed by the LogRecord in pickle format. Logs the record
-        according to whatever policy is configured locally.
-        """
-        while True:
-            chunk = self.connection.recv(4)
-            if len(chunk) < 4:
+    def recv_from(self, sock):
+        if self.end == len(self.buffer):
+            self.make_room()
+        received = sock.recv_into(memoryview(self.buffer)[self.end:])
+        self.end += received
+        return received
+
+    def make_room(self):
+        pending = self.end - self.start
+        self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def frames(self):
+        # Size of the frame that is not received in full yet.
+        needed = 0
+        while self.end - self.start >= 4:
+            length = struct.unpack_from('>L', self.buffer, self.start)[0]
+            if length > MAX_FRAME_SIZE:
+                raise ValueError('Log frame of %d bytes is too big' % length)
+            frame_end = self.start + 4 + length
+            if frame_end > self.end:
+                needed = 4 + length
                 break
-            slen = struct.unpack('>L', chunk)[0]
-            chunk = self.connection.recv(slen)
-            while len(chunk) < slen:
-                chunk = chunk + self.connection.recv(slen - len(chunk))
-            obj = self.unPickle(chunk)
-            record = logging.makeLogRecord(obj)
-            self.handleLogRecord(record)
+            yield bytes(self.buffer[self.start + 4:frame_end])
+            self.start = frame_end
+        if needed > len(self.buffer):
+            self.buffer.extend(bytearray(needed - len(self.buffer)))
+        elif len(self.buffer) > self.size and \
+                max(needed, self.end - self.start) <= self.size:
+            self.shrink()
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def shrink(self):
+        '''Big frames are consumed, keep the rest in a buffer of usual size.'''
+        pending = self.end - self.start
+        buffer = bytearray(self.size)
+        buffer[:pending] = self.buffer[self.start:self.end]
+        self.buffer = buffer
+        self.start = 0
+        self.end = pending
+
 
-    def unPickle(self, data):
-        return pickle.loads(data)
+def make_poller():
+    """Return poller and the multiplier of its timeout in seconds."""
+    if hasattr(select, 'epoll'):
+        return select.epoll(), 1
+    return select.poll(), 1000
+
+
+class LogRecordSocketReceiver(object):
+    """
+    Serves all the clients from a single thread, on TCP and (optionally) on
+    a unix domain socket.
+    """
+
+    def __init__(self, host='localhost',
+                 port=logging.handlers.DEFAULT_TCP_LOGGING_PORT,
+                 socket_path=None, serializer='json'):
+        self.abort = 0
+        self.timeout = 1
+        self.logname = None
+        self.socket_path = socket_path
+        self.serializer = serializer
+        self.listeners = dict()
+        self.connections = dict()
+        self.poller = None
+        tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tcp_sock.bind((host, port))
+        self.server_address = tcp_sock.getsockname()
+        self.add_listener(tcp_sock)
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                # Left over by a logging server that was killed.
+                os.unlink(socket_path)
+            unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            unix_sock.bind(socket_path)
+            os.chmod(socket_path, 0o770)
+            self.add_listener(unix_sock)
+
+    def add_listener(self, sock):
+        sock.listen(LISTEN_BACKLOG)
+        sock.setblocking(0)
+        self.listeners[sock.fileno()] = sock
+
+    def accept(self, listener):
+        try:
+            connection, _ = listener.accept()
+        except socket.error as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        connection.setblocking(0)
+        self.connections[connection.fileno()] = (connection, FrameReader())
+        self.poller.register(connection.fileno(), select.POLLIN)
+
+    def drop_connection(self, fd):
+        connection, _ = self.connections.pop(fd)
+        self.poller.unregister(fd)
+        connection.close()
+
+    def read(self, fd):
+        connection, reader = self.connections[fd]
+        try:
+            received = reader.recv_from(connection)
+        except socket.error as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            received = 0
+        if not received:
+            self.drop_connection(fd)
+            return
+        try:
+            for frame in reader.frames():
+                for obj in decode_records(frame, self.serializer):
+                    self.handleLogRecord(logging.makeLogRecord(obj))
+        except Exception:
+            logging.getLogger(__name__).exception(
+                'Dropping client with malformed log records')
+            self.drop_connection(fd)
 
     def handleLogRecord(self, record):
         # if a name is specified, we use the named logger rather than the one
         # implied by the record.
-        if self.server.logname is not None:
-            name = self.server.logname
+        if self.logname is not None:
+            name = self.logname
         else:
             name = record.name
         logger = logging.getLogger(name)
@@ -51,31 +187,33 @@ class LogRecordStreamHandler(SocketServer.StreamRequestHandler):
         # cycles and network bandwidth!
         logger.handle(record)
 
-class LogRecordSocketReceiver(SocketServer.ThreadingTCPServer):
-    """
-    Simple TCP socket-based logging receiver suitable for testing.
-    """
-
-    allow_reuse_address = 1
+    def serve_until_stopped(self):
+        self.poller, scale = make_poller()
+        for fd in self.listeners:
+            self.poller.register(fd, select.POLLIN)
+        while not self.abort:
+            try:
+                events = self.poller.poll(self.timeout * scale)
+            except (IOError, select.error) as error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, _ in events:
+                if fd in self.listeners:
+                    self.accept(self.listeners[fd])
+                elif fd in self.connections:
+                    self.read(fd)
+        self.server_close()
 
-    def __init__(self, host='localhost',
-                 port=logging.handlers.DEFAULT_TCP_LOGGING_PORT,
-                 handler=LogRecordStreamHandler):
-        SocketServer.ThreadingTCPServer.__init__(self, (host, port), handler)
-        self.abort = 0
-        self.timeout = 1
-        self.logname = None
+    def server_close(self):
+        for fd in list(self.connections):
+            self.drop_connection(fd)
+        for sock in self.listeners.values():
+            sock.close()
+        self.listeners.clear()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
 
-    def serve_until_stopped(self):
-        import select
-        abort = 0
-        while not abort:
-            rd, wr, ex = select.select([self.socket.fileno()],
-                                       [], [],
-                                       self.timeout)
-            if rd:
-                self.handle_request()
-            abort = self.abort
 
 def main():
     logging.basicConfig(
@@ -0,0 +1,33 @@
+'''
+Daemon, web server workers and the command line share a single SQLite file.
+In WAL mode readers do not wait for the writer (and the other way around),
+writers wait for each other up to the busy timeout instead of failing with
+"database is locked". The folder of the DB has to be writable for all of them,
+since the -wal and -shm files live next to the DB.
+'''
+
+# Seconds a connection waits for a lock held by another one (timeout option of
+# the DB in settings.py).
+SQLITE_BUSY_TIMEOUT = 20
+SQLITE_PRAGMAS = (
+    # Kept in the DB file, but setting it again is cheap.
+    ('journal_mode', 'WAL'),
+    # With WAL only a power loss may roll back the last transactions.
+    ('synchronous', 'NORMAL'),
+)
+
+
+def apply_pragmas(cursor, pragmas=SQLITE_PRAGMAS):
+    for name, value in pragmas:
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+
+
+def tune_sqlite_connection(sender, connection, **kwargs):
+    '''Receiver of django.db.backends.signals.connection_created.'''
+    if connection.vendor != 'sqlite':
+        return
+    cursor = connection.cursor()
+    try:
+        apply_pragmas(cursor)
+    finally:
+        cursor.close()
@@ -0,0 +1,184 @@
+'''
+Spawn VMs as direct children of the daemon. ProcessUtil.exec_process keeps a
+daemonized helper process (with its own pidfile) per VM which waits for QEMU.
+Here a single thread of the daemon streams the output of all VMs into their
+reports and reaps them once they exit.
+'''
+import os
+import time
+import errno
+import fcntl
+import select
+import signal
+import logging
+import threading
+from datetime import datetime
+from collections import deque
+from subprocess import Popen, PIPE
+from picostack.process_spawn import (
+    ProcessUtil, RotatingReport, LineSplitter, describe_returncode,
+    write_report_footer, REPORT_MAX_SIZE, REPORT_BACKUPS, REPORT_TAIL_LINES,
+    READ_SIZE)
+
+
+logger = logging.getLogger(__name__)
+# How often exited children are checked for once their output is closed.
+EXIT_POLL_INTERVAL = 0.05
+
+
+def detach_child():
+    '''
+    Run in the child before exec. Own session keeps the VM away from signals
+    sent to the terminal of the daemon. Once the daemon is gone, writes to
+    the closed pipes must not kill the VM.
+    '''
+    os.setsid()
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+
+
+class Child(object):
+
+    def __init__(self, key, proc, shell_command, report):
+        self.key = key
+        self.proc = proc
+        self.shell_command = shell_command
+        self.report = report
+        self.tail = deque(maxlen=REPORT_TAIL_LINES)
+        self.started_at = datetime.now()
+        self.open_streams = 2
+        self.returncode = None
+        self.exited = threading.Event()
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+
+class Supervisor(object):
+
+    def __init__(self, on_exit=None):
+        '''on_exit(key, pid, exit_status, exited_at) is called by a thread.'''
+        self.on_exit = on_exit
+        self.lock = threading.Lock()
+        self.children = dict()
+        self.streams = dict()
+        self.exiting = list()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        fcntl.fcntl(self.wakeup_r, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='supervisor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wake(self):
+        os.write(self.wakeup_w, 'w')
+
+    def spawn(self, key, shell_command, report_filename, pidfile_path,
+              max_report_size=REPORT_MAX_SIZE, report_backups=REPORT_BACKUPS):
+        '''
+        Start the VM process and write its pid into pidfile_path. Child is
+        returned as soon as the process is executed, exec errors are raised.
+        '''
+        report = RotatingReport(report_filename, max_report_size,
+                                report_backups)
+        report.write('Started at %s, the output follows:\n' % datetime.now())
+        try:
+            proc = Popen(ProcessUtil.split_command(shell_command),
+                         stdout=PIPE, stderr=PIPE, close_fds=True,
+                         preexec_fn=detach_child)
+        except OSError as error:
+            report.write('Failed to start: %s\n' % error)
+            report.close()
+            raise
+        with open(pidfile_path, 'w+') as pidfile:
+            pidfile.write('%d' % proc.pid)
+        child = Child(key, proc, shell_command, report)
+        with self.lock:
+            self.children[proc.pid] = child
+            for stream in (proc.stdout, proc.stderr):
+                self.streams[stream.fileno()] = (
+                    child, stream, LineSplitter(report, child.tail))
+        self.wake()
+        logger.info('Spawned VM process %d of %s' % (proc.pid, key))
+        return child
+
+    def is_supervised(self, key):
+        with self.lock:
+            return any(child.key == key for child in self.children.values())
+
+    def drain(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def read_stream(self, fd):
+        with self.lock:
+            child, stream, splitter = self.streams[fd]
+        data = os.read(fd, READ_SIZE)
+        if data:
+            splitter.feed(data)
+            return
+        splitter.flush()
+        with self.lock:
+            del self.streams[fd]
+        stream.close()
+        child.open_streams -= 1
+        if child.open_streams == 0:
+            self.exiting.append(child)
+
+    def reap_exited(self):
+        for child in list(self.exiting):
+            pid, status = os.waitpid(child.proc.pid, os.WNOHANG)
+            if pid == 0:
+                continue
+            exited_at = time.time()
+            self.exiting.remove(child)
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+            # Keep Popen from waiting for the pid again.
+            child.proc.returncode = returncode
+            success, process_error = describe_returncode(returncode)
+            write_report_footer(child.report, child.shell_command,
+                                child.started_at, success, process_error,
+                                child.tail)
+            child.report.close()
+            with self.lock:
+                del self.children[pid]
+            child.returncode = returncode
+            child.exited.set()
+            logger.info('VM process %d of %s has exited with status %d' %
+                        (pid, child.key, returncode))
+            if self.on_exit is not None:
+                try:
+                    self.on_exit(child.key, pid, returncode, exited_at)
+                except Exception:
+                    logger.exception('Failed to handle exit of %d' % pid)
+
+    def run(self):
+        while True:
+            with self.lock:
+                fds = list(self.streams)
+            timeout = EXIT_POLL_INTERVAL if self.exiting else None
+            try:
+                readable, _, _ = select.select([self.wakeup_r] + fds, [], [],
+                                               timeout)
+            except select.error as error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                if fd == self.wakeup_r:
+                    self.drain()
+                    continue
+                try:
+                    self.read_stream(fd)
+                except Exception:
+                    logger.exception('Failed to read output of a VM')
+            self.reap_exited()
@@ -8,6 +8,11 @@ urlpatterns = patterns('',
     url(r'^$', RedirectView.as_view(url='/instances', permanent=False), name='home'),
     url(r'^connect_instance/', 'picostack.vms.views.get_connection_details', name='connect_instance'),
     url(r'^list_instances/', 'picostack.vms.views.list_instances', name='list_instance'),
+    url(r'^metrics/', 'picostack.vms.views.instance_metrics', name='instance_metrics'),
+    url(r'^status/', 'picostack.vms.views.instance_status', name='instance_status'),
+    url(r'^events/', 'picostack.vms.views.instance_events', name='instance_events'),
+    url(r'^instances/bulk/$', 'picostack.vms.views.bulk_instance_action', name='bulk_instance_action'),
+    url(r'^instances/(?P<pk>\d+)/(?P<action>start|stop|trash)/$', 'picostack.vms.views.instance_action', name='instance_action'),
     url(r'^instances/', 'picostack.vms.views.manage_instances', name='view_instances'),
     url(r'^logout/', 'picostack.vms.views.logout_view', name='logout'),
     url(r'^novnc/', 'picostack.vms.views.novnc', name='novnc'),
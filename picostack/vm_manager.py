@@ -1,17 +1,43 @@
 import os
-import sh
-import re
+import time
+import json
+import uuid
+import errno
 import signal
-import shutil
 import logging
+import threading
 import psutil
-from collections import deque
+from datetime import datetime
+from functools import partial
+from django.db import transaction, IntegrityError
+from django.utils import timezone
 from picostack.vms.models import (
-    VmInstance, VM_PORTS,
-    VM_IN_CLONING, VM_IS_STOPPED, VM_IS_LAUNCHED, VM_IS_RUNNING,
+    VmImage, VmInstance, PortReservation, InstanceTableVersion, VM_PORTS,
+    CLONE_OVERLAY, MEMORY_DEFAULT, MEMORY_HUGEPAGES, DISK_BUS_IDE,
+    DISK_BUS_VIRTIO_SCSI,
+    VM_IN_CLONING, VM_IS_STOPPED, VM_IS_LAUNCHED, VM_IS_QUEUED, VM_IS_RUNNING,
     VM_HAS_FAILED, VM_IS_TERMINATING, VM_IS_TRASHED,
 )
-from process_spawn import ProcessUtil
+from process_spawn import (ProcessUtil, ExecProcessError, REPORT_MAX_SIZE,
+                           REPORT_BACKUPS)
+from picostack.errors import PicoStackError
+from picostack.worker_pool import WorkerPool
+from picostack.wakeup import wake_daemon, WORK_DONE_MESSAGE
+from picostack.file_copy import copy_file
+from picostack.port_allocator import PortAllocator, get_listening_ports
+from picostack.process_watcher import ProcessWatcher
+from picostack.process_table import ProcessTable
+from picostack.qmp import QmpPool, QmpConnection, QmpError
+from picostack.supervisor import Supervisor
+from picostack.host_capacity import HostCapacity
+from picostack.hugepages import HugepagePool
+from picostack.cpu_placement import (CpuPlacement,
+                                     read_cpu_topology, parse_cpu_list,
+                                     format_cpu_list, find_vcpu_threads,
+                                     apply_affinity)
+from picostack.disk_image import (DiskImageError, get_backing_file,
+                                  get_image_format, create_overlay,
+                                  protect_image, unprotect_image)
 
 logger = logging.getLogger(__name__)
 
@@ -35,10 +61,15 @@ class CallBuilder(object):
             return DebianKvm()
         raise Exception('Unknown call builder name: %s' % builder_name)
 
-    def build_params(self):
+    def build_params(self, parameters=None):
+        if parameters is None:
+            parameters = self.parameters
         options = list()
-        for key in self.parameters:
-            value = self.parameters[key]
+        for key in parameters:
+            value = parameters[key]
+            if value is None:
+                # Dropped by overrides.
+                continue
             if type(value) == list:
                 for subvalue in value:
                     options.append('-' + key + ' ' + subvalue)
@@ -46,9 +77,53 @@ class CallBuilder(object):
                 options.append('-' + key + ' ' + value)
         return ' '.join(options)
 
-    def get_call(self, substitute_vars):
-        '''Make a command line text with VM call.'''
-        return self.executable + ' ' + self.build_params() % substitute_vars
+    def get_call(self, substitute_vars, overrides=None):
+        '''
+        Make a command line text with VM call. Overrides replace or add
+        parameters of this call only, e.g. the memory backing of the VM.
+        '''
+        parameters = self.parameters
+        if overrides:
+            parameters = dict(self.parameters)
+            parameters.update(overrides)
+        return self.executable + ' ' + \
+            self.build_params(parameters) % substitute_vars
+
+    def get_disk_params(self, image, disk_format):
+        '''
+        Get overrides attaching the disk the way the image asks for. Emulated
+        IDE with default settings stays the plain -hda of configure().
+        '''
+        options = ['cache=%s' % image.disk_cache, 'aio=%s' % image.disk_aio]
+        if image.disk_discard:
+            options += ['discard=unmap', 'detect-zeroes=unmap']
+        if image.disk_bus == DISK_BUS_IDE:
+            if options == ['cache=writeback', 'aio=threads']:
+                return dict()
+            return {
+                'hda': None,
+                'drive': ','.join(['file=%(disk_path)s', 'if=ide',
+                                   'index=0', 'media=disk',
+                                   'format=' + disk_format] + options),
+            }
+        parameters = {
+            'hda': None,
+            'drive': ','.join(['file=%(disk_path)s', 'if=none', 'id=disk0',
+                               'format=' + disk_format] + options),
+        }
+        iothread = ''
+        if image.disk_iothread:
+            parameters['object'] = 'iothread,id=iothread0'
+            iothread = ',iothread=iothread0'
+        if image.disk_bus == DISK_BUS_VIRTIO_SCSI:
+            parameters['device'] = [
+                'virtio-scsi-pci,id=scsi0' + iothread,
+                'scsi-hd,drive=disk0,bus=scsi0.0,bootindex=0',
+            ]
+        else:
+            parameters['device'] = \
+                'virtio-blk-pci,drive=disk0,bootindex=0' + iothread
+        return parameters
 
     def configure(self):
         '''Configure command line builder with default set of parameters.'''
@@ -88,18 +163,122 @@ class DebianKvm(CallBuilder):
         self.parameters['balloon'] = 'virtio'
 
 
+VM_OPERATIONS = ('clone', 'start', 'stop', 'trash')
+VNC_BASE_PORT = 5900
+READY_POLL_INTERVAL = 0.02
+# Lines of the VM output kept as the error of a failed start.
+ERROR_TAIL_LINES = 20
+# Defaults of the vm_manager section, set by PicoStackApp.init_config() and
+# used by VmManager for options missing in a config of its own.
+VM_MANAGER_DEFAULTS = dict(
+    call_builder='ubuntu_kvm',
+    qemu_img='/usr/bin/qemu-img',
+    # Number of worker threads per operation type. Zero means that the
+    # operation is done right away in the main loop of the daemon.
+    clone_workers='2',
+    start_workers='4',
+    stop_workers='4',
+    trash_workers='2',
+    # Launches wait in the queue unless the VMs fit the host: memory (MB)
+    # and cores left to the host, the rest times the overcommit ratio.
+    memory_reserve='1024',
+    cpu_reserve='0',
+    memory_overcommit='1.0',
+    cpu_overcommit='4.0',
+    # CPUs left to the host by flavours that pin VMs, e.g. 0-1.
+    host_cpus='0',
+    # Flavours with hugepage backing map guest memory from this hugetlbfs
+    # mount, its page size is in kB.
+    hugepages_mount='/dev/hugepages',
+    hugepage_size='2048',
+    # VMs are children of the daemon, see supervisor.py. Set to "detached"
+    # to spawn every VM through its own helper process.
+    spawn_mode='supervisor',
+    # Starting VM is running once its QMP socket answers. Give up waiting
+    # after this many seconds and assume it runs anyway.
+    ready_timeout='30',
+    # Output of every VM goes to a report rotated after this many bytes.
+    report_max_size=str(REPORT_MAX_SIZE),
+    report_backups=str(REPORT_BACKUPS),
+)
+
+
+class VmSpawnError(PicoStackError):
+    '''Raised if VM process exits before it gets ready.'''
+
+
 class VmManager(object):
 
     def __init__(self, config):
         self.config = config
-        self.__next_unmapped_port = None
+        self.__port_allocator = None
+        self.__cpu_placement = None
+        self.__hugepage_pool = None
+        self.__worker_pool = None
+        self.process_watcher = None
+        self.supervisor = None
+        self.qmp_pool = None
+        self.process_table = ProcessTable()
         self.call_builder = CallBuilder.factory(self.call_builder_name)
 
+    def get_option(self, option, convert=str):
+        '''Value of the vm_manager option, or its default.'''
+        if self.config.has_option('vm_manager', option):
+            return convert(self.config.get('vm_manager', option))
+        return convert(VM_MANAGER_DEFAULTS[option])
+
     @property
     def call_builder_name(self):
-        if self.config.has_option('vm_manager', 'call_builder'):
-            return self.config.get('vm_manager', 'call_builder')
-        return 'ubuntu_kvm'
+        return self.get_option('call_builder')
+
+    @property
+    def qemu_img(self):
+        return self.get_option('qemu_img')
+
+    @property
+    def spawn_mode(self):
+        '''
+        "supervisor" - VMs are children of the daemon, "detached" - every VM
+        is spawned through a daemonized helper process.
+        '''
+        return self.get_option('spawn_mode')
+
+    @property
+    def ready_timeout(self):
+        '''Seconds to wait for the QMP socket of a starting VM.'''
+        return self.get_option('ready_timeout', float)
+
+    @property
+    def memory_reserve(self):
+        '''MB of memory left to the host, VMs share the rest.'''
+        return self.get_option('memory_reserve', int)
+
+    @property
+    def cpu_reserve(self):
+        return self.get_option('cpu_reserve', int)
+
+    @property
+    def memory_overcommit(self):
+        return self.get_option('memory_overcommit', float)
+
+    @property
+    def cpu_overcommit(self):
+        return self.get_option('cpu_overcommit', float)
+
+    @property
+    def host_cpus(self):
+        '''CPUs never given to pinned VMs, e.g. "0-1".'''
+        return self.get_option('host_cpus', parse_cpu_list)
+
+    @property
+    def hugepages_mount(self):
+        '''Mount point of hugetlbfs, QEMU maps guest memory from there.'''
+        return self.get_option('hugepages_mount')
+
+    @property
+    def hugepage_size(self):
+        '''In kB, the default size of the kernel unless mounted otherwise.'''
+        return self.get_option('hugepage_size', int)
 
     @property
     def vm_image_path(self):
@@ -109,40 +288,166 @@ class VmManager(object):
     def vm_disk_path(self):
         return self.config.get('vm_manager', 'vm_disk_path')
 
+    def get_num_of_workers(self, operation):
+        return self.get_option('%s_workers' % operation, int)
+
+    @property
+    def worker_pool(self):
+        '''Created on demand - CLI calls machine operations directly.'''
+        if self.__worker_pool is None:
+            # Let the daemon pick up the follow-up work right away.
+            self.__worker_pool = WorkerPool(
+                dict((operation, self.get_num_of_workers(operation))
+                     for operation in VM_OPERATIONS),
+                on_done=partial(wake_daemon, message=WORK_DONE_MESSAGE))
+        return self.__worker_pool
+
     def validate_config(self):
         assert self.config.has_section('vm_manager')
         assert os.path.exists(self.vm_image_path)
         assert os.path.exists(self.vm_disk_path)
 
     @property
-    def mapping_port_range(self):
-        first_port = int(self.config.get('app', 'first_mapped_port'))
-        last_port = int(self.config.get('app', 'last_mapped_port'))
-        assert last_port > first_port
-        if self.__next_unmapped_port is None \
-                or self.__next_unmapped_port > last_port:
-            self.__next_unmapped_port = first_port
-        mapping_port_range = range(first_port, last_port)
-        result = deque(mapping_port_range)
-        shift = self.__next_unmapped_port - first_port + 1
-        result.rotate(-1 * shift)
-        return result
-
-    def get_next_unmapped_port(self):
+    def port_allocator(self):
+        '''Seeded on first use from the DB and host's listening sockets.'''
+        if self.__port_allocator is None:
+            occupied_ports = set(PortReservation.objects.values_list(
+                'port', flat=True))
+            occupied_ports.update(VmInstance.get_all_occupied_ports())
+            occupied_ports.update(get_listening_ports())
+            self.__port_allocator = PortAllocator(
+                int(self.config.get('app', 'first_mapped_port')),
+                int(self.config.get('app', 'last_mapped_port')),
+                occupied_ports)
+        return self.__port_allocator
+
+    def reserve_port(self, machine, service):
+        '''Get a host port for the service of the machine and persist it.'''
+        while True:
+            port = self.port_allocator.allocate()
+            try:
+                with transaction.atomic():
+                    PortReservation.objects.create(
+                        port=port, instance=machine, service=service)
+            except IntegrityError:
+                # Reserved by somebody else behind our back. Allocator keeps
+                # the port marked as taken, try the next one.
+                logger.warning('Port %d is already reserved.' % port)
+                continue
+            return port
+
+    @property
+    def cpu_placement(self):
+        '''Seeded on first use from the host topology and the DB.'''
+        if self.__cpu_placement is None:
+            self.__cpu_placement = CpuPlacement(read_cpu_topology(),
+                                                self.host_cpus)
+            for pk, pinned_cpus in VmInstance.objects.filter(
+                    current_state__in=(VM_IS_LAUNCHED, VM_IS_RUNNING,
+                                       VM_IS_TERMINATING)).exclude(
+                    pinned_cpus='').values_list('pk', 'pinned_cpus'):
+                self.__cpu_placement.restore(pk, parse_cpu_list(pinned_cpus))
+        return self.__cpu_placement
+
+    def pin_machine(self, machine):
+        '''Assign dedicated CPUs to the machine and persist them.'''
+        cpus = self.cpu_placement.assign(machine.pk, machine.num_of_cores)
+        machine.pinned_cpus = format_cpu_list(cpus)
+        machine.save(update_fields=['pinned_cpus'])
+        logger.info('Machine "%s" gets CPUs %s' % (machine.name,
+                                                  machine.pinned_cpus))
+
+    def unpin_machine(self, machine):
+        if self.__cpu_placement is not None and \
+                self.__cpu_placement.release(machine.pk):
+            # Unpinned VMs may use the CPUs again.
+            self.confine_unpinned_machines()
+        if machine.pinned_cpus:
+            machine.pinned_cpus = ''
+            machine.save(update_fields=['pinned_cpus'])
+
+    def get_shared_cpus(self):
+        '''CPUs for VMs that are not pinned, None if no VM is pinned.'''
+        if self.__cpu_placement is None and not VmInstance.objects.exclude(
+                pinned_cpus='').exists():
+            return None
+        return self.cpu_placement.get_shared_cpus()
+
+    def confine_machine(self, name, pid, cpus):
+        try:
+            apply_affinity(pid, cpus, {})
+        except (EnvironmentError, psutil.Error) as error:
+            logger.warning('Failed to keep "%s" on CPUs %s: %s' %
+                           (name, format_cpu_list(cpus), error))
+
+    def confine_unpinned_machines(self):
+        '''Keep running VMs that are not pinned off the assigned CPUs.'''
+        cpus = self.get_shared_cpus()
+        if cpus is None:
+            return
+        unpinned = set(VmInstance.objects.filter(
+            current_state=VM_IS_RUNNING, pinned_cpus='').values_list(
+            'name', flat=True))
+        for name, pid in self.get_running_processes().items():
+            if name in unpinned:
+                self.confine_machine(name, pid, cpus)
+
+    def release_unused_cpus(self):
+        '''CPUs of machines that have failed or stopped in any other way.'''
+        if self.__cpu_placement is None:
+            return
+        active = set(VmInstance.objects.filter(current_state__in=(
+            VM_IS_LAUNCHED, VM_IS_RUNNING, VM_IS_TERMINATING)).values_list(
+            'pk', flat=True))
+        unused = [pk for pk in self.__cpu_placement.assignments
+                  if pk not in active]
+        for pk in unused:
+            self.__cpu_placement.release(pk)
+        if unused:
+            VmInstance.objects.filter(pk__in=unused).update(pinned_cpus='')
+            self.confine_unpinned_machines()
+
+    @property
+    def hugepage_pool(self):
+        if self.__hugepage_pool is None:
+            self.__hugepage_pool = HugepagePool(self.hugepage_size,
+                                                self.hugepages_mount)
+        return self.__hugepage_pool
+
+    def reserve_memory_backing(self, machine):
         '''
-        Get a next port form the mapping range that was not mapped by any
-        instances.
+        Get call parameters for the memory backing of the flavour. Hugepages
+        are counted as taken until release_memory_backing(). If the pool is
+        short, VmSpawnError is raised for strict flavours, the others run on
+        normal memory.
         '''
-        # Get a list of ports, occupied by running instances
-        already_mapped_ports = VmInstance.get_all_occupied_ports()
-        # Continue until unmapped port is found.
-        for next_port in self.mapping_port_range:
-            if next_port in already_mapped_ports:
-                continue
-            # Found unmapped port.
-            self.__next_unmapped_port = next_port
-            return next_port
-        raise Exception('Failed to find unmapped/unoccupied port.')
+        flavour = machine.flavour
+        if flavour.memory_backing == MEMORY_DEFAULT:
+            return dict()
+        shortage = self.hugepage_pool.reserve(machine.pk, machine.memory_size)
+        if shortage is None:
+            parameters = {'mem-path': self.hugepages_mount}
+            if flavour.hugepages_prealloc:
+                parameters['mem-prealloc'] = ''
+            return parameters
+        if flavour.memory_backing == MEMORY_HUGEPAGES:
+            raise VmSpawnError('Flavour "%s" needs hugepages: %s' %
+                               (flavour, shortage))
+        logger.warning('Machine "%s" falls back to normal memory: %s' %
+                       (machine.name, shortage))
+        return dict()
+
+    def release_memory_backing(self, machine):
+        '''Kernel accounts for the hugepages once the VM has mapped them.'''
+        if self.__hugepage_pool is not None:
+            self.__hugepage_pool.release(machine.pk)
+
+    def release_ports(self, machine):
+        ports = list(machine.port_reservations.values_list('port', flat=True))
+        machine.port_reservations.all().delete()
+        if self.__port_allocator is not None:
+            for port in ports:
+                self.__port_allocator.release(port)
 
     @property
     def location_of_images(self):
@@ -158,6 +463,95 @@ class VmManager(object):
     def get_disk_path(self, machine):
         return os.path.join(self.location_of_disks, machine.disk_filename)
 
+    def get_image_format(self, image):
+        '''Format set by the admin, or the one of the image file.'''
+        if image.image_format:
+            return image.image_format
+        try:
+            return get_image_format(self.get_image_path(image))
+        except (OSError, IOError):
+            logger.warning('Failed to read the format of image "%s"' %
+                           image.name, exc_info=True)
+            return 'qcow2'
+
+    def get_spares_path(self, image):
+        '''Spare disks are kept on the same filesystem to be claimed fast.'''
+        return os.path.join(self.location_of_disks, '.spares', str(image.pk))
+
+    def list_spares(self, image):
+        spares_path = self.get_spares_path(image)
+        if not os.path.exists(spares_path):
+            return list()
+        return sorted(os.path.join(spares_path, filename)
+                      for filename in os.listdir(spares_path)
+                      if filename.endswith('.dsk'))
+
+    def claim_spare_disk(self, machine):
+        '''
+        Turn one of the pre-cloned spare disks into the disk of the machine.
+        Return False if there was none left.
+        '''
+        disk_file = self.get_disk_path(machine)
+        if os.path.exists(disk_file):
+            return False
+        try:
+            spares = self.list_spares(machine.image)
+        except OSError:
+            logger.info('Failed to list spare disks', exc_info=True)
+            return False
+        for spare_file in spares:
+            try:
+                # Atomic - concurrent claimers can not get the same spare.
+                os.rename(spare_file, disk_file)
+            except OSError as error:
+                if error.errno == errno.ENOENT:
+                    continue
+                logger.info('Failed to claim spare disk %s' % spare_file,
+                            exc_info=True)
+                return False
+            logger.info('Machine "%s" got spare disk %s' %
+                        (machine.name, spare_file))
+            return True
+        return False
+
+    def refill_spare_pools(self):
+        '''
+        Keep spare_pool_size of spare disks ready for every image. A task
+        makes one spare only, its completion wakes the daemon for the next.
+        '''
+        if VmInstance.objects.filter(current_state=VM_IN_CLONING).exists():
+            # Instances that wait for their disks come first.
+            return
+        for image in VmImage.objects.all():
+            if len(self.list_spares(image)) != image.spare_pool_size:
+                self.worker_pool.submit('clone', ('spares', image.pk),
+                                        self.make_spare, image.pk)
+
+    def make_spare(self, image_pk):
+        image = VmImage.objects.get(pk=image_pk)
+        spares_path = self.get_spares_path(image)
+        if not os.path.exists(spares_path):
+            os.makedirs(spares_path)
+        for filename in os.listdir(spares_path):
+            if filename.endswith('.tmp'):
+                # Unfinished spare of a killed daemon.
+                os.unlink(os.path.join(spares_path, filename))
+        spares = self.list_spares(image)
+        for spare_file in spares[image.spare_pool_size:]:
+            logger.info('Removing excessive spare disk %s' % spare_file)
+            self.remove_disk(image, spare_file)
+        if len(spares) >= image.spare_pool_size:
+            return
+        if VmInstance.objects.filter(current_state=VM_IN_CLONING).exists():
+            # Instances queued for cloning meanwhile come first.
+            return
+        spare_file = os.path.join(spares_path, '%s.dsk' % uuid.uuid4().hex)
+        logger.info('Preparing spare disk %s of image "%s"' %
+                    (spare_file, image.name))
+        # Never let anybody claim a half-done spare.
+        self.produce_disk(image, spare_file + '.tmp')
+        os.rename(spare_file + '.tmp', spare_file)
+
     def get_pid_file(self, machine):
         pidfiles_folder = self.config.get('app', 'pidfiles_path')
         return os.path.join(pidfiles_folder, '%s.pid' % machine.name)
@@ -166,6 +560,15 @@ class VmManager(object):
         logfiles_folder = self.config.get('app', 'log_path')
         return os.path.join(logfiles_folder, '%s.log' % machine.name)
 
+    @property
+    def report_max_size(self):
+        '''Size in bytes after which the report of a VM is rotated.'''
+        return self.get_option('report_max_size', int)
+
+    @property
+    def report_backups(self):
+        return self.get_option('report_backups', int)
+
     def get_vnc_target_path(self, machine):
         vnc_targets_path = os.path.join(self.config.get('app', 'statepath'),
                                         'vnc-targets')
@@ -173,6 +576,13 @@ class VmManager(object):
             os.makedirs(vnc_targets_path)
         return os.path.join(vnc_targets_path, machine.name)
 
+    def get_qmp_socket_path(self, machine):
+        qmp_sockets_path = os.path.join(self.config.get('app', 'statepath'),
+                                        'qmp')
+        if not os.path.exists(qmp_sockets_path):
+            os.makedirs(qmp_sockets_path)
+        return os.path.join(qmp_sockets_path, '%s.sock' % machine.name)
+
     @classmethod
     def create(self, name, config):
         '''Fabric of VM managers'''
@@ -180,23 +590,125 @@ class VmManager(object):
             return Kvm(config)
         raise Exception('Unknown VM manager: %s' % name)
 
+    def dispatch(self, operation, machine, method):
+        '''Hand the machine over to the workers of given operation type.'''
+        if not self.worker_pool.submit(operation, machine.pk,
+                                       self.handle_machine, method,
+                                       machine.pk, machine.current_state):
+            logger.info('Machine "%s" is still being handled. Skipping..' %
+                        machine.name)
+
+    def handle_machine(self, method, machine_pk, expected_state):
+        '''Run in a worker. Machine is re-read since it could have changed.'''
+        try:
+            machine = VmInstance.objects.get(pk=machine_pk,
+                                             current_state=expected_state)
+        except VmInstance.DoesNotExist:
+            logger.info('Machine #%d has changed in the meantime. Skipping..' %
+                        machine_pk)
+            return
+        try:
+            method(machine)
+        except Exception as error:
+            logger.exception('Failed to handle machine "%s"' % machine.name)
+            machine.mark_failed(str(error) or repr(error))
+
     def build_machines(self):
         instances = VmInstance.objects.filter(current_state=VM_IN_CLONING)
         if not instances.exists():
             logger.info('Nothing to clone..')
             return
         for machine in instances:
+            if not self.worker_pool.is_busy(machine.pk) \
+                    and self.claim_spare_disk(machine):
+                machine.change_state(VM_IS_STOPPED)
+                continue
             logger.info('Cloning "%s"' % machine.name)
-            self.clone_from_image(machine)
+            self.dispatch('clone', machine, self.clone_from_image)
+
+    def get_host_capacity(self):
+        '''Capacity of the host with running (and stopping) VMs accounted.'''
+        capacity = HostCapacity(self.memory_reserve, self.cpu_reserve,
+                                self.memory_overcommit, self.cpu_overcommit)
+        for machine in VmInstance.objects.filter(current_state__in=(
+                VM_IS_RUNNING, VM_IS_TERMINATING)).select_related('flavour'):
+            capacity.reserve(machine.memory_size, machine.num_of_cores)
+        return capacity
 
     def start_machines(self):
-        instances = VmInstance.objects.filter(current_state=VM_IS_LAUNCHED)
+        '''
+        Launches are admitted only if the host has the capacity for them.
+        The rest waits in the queue, which is strictly ordered by priority
+        and then by the time of queueing: nobody overtakes the head.
+        '''
+        instances = VmInstance.objects.filter(current_state__in=(
+            VM_IS_LAUNCHED, VM_IS_QUEUED)).select_related('flavour')
         if not instances.exists():
             logger.info('Nothing to start..')
             return
+        self.release_unused_cpus()
+        capacity = self.get_host_capacity()
+        waiting = list()
         for machine in instances:
+            if machine.current_state == VM_IS_LAUNCHED \
+                    and self.worker_pool.is_busy(machine.pk):
+                # Being started right now.
+                capacity.reserve(machine.memory_size, machine.num_of_cores)
+            else:
+                waiting.append(machine)
+        waiting.sort(key=lambda machine: (
+            -machine.priority, machine.launch_queued_at is None,
+            machine.launch_queued_at, machine.pk))
+        is_blocked = False
+        for machine in waiting:
+            error = self.get_misfit_error(machine, capacity)
+            if error is not None:
+                # Would block the queue forever. Users may have stopped the
+                # queued machine meanwhile.
+                machine.switch_state([VM_IS_LAUNCHED, VM_IS_QUEUED],
+                                     VM_HAS_FAILED, last_error=error)
+                continue
+            if is_blocked or not self.admit_machine(machine, capacity):
+                is_blocked = True
+                self.queue_machine(machine)
+                continue
+            if machine.current_state == VM_IS_QUEUED and \
+                    not machine.switch_state([VM_IS_QUEUED], VM_IS_LAUNCHED,
+                                             launch_queued_at=None):
+                self.unpin_machine(machine)
+                continue
             logger.info('Start running machine "%s"' % machine.name)
-            self.run_machine(machine)
+            self.dispatch('start', machine, self.run_machine)
+
+    def get_misfit_error(self, machine, capacity):
+        '''Tell why the machine can never start on this host, or None.'''
+        if capacity.exceeds_host(machine.memory_size, machine.num_of_cores):
+            return 'Flavour "%s" (%d MB, %d cores) does not fit the host.' % (
+                machine.flavour, machine.memory_size, machine.num_of_cores)
+        if machine.flavour.pin_cpus and \
+                machine.num_of_cores > self.cpu_placement.num_of_pinnable:
+            return 'Flavour "%s" pins %d cores, only %d CPUs can be ' \
+                'pinned.' % (machine.flavour, machine.num_of_cores,
+                             self.cpu_placement.num_of_pinnable)
+        return None
+
+    def admit_machine(self, machine, capacity):
+        '''Reserve capacity (and CPUs if the flavour pins them).'''
+        if not capacity.fits(machine.memory_size, machine.num_of_cores):
+            return False
+        if machine.flavour.pin_cpus:
+            if not self.cpu_placement.can_assign(machine.num_of_cores):
+                return False
+            self.pin_machine(machine)
+        return capacity.admit(machine.memory_size, machine.num_of_cores)
+
+    def queue_machine(self, machine):
+        if machine.current_state == VM_IS_QUEUED:
+            return
+        if machine.switch_state([VM_IS_LAUNCHED], VM_IS_QUEUED,
+                                launch_queued_at=timezone.now()):
+            logger.info('Not enough capacity to start "%s", queued.' %
+                        machine.name)
 
     def stop_machines(self):
         instances = VmInstance.objects.filter(current_state=VM_IS_TERMINATING)
@@ -205,7 +717,7 @@ class VmManager(object):
             return
         for machine in instances:
             logger.info('Terminating machine "%s"' % machine.name)
-            self.stop_machine(machine)
+            self.dispatch('stop', machine, self.stop_machine)
 
     def destory_machines(self):
         instances = VmInstance.objects.filter(current_state=VM_IS_TRASHED)
@@ -214,7 +726,7 @@ class VmManager(object):
             return
         for machine in instances:
             logger.info('Trashing machine "%s"' % machine.name)
-            self.remove_machine(machine)
+            self.dispatch('trash', machine, self.remove_machine)
 
     def run_machine(self, machine):
         raise NotImplementedError()
@@ -225,31 +737,24 @@ class VmManager(object):
     def clone_from_image(self, machine):
         raise NotImplementedError()
 
+    def produce_disk(self, image, dst_file):
+        raise NotImplementedError()
+
+    def remove_disk(self, image, disk_file):
+        raise NotImplementedError()
+
     def remove_machine(self, vm_image):
         raise NotImplementedError()
 
     def kill_all_machines(self):
         raise NotImplementedError()
 
+    def get_running_processes(self):
+        '''Get {name: pid} of the running machines.'''
+        raise NotImplementedError()
 
-def get_cmd_from_ps(needle):
-    try:
-        result = sh.grep(sh.cat(sh.ps('-wwaeopid,cmd')), needle)
-    except sh.ErrorReturnCode_1:
-        raise KeyError('Failed to find: %s' % needle)
-    except sh.ErrorReturnCode:
-        print("unknown error")
-        exit(1)
-    if result.exit_code == 0:
-        for line in result.stdout.split('\n'):
-            line = line.strip()
-            if not line:
-                continue
-            match = re.search(r'^(\d*)\s*(.*)', line)
-            if match.group(2).startswith('grep'):
-                continue
-            return match.group(2)
-    raise KeyError('Failed to find: %s' % needle)
+    def start_watching(self):
+        raise NotImplementedError()
 
 
 class Kvm(VmManager):
@@ -272,7 +777,19 @@ class Kvm(VmManager):
         logging.debug('Local VNC port is: %d' % local_vnc_port)
         return local_vnc_port
 
-    def get_kvm_call(self, machine):
+    def get_disk_format(self, machine):
+        '''Overlays are qcow2, full copies have the format of the image.'''
+        image = machine.image
+        image_format = self.get_image_format(image)
+        if image.clone_mode == CLONE_OVERLAY and image_format != 'qcow2':
+            try:
+                if get_backing_file(self.get_disk_path(machine)) is not None:
+                    return 'qcow2'
+            except (OSError, IOError):
+                pass
+        return image_format
+
+    def get_kvm_call(self, machine, overrides=None):
         # Make a list of ports to redirect from the VM to host. Ports will be
         # available at the host computer.
         redirected_ports = ''
@@ -284,8 +801,10 @@ class Kvm(VmManager):
             ports_to_map.append('vnc')
         if machine.has_rdp:
             ports_to_map.append('rdp')
+        # Drop reservations left over, e.g. by a failed machine.
+        self.release_ports(machine)
         for port_to_map in ports_to_map:
-            unmapped_port = self.get_next_unmapped_port()
+            unmapped_port = self.reserve_port(machine, port_to_map)
             machine.map_port(port_to_map, unmapped_port)
             redirected_ports += ' -redir tcp:%d::%d ' % (unmapped_port,
                                                          VM_PORTS[port_to_map])
@@ -293,6 +812,14 @@ class Kvm(VmManager):
         machine.localhost_vnc_port = self.get_dynamic_localhost_vncport(
             machine)
         host_vnc = '-vnc localhost:%d' % machine.localhost_vnc_port
+        # Name makes the process easy to recognize.
+        host_name = '-name %s' % machine.name
+        # Control channel of the daemon, see QmpPool.
+        qmp_socket = '-qmp unix:%s,server,nowait' % \
+            self.get_qmp_socket_path(machine)
+        overrides = dict(overrides or {})
+        overrides.update(self.call_builder.get_disk_params(
+            machine.image, self.get_disk_format(machine)))
         # Make a command line text with KVM call.
         return self.call_builder.get_call({
             'disk_path': self.get_disk_path(machine),
@@ -300,112 +827,483 @@ class Kvm(VmManager):
             'num_of_cores': machine.num_of_cores,
             'redirected_ports': redirected_ports,
             'host_vnc': host_vnc,
-        }) + ' '.join([redirected_ports, host_vnc])
+        }, overrides) + ' '.join([redirected_ports, host_vnc, host_name,
+                                  qmp_socket])
+
+    def get_launch_record_file(self, machine):
+        pidfiles_folder = self.config.get('app', 'pidfiles_path')
+        return os.path.join(pidfiles_folder, '%s.launch' % machine.name)
+
+    def write_launch_record(self, machine, shell_command):
+        '''
+        Keep what we know about the spawned VM, so nobody has to dig it out
+        of the process table later.
+        '''
+        pid = None
+        proc_pidfile_path = self.get_proc_pid_file(machine)
+        if ProcessUtil.process_runs(proc_pidfile_path):
+            pid = ProcessUtil.read_pid(proc_pidfile_path)
+        launch_record = {
+            'name': machine.name,
+            'pid': pid,
+            'argv': ProcessUtil.split_command(shell_command),
+            'vnc_display': machine.localhost_vnc_port,
+            'vnc_port': VNC_BASE_PORT + machine.localhost_vnc_port,
+            'launched_at': time.time(),
+        }
+        with open(self.get_launch_record_file(machine), 'w+') as record_file:
+            json.dump(launch_record, record_file)
+        return launch_record
+
+    def read_launch_record(self, machine):
+        try:
+            with open(self.get_launch_record_file(machine)) as record_file:
+                return json.load(record_file)
+        except (IOError, ValueError):
+            return None
+
+    def get_vnc_port(self, machine):
+        '''
+        Get VNC port of the running machine from its launch record or from
+        the command line of its process.
+        '''
+        launch_record = self.read_launch_record(machine)
+        if launch_record is not None:
+            return launch_record['vnc_port']
+        proc_pidfile_path = self.get_proc_pid_file(machine)
+        if not ProcessUtil.process_runs(proc_pidfile_path):
+            raise KeyError('No VM process runs for: %s' % machine.name)
+        argv = ProcessUtil.read_cmdline(
+            ProcessUtil.read_pid(proc_pidfile_path))
+        if '-vnc' not in argv[:-1]:
+            raise KeyError('No VNC display found for: %s' % machine.name)
+        display = argv[argv.index('-vnc') + 1].rsplit(':', 1)[1]
+        return VNC_BASE_PORT + int(display)
 
     def run_machine(self, machine):
         # Check if machine is in accepting state.
         assert machine.current_state == VM_IS_LAUNCHED
+        try:
+            memory_backing = self.reserve_memory_backing(machine)
+        except VmSpawnError as error:
+            logger.warning('Machine "%s" has failed to start: %s' %
+                           (machine.name, error))
+            self.cleanup_machine(machine)
+            machine.mark_failed(str(error))
+            return
+        try:
+            self.spawn_machine(machine, memory_backing)
+        finally:
+            self.release_memory_backing(machine)
+
+    def spawn_machine(self, machine, memory_backing):
         # Bake a shell command to spawn the machine.
-        shell_command = self.get_kvm_call(machine)
+        shell_command = self.get_kvm_call(machine, memory_backing)
         logger.debug('Running VM with shell command:\n%s' % shell_command)
         report_filepath = self.get_report_file(machine)
         pid_filepath = self.get_pid_file(machine)
-        if ProcessUtil.process_runs(pid_filepath):
-            logging.warning('Apparently, VM process is already running. '
-                            'Check %s ' % pid_filepath)
-            machine.change_state(VM_HAS_FAILED)
-            # TODO: kill the VM?
+        proc_pidfile_path = self.get_proc_pid_file(machine)
+        for running_pidfile in (pid_filepath, proc_pidfile_path):
+            if ProcessUtil.process_runs(running_pidfile):
+                logging.warning('Apparently, VM process is already running. '
+                                'Check %s ' % running_pidfile)
+                machine.mark_failed('VM process is already running, see %s' %
+                                    running_pidfile)
+                # TODO: kill the VM?
+                return
+        child = None
+        try:
+            if self.supervisor is not None:
+                child = self.supervisor.spawn(
+                    machine.pk, shell_command, report_filepath,
+                    proc_pidfile_path, self.report_max_size,
+                    self.report_backups)
+                pid = child.pid
+            else:
+                pid = ProcessUtil.exec_process(
+                    shell_command, report_filepath, pid_filepath,
+                    self.report_max_size, self.report_backups)
+            self.wait_until_ready(machine, pid, child)
+        except (VmSpawnError, ExecProcessError, OSError) as error:
+            logger.warning('Machine "%s" has failed to start: %s' %
+                           (machine.name, error))
+            self.cleanup_machine(machine)
+            machine.mark_failed(str(error))
             return
-        ProcessUtil.exec_process(shell_command, report_filepath, pid_filepath)
         # Update state.
-        machine.change_state(VM_IS_RUNNING)
+        machine.last_error = ''
+        machine.change_state(VM_IS_RUNNING,
+                             also_save=['last_error', 'localhost_vnc_port'])
+        self.watch_machine(machine)
+        self.connect_qmp(machine)
+        if machine.pinned_cpus:
+            self.apply_pinning(machine, pid)
+        else:
+            shared_cpus = self.get_shared_cpus()
+            if shared_cpus is not None:
+                self.confine_machine(machine.name, pid, shared_cpus)
+        self.write_launch_record(machine, shell_command)
         # Put info into vnc target file.
         vnc_target_path = self.get_vnc_target_path(machine)
         with open(vnc_target_path, 'w+') as vnc_target:
             try:
-                cmd = get_cmd_from_ps(needle=machine.disk_filename)
+                local_vnc_port = self.get_vnc_port(machine)
             except KeyError as error:
                 logger.error('Failed to find VNC port of the vm: %s' % machine)
                 logger.exception(error)
                 return
-            match = re.search(r'-vnc localhost:(\d+)', cmd, re.MULTILINE)
-            local_vnc_port = 5900 + int(match.group(1))
             # e.g 'test: localhost:5901'
             vnc_info = '%s: localhost:%s' % (machine.name, local_vnc_port)
             logger.info('Writing into VNC target file: %s' % vnc_info)
             vnc_target.write(vnc_info + "\n")
 
+    def get_vcpu_threads(self, machine, pid):
+        '''Thread ids of vCPUs as told by QEMU, or found by thread names.'''
+        if self.qmp_pool is not None and self.qmp_pool.has(machine.pk):
+            for command, index_key, thread_key in (
+                    ('query-cpus-fast', 'cpu-index', 'thread-id'),
+                    ('query-cpus', 'CPU', 'thread_id')):
+                try:
+                    return dict((cpu[index_key], cpu[thread_key]) for cpu
+                                in self.qmp_pool.execute(machine.pk, command))
+                except (QmpError, KeyError):
+                    continue
+        return find_vcpu_threads(pid)
+
+    def apply_pinning(self, machine, pid):
+        cpus = parse_cpu_list(machine.pinned_cpus)
+        try:
+            vcpu_threads = self.get_vcpu_threads(machine, pid)
+            apply_affinity(pid, cpus, vcpu_threads)
+        except (EnvironmentError, psutil.Error) as error:
+            logger.warning('Failed to pin "%s" to CPUs %s: %s' %
+                           (machine.name, machine.pinned_cpus, error))
+            return
+        logger.info('Pinned %d vCPUs of "%s" to CPUs %s' %
+                    (len(vcpu_threads), machine.name, machine.pinned_cpus))
+        self.confine_unpinned_machines()
+
+    def wait_until_ready(self, machine, pid, child=None):
+        '''
+        VM is ready as soon as its QMP socket greets us. If the VM exits
+        before, VmSpawnError with the last lines of its output is raised.
+        Child of the supervisor tells about its exit right away.
+        '''
+        qmp_socket_path = self.get_qmp_socket_path(machine)
+        deadline = time.time() + self.ready_timeout
+        while True:
+            if os.path.exists(qmp_socket_path):
+                connection = QmpConnection(qmp_socket_path)
+                try:
+                    connection.connect()
+                    connection.close()
+                    return
+                except QmpError:
+                    pass
+            if child is not None:
+                has_exited = child.exited.wait(READY_POLL_INTERVAL)
+            else:
+                time.sleep(READY_POLL_INTERVAL)
+                has_exited = not ProcessUtil.pid_exists(pid)
+            if has_exited:
+                raise VmSpawnError(self.get_spawn_error(machine, child))
+            if time.time() > deadline:
+                logger.warning('QMP of "%s" is not available after %d sec. '
+                               'Assuming it runs.' %
+                               (machine.name, self.ready_timeout))
+                return
+
+    def get_spawn_error(self, machine, child=None):
+        if child is not None:
+            status = 'exit status %s' % child.returncode
+            lines = list(child.tail)
+        else:
+            # Let the spawning helper finish the report.
+            cxt_pidfile_filepath = self.get_pid_file(machine)
+            deadline = time.time() + 1
+            while ProcessUtil.process_runs(cxt_pidfile_filepath) \
+                    and time.time() < deadline:
+                time.sleep(READY_POLL_INTERVAL)
+            status = 'exited'
+            lines = ProcessUtil.read_report_tail(
+                self.get_report_file(machine), ERROR_TAIL_LINES)
+        return 'VM process %s before it got ready:\n%s' % (
+            status, '\n'.join(lines[-ERROR_TAIL_LINES:]))
+
     def stop_machine(self, machine):
         # Check if machine is in accepting state.
         assert machine.current_state == VM_IS_TERMINATING
         # Kill the machine by pid.
         cxt_pidfile_filepath = self.get_pid_file(machine)
-        proc_pidfile_path = '%s_proc' % cxt_pidfile_filepath
-        # First kill proc which is a child and then daemoncxt.
+        proc_pidfile_path = self.get_proc_pid_file(machine)
+        # First kill proc which is a child and then daemoncxt (if any, VMs
+        # of the supervisor have none).
         if ProcessUtil.kill_process(proc_pidfile_path) \
-                and ProcessUtil.kill_process(cxt_pidfile_filepath):
+                and (not os.path.exists(cxt_pidfile_filepath)
+                     or ProcessUtil.kill_process(cxt_pidfile_filepath)):
             logging.info('Successfully stopping VM processes as in %s and %s' %
                          (proc_pidfile_path, cxt_pidfile_filepath))
         else:
             logging.warning('Expected VM process does not run anymore. '
                             'Please check the log file for details: %s' %
                             self.get_report_file(machine))
+        self.cleanup_machine(machine)
+        # Update state.
+        machine.change_state(VM_IS_STOPPED)
+
+    def cleanup_machine(self, machine):
+        '''Remove leftovers of the VM process that is gone.'''
+        cxt_pidfile_filepath = self.get_pid_file(machine)
+        proc_pidfile_path = self.get_proc_pid_file(machine)
+        if ProcessUtil.process_runs(cxt_pidfile_filepath):
+            # Spawning helper can outlive the VM for a while.
+            ProcessUtil.kill_process(cxt_pidfile_filepath)
         # Proc pid should be taken care of.
         if os.path.exists(proc_pidfile_path):
             os.unlink(proc_pidfile_path)
-        # Update state.
-        machine.change_state(VM_IS_STOPPED)
+        launch_record_path = self.get_launch_record_file(machine)
+        if os.path.exists(launch_record_path):
+            os.unlink(launch_record_path)
+        if self.qmp_pool is not None:
+            self.qmp_pool.remove(machine.pk)
+        qmp_socket_path = self.get_qmp_socket_path(machine)
+        if os.path.exists(qmp_socket_path):
+            os.unlink(qmp_socket_path)
+        # Give the mapped ports back.
+        self.release_ports(machine)
+        machine.unmap_ports()
+        self.unpin_machine(machine)
         # Remove vnc target file
         vnc_target_path = self.get_vnc_target_path(machine)
         if os.path.exists(vnc_target_path):
             logger.info('Removing VNC target file: %s' % vnc_target_path)
             os.remove(vnc_target_path)
 
+    def get_proc_pid_file(self, machine):
+        '''Pidfile of the VM process itself, see ProcessUtil.exec_process.'''
+        return '%s_proc' % self.get_pid_file(machine)
+
+    def start_watching(self):
+        '''Adopt running machines and get notified once they exit.'''
+        self.start_qmp_pool()
+        if self.spawn_mode == 'supervisor':
+            self.supervisor = Supervisor(on_exit=self.handle_exit)
+            self.supervisor.start()
+        if not ProcessWatcher.is_supported():
+            logger.warning('pidfd_open() is not supported by the kernel. '
+                           'Exits of VMs are found by the heartbeat check.')
+            return
+        self.process_watcher = ProcessWatcher(on_exit=self.handle_exit)
+        self.process_watcher.start()
+        for machine in VmInstance.objects.filter(current_state=VM_IS_RUNNING):
+            process = self.find_vm_process(machine)
+            if process is None:
+                # Heartbeat check takes care of it.
+                continue
+            logger.info('Adopting VM process %d of "%s"' %
+                        (process.pid, machine.name))
+            self.process_watcher.watch(machine.pk, process.pid)
+
+    def start_qmp_pool(self):
+        self.qmp_pool = QmpPool()
+        self.qmp_pool.subscribe('SHUTDOWN', self.handle_guest_shutdown)
+        self.qmp_pool.subscribe('STOP', self.log_guest_event)
+        self.qmp_pool.subscribe('RESET', self.log_guest_event)
+        self.qmp_pool.start()
+        for machine in VmInstance.objects.filter(current_state=VM_IS_RUNNING):
+            self.connect_qmp(machine)
+
+    def connect_qmp(self, machine):
+        if self.qmp_pool is None:
+            return
+        qmp_socket_path = self.get_qmp_socket_path(machine)
+        if not os.path.exists(qmp_socket_path):
+            # Machines launched before QMP was introduced.
+            logger.info('No QMP socket for "%s"' % machine.name)
+            return
+        self.qmp_pool.add(machine.pk, qmp_socket_path)
+
+    def query_guest_status(self, machine):
+        '''Run state of the guest as reported by QEMU, e.g. "running".'''
+        if self.qmp_pool is None or not self.qmp_pool.has(machine.pk):
+            return None
+        try:
+            return self.qmp_pool.query_status(machine.pk)['status']
+        except QmpError as error:
+            logger.info('Failed to query status of "%s": %s' %
+                        (machine.name, error))
+            return None
+
+    def handle_guest_shutdown(self, machine_pk, event):
+        '''
+        Called by the QMP pool. With -no-shutdown QEMU stays alive once the
+        guest powers off, so the machine is stopped for real here.
+        '''
+        if not event.get('data', {}).get('guest', True):
+            # Caused by our own signal.
+            return
+        if VmInstance.objects.filter(pk=machine_pk,
+                                     current_state=VM_IS_RUNNING).update(
+                current_state=VM_IS_TERMINATING):
+            InstanceTableVersion.bump()
+            logger.info('Guest #%d has shut down.' % machine_pk)
+            wake_daemon()
+
+    def log_guest_event(self, machine_pk, event):
+        logger.info('Guest #%d reported %s' % (machine_pk, event['event']))
+
+    def watch_machine(self, machine, timeout=1.0):
+        if self.process_watcher is None:
+            return
+        if self.supervisor is not None \
+                and self.supervisor.is_supervised(machine.pk):
+            # Supervisor reports the exit of its own children.
+            return
+        # Spawned helper writes the pidfile of the VM shortly after it
+        # reports back to us.
+        pid_filepath = self.get_proc_pid_file(machine)
+        deadline = time.time() + timeout
+        while not ProcessUtil.process_runs(pid_filepath):
+            if time.time() > deadline:
+                logger.warning('No running VM process found for "%s" in %s' %
+                               (machine.name, pid_filepath))
+                return
+            time.sleep(0.05)
+        if not self.process_watcher.watch(machine.pk,
+                                          ProcessUtil.read_pid(pid_filepath)):
+            logger.warning('VM process of "%s" is already gone.' %
+                           machine.name)
+
+    def handle_exit(self, machine_pk, pid, exit_status, exited_at):
+        '''Called by the process watcher once a VM process is gone.'''
+        if not self.worker_pool.submit('stop', machine_pk,
+                                       self.finish_exited_machine, machine_pk,
+                                       exit_status, exited_at):
+            # Machine is still being started (or stopped). Try again shortly.
+            timer = threading.Timer(0.1, self.handle_exit,
+                                    (machine_pk, pid, exit_status, exited_at))
+            timer.daemon = True
+            timer.start()
+
+    def finish_exited_machine(self, machine_pk, exit_status, exited_at):
+        try:
+            machine = VmInstance.objects.get(pk=machine_pk,
+                                             current_state=VM_IS_RUNNING)
+        except VmInstance.DoesNotExist:
+            # Machine was stopped on purpose.
+            return
+        logger.warning('VM "%s" has exited with status %s at %s' %
+                       (machine.name, exit_status,
+                        datetime.fromtimestamp(exited_at)))
+        self.cleanup_machine(machine)
+        if exit_status in (None, 0):
+            machine.change_state(VM_IS_STOPPED)
+        else:
+            machine.mark_failed('VM process has exited with status %s, see %s'
+                                % (exit_status, self.get_report_file(machine)))
+
     def clone_from_image(self, machine):
         # Check if machine is in accepting state.
         assert machine.current_state == VM_IN_CLONING
         logger.info('Cloning new machine \'%s\' from image \'%s\'' %
                     (machine.name, machine.image.name))
+        self.produce_disk(machine.image, self.get_disk_path(machine))
+        # Update state to VM_IS_STOPPED - we are ready to run.
+        machine.change_state(VM_IS_STOPPED)
+
+    def produce_disk(self, image, dst_file):
+        src_file = self.get_image_path(image)
+        if image.clone_mode == CLONE_OVERLAY:
+            try:
+                self.create_overlay(image, dst_file)
+                return
+            except DiskImageError as error:
+                logger.warning('Falling back to a full copy. %s' % error)
+        self.copy_image(src_file, dst_file)
+
+    def copy_image(self, src_file, dst_file):
         # Copy machine. Can take time.
-        src_file = self.get_image_path(machine.image)
-        dst_file = self.get_disk_path(machine)
         logger.info('Copying %s -> %s' %
                     (src_file, dst_file))
-        shutil.copyfile(src_file, dst_file)
-        # Update state to VM_IS_STOPPED - we are ready to run.
-        machine.change_state(VM_IS_STOPPED)
+        method = copy_file(src_file, dst_file)
+        logger.info('Copied %s using %s' % (dst_file, method))
 
-    def remove_machine(self, machine):
-        # Check if machine is in accepting state.
-        assert machine.current_state == VM_IS_TRASHED
-        logger.info('Removing trashed machine \'%s\' and its files: \'%s\'' %
-                    (machine.name, machine.disk_filename))
-        disk_file = self.get_disk_path(machine)
+    def create_overlay(self, image, dst_file):
+        src_file = self.get_image_path(image)
+        logger.info('Creating overlay %s backed by %s' % (dst_file, src_file))
+        protect_image(src_file)
+        create_overlay(self.qemu_img, src_file, self.get_image_format(image),
+                       dst_file)
+
+    def release_image(self, image, backing_file):
+        '''Unprotect the image once the last overlay backed by it is gone.'''
+        disk_files = [self.get_disk_path(machine)
+                      for machine in image.instances.all()]
+        disk_files += self.list_spares(image)
+        for disk_file in disk_files:
+            try:
+                if get_backing_file(disk_file) == backing_file:
+                    return
+            except (OSError, IOError):
+                continue
+        unprotect_image(backing_file)
+
+    def remove_disk(self, image, disk_file):
+        backing_file = None
         try:
+            # Only the overlay is removed, never the image backing it.
+            backing_file = get_backing_file(disk_file)
             os.unlink(disk_file)
         except (OSError, IOError):
             logger.info('Failed to remove the VM\'s disk: %s' % disk_file,
                         exc_info=True)
-        # Clean logs.
+        if backing_file is not None and os.path.exists(backing_file):
+            self.release_image(image, backing_file)
+
+    def remove_machine(self, machine):
+        # Check if machine is in accepting state.
+        assert machine.current_state == VM_IS_TRASHED
+        logger.info('Removing trashed machine \'%s\' and its files: \'%s\'' %
+                    (machine.name, machine.disk_filename))
+        self.remove_disk(machine.image, self.get_disk_path(machine))
+        # Clean logs, rotated ones included.
         report_filepath = self.get_report_file(machine)
-        if os.path.exists(report_filepath):
-            os.unlink(report_filepath)
-        # Finally kill the DB record.
+        report_filepaths = [report_filepath] + [
+            '%s.%d' % (report_filepath, index)
+            for index in xrange(1, self.report_backups + 1)]
+        for report_filepath in report_filepaths:
+            if os.path.exists(report_filepath):
+                os.unlink(report_filepath)
+        # Finally kill the DB record (with its port reservations).
+        self.release_ports(machine)
         machine.delete()
 
     def kill_all_machines(self):
-        needle = self.vm_disk_path
-        machines = list()
-        for proc in psutil.process_iter():
+        self.process_table.invalidate()
+        for process in self.process_table.find_matching(self.vm_disk_path):
+            if process.pid == os.getpid():
+                continue
             try:
-                pinfo = proc.as_dict(attrs=['pid', 'cmdline'])
-            except psutil.NoSuchProcess:
-                pass
-            else:
-                if needle in ' '.join(pinfo['cmdline']):
-                    machines.append(pinfo)
-        for machine in machines:
-            os.kill(machine['pid'], signal.SIGTERM)
+                os.kill(process.pid, signal.SIGTERM)
+            except OSError:
+                logger.info('Failed to kill %d' % process.pid, exc_info=True)
+
+    def find_vm_process(self, machine):
+        '''Look up the VM process in the current process table snapshot.'''
+        process = self.process_table.find_by_name(machine.name)
+        if process is None:
+            # Machines launched without -name.
+            process = self.process_table.find_by_disk(
+                self.get_disk_path(machine))
+        return process
+
+    def get_running_processes(self):
+        processes = dict()
+        for machine in VmInstance.objects.filter(current_state=VM_IS_RUNNING):
+            process = self.find_vm_process(machine)
+            if process is not None:
+                processes[machine.name] = process.pid
+        return processes
 
     def check_heartbeat(self):
         '''
@@ -418,8 +1316,16 @@ class Kvm(VmManager):
             logger.info('No machines are running to check the heartbeat..')
             return
         for machine in instances:
-            pid_filepath = self.get_pid_file(machine)
-            if ProcessUtil.process_runs(pid_filepath):
+            if self.worker_pool.is_busy(machine.pk):
+                continue
+            if self.process_watcher is not None \
+                    and self.process_watcher.is_watched(machine.pk):
+                # Exit would have been reported right away.
+                continue
+            if self.supervisor is not None \
+                    and self.supervisor.is_supervised(machine.pk):
+                continue
+            if self.find_vm_process(machine) is not None:
                 logger.info('Heart beat of "%s" is OK - still running' %
                             machine.name)
                 continue
@@ -428,4 +1334,4 @@ class Kvm(VmManager):
             logging.info('Stopping the machine "%s" and removing pid files ' %
                          machine.name)
             machine.change_state(VM_IS_TERMINATING)
-            self.stop_machine(machine)
+            self.dispatch('stop', machine, self.stop_machine)
@@ -1,12 +1,21 @@
 from django.contrib import admin
 from picostack.vms.models import Flavour, VmImage, VmInstance
+from picostack.wakeup import wake_daemon
 
 
-class VmInstanceAdmin(admin.ModelAdmin):
-    pass
+class WakingAdmin(admin.ModelAdmin):
+    '''Daemon acts on the changes right away, e.g. refills spare pools.'''
 
+    def save_model(self, request, obj, form, change):
+        super(WakingAdmin, self).save_model(request, obj, form, change)
+        wake_daemon()
 
-admin.site.register(Flavour)
-admin.site.register(VmImage)
-admin.site.register(VmInstance, VmInstanceAdmin)
+    def delete_model(self, request, obj):
+        super(WakingAdmin, self).delete_model(request, obj)
+        wake_daemon()
+
+
+admin.site.register(Flavour, WakingAdmin)
+admin.site.register(VmImage, WakingAdmin)
+admin.site.register(VmInstance, WakingAdmin)
 
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Flavour',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=60)),
+                ('memory_size', models.PositiveIntegerField(default=1024)),
+                ('num_of_cores', models.PositiveSmallIntegerField(default=1)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VmImage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=60)),
+                ('image_filename', models.CharField(max_length=120)),
+                ('disk_size', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VmInstance',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=60)),
+                ('current_state', models.CharField(default=b'C', max_length=1, choices=[(b'C', b'InCloning'), (b'S', b'Stopped'), (b'R', b'Running'), (b'L', b'Launched'), (b'F', b'Failed'), (b'T', b'Terminating'), (b'W', b'Trashed')])),
+                ('has_ssh', models.BooleanField(default=False)),
+                ('ssh_mapping', models.PositiveSmallIntegerField(null=True, blank=True)),
+                ('has_vnc', models.BooleanField(default=False)),
+                ('vnc_mapping', models.PositiveSmallIntegerField(null=True, blank=True)),
+                ('has_rdp', models.BooleanField(default=False)),
+                ('rdp_mapping', models.PositiveSmallIntegerField(null=True, blank=True)),
+                ('localhost_vnc_port', models.PositiveSmallIntegerField(null=True, blank=True)),
+                ('disk_filename', models.CharField(max_length=120, null=True, blank=True)),
+                ('flavour', models.ForeignKey(related_name='instances', to='vms.Flavour')),
+                ('image', models.ForeignKey(related_name='instances', to='vms.VmImage')),
+            ],
+        ),
+    ]
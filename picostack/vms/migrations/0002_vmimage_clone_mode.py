@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vmimage',
+            name='image_format',
+            field=models.CharField(default=b'qcow2', max_length=10, choices=[(b'qcow2', b'qcow2'), (b'raw', b'raw')]),
+        ),
+        migrations.AddField(
+            model_name='vmimage',
+            name='clone_mode',
+            field=models.CharField(default=b'copy', max_length=10, choices=[(b'copy', b'Full copy'), (b'overlay', b'Copy-on-write overlay')]),
+        ),
+    ]
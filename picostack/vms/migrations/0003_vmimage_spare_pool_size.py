@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0002_vmimage_clone_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vmimage',
+            name='spare_pool_size',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
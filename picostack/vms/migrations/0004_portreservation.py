@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0003_vmimage_spare_pool_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortReservation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('port', models.PositiveIntegerField(unique=True)),
+                ('service', models.CharField(max_length=10)),
+                ('instance', models.ForeignKey(related_name='port_reservations', to='vms.VmInstance')),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0004_portreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vminstance',
+            name='last_error',
+            field=models.TextField(default=b'', blank=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0006_instancetableversion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vminstance',
+            name='current_state',
+            field=models.CharField(default=b'C', max_length=1, db_index=True, choices=[(b'C', b'InCloning'), (b'S', b'Stopped'), (b'R', b'Running'), (b'L', b'Launched'), (b'F', b'Failed'), (b'T', b'Terminating'), (b'W', b'Trashed')]),
+        ),
+        migrations.AlterField(
+            model_name='vminstance',
+            name='rdp_mapping',
+            field=models.PositiveSmallIntegerField(db_index=True, null=True, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='vminstance',
+            name='ssh_mapping',
+            field=models.PositiveSmallIntegerField(db_index=True, null=True, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='vminstance',
+            name='vnc_mapping',
+            field=models.PositiveSmallIntegerField(db_index=True, null=True, blank=True),
+        ),
+    ]
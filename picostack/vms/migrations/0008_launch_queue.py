@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0007_state_and_mapping_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vminstance',
+            name='priority',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='vminstance',
+            name='launch_queued_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='vminstance',
+            name='current_state',
+            field=models.CharField(default=b'C', max_length=1, db_index=True, choices=[(b'C', b'InCloning'), (b'S', b'Stopped'), (b'R', b'Running'), (b'L', b'Launched'), (b'Q', b'Queued'), (b'F', b'Failed'), (b'T', b'Terminating'), (b'W', b'Trashed')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0008_launch_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flavour',
+            name='pin_cpus',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='vminstance',
+            name='pinned_cpus',
+            field=models.CharField(default=b'', max_length=200, blank=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0009_cpu_pinning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flavour',
+            name='memory_backing',
+            field=models.CharField(default=b'default', max_length=20, choices=[(b'default', b'Anonymous memory'), (b'hugepages', b'Hugepages'), (b'hugepages_preferred', b'Hugepages if available')]),
+        ),
+        migrations.AddField(
+            model_name='flavour',
+            name='hugepages_prealloc',
+            field=models.BooleanField(default=False),
+        ),
+    ]
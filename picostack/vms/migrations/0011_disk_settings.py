@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0010_memory_backing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vmimage',
+            name='disk_bus',
+            field=models.CharField(default=b'ide', max_length=20, choices=[(b'ide', b'Emulated IDE'), (b'virtio-blk', b'virtio-blk'), (b'virtio-scsi', b'virtio-scsi')]),
+        ),
+        migrations.AddField(
+            model_name='vmimage',
+            name='disk_cache',
+            field=models.CharField(default=b'writeback', max_length=20, choices=[(b'writeback', b'writeback'), (b'none', b'none (O_DIRECT)'), (b'writethrough', b'writethrough'), (b'directsync', b'directsync'), (b'unsafe', b'unsafe')]),
+        ),
+        migrations.AddField(
+            model_name='vmimage',
+            name='disk_aio',
+            field=models.CharField(default=b'threads', max_length=20, choices=[(b'threads', b'threads'), (b'native', b'native (Linux AIO)'), (b'io_uring', b'io_uring')]),
+        ),
+        migrations.AddField(
+            model_name='vmimage',
+            name='disk_discard',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='vmimage',
+            name='disk_iothread',
+            field=models.BooleanField(default=False),
+        ),
+    ]
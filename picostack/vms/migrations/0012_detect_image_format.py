@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def detect_image_formats(apps, schema_editor):
+    # Images got qcow2 by default, whatever their files are. The daemon
+    # reads the format of the file instead.
+    VmImage = apps.get_model('vms', 'VmImage')
+    VmImage.objects.filter(image_format='qcow2').update(image_format='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0011_disk_settings'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vmimage',
+            name='image_format',
+            field=models.CharField(default=b'', max_length=10, blank=True, choices=[(b'qcow2', b'qcow2'), (b'raw', b'raw')]),
+        ),
+        migrations.RunPython(detect_image_formats,
+                             migrations.RunPython.noop),
+    ]
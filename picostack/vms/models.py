@@ -1,12 +1,21 @@
 import os
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from picostack.errors import DataModelError
+from picostack.sqlite_tuning import tune_sqlite_connection
 
 
 VM_IN_CLONING = 'C'
 # After cloning instance state is set to 'stopped'
 VM_IS_STOPPED = 'S'
 VM_IS_LAUNCHED = 'L'
+# Launched, but waiting for the host to have enough capacity.
+VM_IS_QUEUED = 'Q'
 VM_IS_RUNNING = 'R'
 VM_HAS_FAILED = 'F'
 VM_IS_TERMINATING = 'T'
@@ -18,11 +27,20 @@ VM_STATES = (
     (VM_IS_STOPPED, 'Stopped'),
     (VM_IS_RUNNING, 'Running'),
     (VM_IS_LAUNCHED, 'Launched'),
+    (VM_IS_QUEUED, 'Queued'),
     (VM_HAS_FAILED, 'Failed'),
     (VM_IS_TERMINATING, 'Terminating'),
     (VM_IS_TRASHED, 'Trashed'),
 )
 
+# Actions users request: states they apply to and the state they lead to.
+VM_ACTIONS = {
+    'start': ((VM_IS_STOPPED, VM_HAS_FAILED), VM_IS_LAUNCHED),
+    'stop': ((VM_IS_RUNNING, VM_HAS_FAILED, VM_IS_QUEUED),
+             VM_IS_TERMINATING),
+    'trash': ((VM_IS_STOPPED, VM_HAS_FAILED), VM_IS_TRASHED),
+}
+
 VM_PORTS = {
     'ssh': 22,
     'vnc': 5900,
@@ -31,6 +49,52 @@ VM_PORTS = {
 
 DEFAULT_FLAVOUR = 'tiny'
 
+# How new instance disks are produced from the image.
+CLONE_FULL_COPY = 'copy'
+CLONE_OVERLAY = 'overlay'
+CLONE_MODES = (
+    (CLONE_FULL_COPY, 'Full copy'),
+    (CLONE_OVERLAY, 'Copy-on-write overlay'),
+)
+
+# Where guest memory comes from. Strict hugepages refuse to start the VM if
+# the pool of the host is short, preferred ones fall back to normal memory.
+MEMORY_DEFAULT = 'default'
+MEMORY_HUGEPAGES = 'hugepages'
+MEMORY_HUGEPAGES_PREFERRED = 'hugepages_preferred'
+MEMORY_BACKINGS = (
+    (MEMORY_DEFAULT, 'Anonymous memory'),
+    (MEMORY_HUGEPAGES, 'Hugepages'),
+    (MEMORY_HUGEPAGES_PREFERRED, 'Hugepages if available'),
+)
+
+IMAGE_FORMATS = (
+    ('qcow2', 'qcow2'),
+    ('raw', 'raw'),
+)
+
+# How the disk is attached to the guest, see CallBuilder.get_disk_params().
+DISK_BUS_IDE = 'ide'
+DISK_BUS_VIRTIO_BLK = 'virtio-blk'
+DISK_BUS_VIRTIO_SCSI = 'virtio-scsi'
+DISK_BUSES = (
+    (DISK_BUS_IDE, 'Emulated IDE'),
+    (DISK_BUS_VIRTIO_BLK, 'virtio-blk'),
+    (DISK_BUS_VIRTIO_SCSI, 'virtio-scsi'),
+)
+DISK_CACHE_MODES = (
+    ('writeback', 'writeback'),
+    ('none', 'none (O_DIRECT)'),
+    ('writethrough', 'writethrough'),
+    ('directsync', 'directsync'),
+    ('unsafe', 'unsafe'),
+)
+DISK_AIO_BACKENDS = (
+    ('threads', 'threads'),
+    ('native', 'native (Linux AIO)'),
+    ('io_uring', 'io_uring'),
+)
+
 
 class VmImage(models.Model):
 
@@ -41,9 +105,45 @@ class VmImage(models.Model):
     # Used to check if we have enough free space when cloning (in MB).
     disk_size = models.PositiveIntegerField()
 
+    # Empty means the format is read from the header of the image file.
+    image_format = models.CharField(max_length=10, choices=IMAGE_FORMATS,
+                                    default='', blank=True)
+
+    # Overlays are thin qcow2 files backed by the (read-only) image.
+    clone_mode = models.CharField(max_length=10, choices=CLONE_MODES,
+                                  default=CLONE_FULL_COPY)
+
+    # Number of disks the daemon keeps cloned in advance, so new instances
+    # do not have to wait for cloning.
+    spare_pool_size = models.PositiveSmallIntegerField(default=0)
+
+    disk_bus = models.CharField(max_length=20, choices=DISK_BUSES,
+                                default=DISK_BUS_IDE)
+
+    disk_cache = models.CharField(max_length=20, choices=DISK_CACHE_MODES,
+                                  default='writeback')
+
+    disk_aio = models.CharField(max_length=20, choices=DISK_AIO_BACKENDS,
+                                default='threads')
+
+    # Pass TRIM of the guest to the disk file and turn zero writes into
+    # holes, so disks stay thin.
+    disk_discard = models.BooleanField(default=False)
+
+    # Do virtio disk I/O in its own thread instead of the main loop of QEMU.
+    disk_iothread = models.BooleanField(default=False)
+
     def __repr__(self):
         return 'VM Image: <%s>' % self.name
 
+    def clean(self):
+        if self.disk_aio == 'native' and \
+                self.disk_cache not in ('none', 'directsync'):
+            raise ValidationError('Native AIO needs the "none" or '
+                                  '"directsync" cache mode.')
+        if self.disk_iothread and self.disk_bus == DISK_BUS_IDE:
+            raise ValidationError('Only virtio disks have an iothread.')
+
     def __str__(self):
         return self.name
 
@@ -58,6 +158,15 @@ class Flavour(models.Model):
     # Number of cores
     num_of_cores = models.PositiveSmallIntegerField(default=1)
 
+    # Give VMs dedicated host CPUs (on one NUMA node if possible).
+    pin_cpus = models.BooleanField(default=False)
+
+    memory_backing = models.CharField(max_length=20, choices=MEMORY_BACKINGS,
+                                      default=MEMORY_DEFAULT)
+
+    # Fault in all hugepages when the VM starts instead of on first touch.
+    hugepages_prealloc = models.BooleanField(default=False)
+
     def __repr__(self):
         return 'VM Flavour: <%s>' % self.name
 
@@ -74,7 +183,7 @@ class VmInstance(models.Model):
     flavour = models.ForeignKey(Flavour, related_name='instances')
 
     current_state = models.CharField(
-        max_length=1, choices=VM_STATES, default=VM_IN_CLONING)
+        max_length=1, choices=VM_STATES, default=VM_IN_CLONING, db_index=True)
 
     @property
     def memory_size(self):
@@ -88,19 +197,22 @@ class VmInstance(models.Model):
     has_ssh = models.BooleanField(default=False)
 
     # Set by vm_manager
-    ssh_mapping = models.PositiveSmallIntegerField(null=True, blank=True)
+    ssh_mapping = models.PositiveSmallIntegerField(null=True, blank=True,
+                                                  db_index=True)
 
     # has VNC ?
     has_vnc = models.BooleanField(default=False)
 
     # Set by vm_manager
-    vnc_mapping = models.PositiveSmallIntegerField(null=True, blank=True)
+    vnc_mapping = models.PositiveSmallIntegerField(null=True, blank=True,
+                                                  db_index=True)
 
     # has RDP ? Set True for Windows.
     has_rdp = models.BooleanField(default=False)
 
     # Set by vm_manager
-    rdp_mapping = models.PositiveSmallIntegerField(null=True, blank=True)
+    rdp_mapping = models.PositiveSmallIntegerField(null=True, blank=True,
+                                                  db_index=True)
 
     # Vnc port in '-vnc localhost:'
     localhost_vnc_port = models.PositiveSmallIntegerField(null=True,
@@ -109,9 +221,86 @@ class VmInstance(models.Model):
     # If left blank, then the value from get_default_disk_filename() is used.
     disk_filename = models.CharField(max_length=120, null=True, blank=True)
 
-    def change_state(self, state):
+    # Why the machine has failed the last time, e.g. output of the VM process.
+    last_error = models.TextField(blank=True, default='')
+
+    # Queued launches with higher priority start first, then the older ones.
+    priority = models.SmallIntegerField(default=0)
+
+    # Set once the launch has been queued.
+    launch_queued_at = models.DateTimeField(null=True, blank=True)
+
+    # Host CPUs the vCPUs are pinned to, e.g. "4-7". Set by vm_manager.
+    pinned_cpus = models.CharField(max_length=200, blank=True, default='')
+
+    def change_state(self, state, also_save=()):
+        '''Write just the state (and also_save fields) to keep it short.'''
         self.current_state = state
-        self.save(force_update=True)
+        self.save(update_fields=['current_state'] + list(also_save))
+
+    def mark_failed(self, error):
+        self.last_error = error
+        self.change_state(VM_HAS_FAILED, also_save=['last_error'])
+
+    def switch_state(self, expected_states, state, **fields):
+        '''
+        Like change_state(), but only if the state is still one of the
+        expected ones (e.g. users may have stopped the machine meanwhile).
+        '''
+        fields['current_state'] = state
+        if not VmInstance.objects.filter(
+                pk=self.pk, current_state__in=expected_states).update(
+                **fields):
+            return False
+        InstanceTableVersion.bump()
+        for name, value in fields.items():
+            setattr(self, name, value)
+        return True
+
+    @staticmethod
+    def request_action(pk, action):
+        '''
+        Apply one of VM_ACTIONS by a single conditional UPDATE, concurrent
+        requests can neither lose nor repeat a transition. Return whether
+        the state has changed and the current state.
+        '''
+        allowed_states, new_state = VM_ACTIONS[action]
+        if VmInstance.objects.filter(
+                pk=pk, current_state__in=allowed_states).update(
+                current_state=new_state):
+            InstanceTableVersion.bump()
+            return True, new_state
+        return False, VmInstance.objects.values_list(
+            'current_state', flat=True).get(pk=pk)
+
+    @staticmethod
+    def request_bulk_action(instances, action):
+        '''
+        Apply one of VM_ACTIONS to all the instances of a queryset, in a single
+        transaction by a single UPDATE. Return {name: (changed, state)}.
+        '''
+        allowed_states, new_state = VM_ACTIONS[action]
+        with transaction.atomic():
+            states = dict(instances.values_list('name', 'current_state'))
+            applicable = [name for name, state in states.items()
+                          if state in allowed_states]
+            if not applicable:
+                return dict((name, (False, state)) for name, state
+                            in states.items())
+            num_of_changed = VmInstance.objects.filter(
+                name__in=applicable, current_state__in=allowed_states).update(
+                current_state=new_state)
+            InstanceTableVersion.bump()
+            if num_of_changed != len(applicable):
+                # Some have moved on meanwhile, ask for the states again.
+                states.update(VmInstance.objects.filter(
+                    name__in=applicable).values_list('name', 'current_state'))
+                applicable = [name for name in applicable
+                              if states[name] == new_state]
+        results = dict((name, (False, state)) for name, state
+                       in states.items())
+        results.update((name, (True, new_state)) for name in applicable)
+        return results
 
     @staticmethod
     def get_all_occupied_ports():
@@ -139,7 +328,13 @@ class VmInstance(models.Model):
             self.vnc_mapping = host_port
         else:
             raise Exception('Trying to map unknown port: %s' % vm_port)
-        self.save(force_update=True)
+        self.save(update_fields=['%s_mapping' % vm_port])
+
+    def unmap_ports(self):
+        self.ssh_mapping = None
+        self.vnc_mapping = None
+        self.rdp_mapping = None
+        self.save(update_fields=['ssh_mapping', 'vnc_mapping', 'rdp_mapping'])
 
     def get_default_disk_filename(self):
         return '%s_%s.dsk' % (self.image.image_filename, self.name)
@@ -172,7 +367,13 @@ class VmInstance(models.Model):
         return machine
 
     @staticmethod
-    def build_vm(vm_name, image_name, flavour_name=DEFAULT_FLAVOUR):
+    def build_vm(vm_name, image_name, flavour_name=DEFAULT_FLAVOUR,
+                 claim_disk=None):
+        '''
+        Create a new instance to be cloned by the daemon. If claim_disk
+        callable manages to provide a disk right away, the instance is ready
+        to be started.
+        '''
         vm_image = VmImage.objects.get(name=image_name)
         if not vm_image:
             raise DataModelError('VM image does not exists: %s' % image_name)
@@ -187,7 +388,14 @@ class VmInstance(models.Model):
             image=vm_image,
             flavour=flavour,
         )
-        machine.save()
+        machine.disk_filename = machine.get_default_disk_filename()
+        with transaction.atomic():
+            # Claim only once the row is saved; should that fail, no spare
+            # is lost. The daemon sees the row with its disk in place.
+            machine.save()
+            if claim_disk is not None and claim_disk(machine):
+                machine.change_state(VM_IS_STOPPED)
+        return machine
 
     # Some representation and casting implementation.
     def __repr__(self):
@@ -205,3 +413,59 @@ class VmInstance(models.Model):
         # if self.localhost_vnc_port is None or self.localhost_vnc_port == 0:
         #     self.localhost_vnc_port = self.get_default_localhost_vnc_port()
         super(VmInstance, self).save(*args, **kwargs)
+
+
+class PortReservation(models.Model):
+    '''Host port mapped to a service of a VM instance. No port twice.'''
+
+    port = models.PositiveIntegerField(unique=True)
+
+    instance = models.ForeignKey(VmInstance, related_name='port_reservations')
+
+    # One of VM_PORTS
+    service = models.CharField(max_length=10)
+
+    def __repr__(self):
+        return 'Port reservation: <%d for %s of %s>' % (
+            self.port, self.service, self.instance.name)
+
+
+class InstanceTableVersion(models.Model):
+    '''
+    Single row counting the changes of the instance table (and of images and
+    flavours listed with the instances). Pollers and the daemon compare it
+    instead of fetching the instances over and over again.
+    '''
+
+    version = models.PositiveIntegerField(default=0)
+
+    changed_at = models.DateTimeField(default=timezone.now)
+
+    @staticmethod
+    def get_current():
+        table_version, _ = InstanceTableVersion.objects.get_or_create(pk=1)
+        return table_version
+
+    @staticmethod
+    def bump():
+        '''Call after changing instances with QuerySet.update().'''
+        if not InstanceTableVersion.objects.filter(pk=1).update(
+                version=F('version') + 1, changed_at=timezone.now()):
+            InstanceTableVersion.objects.get_or_create(
+                pk=1, defaults={'version': 1})
+
+    def __repr__(self):
+        return 'Instance table version: <%d>' % self.version
+
+
+connection_created.connect(tune_sqlite_connection)
+
+
+@receiver(post_save, sender=VmInstance)
+@receiver(post_delete, sender=VmInstance)
+@receiver(post_save, sender=VmImage)
+@receiver(post_delete, sender=VmImage)
+@receiver(post_save, sender=Flavour)
+@receiver(post_delete, sender=Flavour)
+def instance_changed(sender, **kwargs):
+    InstanceTableVersion.bump()
@@ -5,8 +5,26 @@ import unittest
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
+import json
+import base64
+from ConfigParser import ConfigParser
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
 from django.test import TestCase
-from picostack.vms.models import Flavour, VmImage, VmInstance
+import picostack.settings
+from picostack.vms.views import generate_instance_events
+from picostack.vm_manager import Kvm, VmSpawnError
+from picostack.host_capacity import read_total_memory
+from picostack.cpu_placement import read_cpu_topology, format_cpu_list
+from picostack.vms.models import (Flavour, VmImage, VmInstance,
+                                  PortReservation, InstanceTableVersion,
+                                  VM_IN_CLONING, VM_IS_STOPPED,
+                                  VM_IS_RUNNING, VM_IS_LAUNCHED,
+                                  VM_IS_TERMINATING, VM_IS_QUEUED,
+                                  VM_HAS_FAILED,
+                                  MEMORY_HUGEPAGES,
+                                  MEMORY_HUGEPAGES_PREFERRED)
 
 
 class InstanceTestCase(TestCase):
@@ -44,6 +62,264 @@ class InstanceTestCase(TestCase):
         assert len(occupied_ports) > 0
         #print occupied_ports
 
+    def test_build_vm_with_spare_disk(self):
+        claimed_disks = list()
+
+        def claim_disk(machine):
+            # The row exists before its disk is claimed.
+            assert VmInstance.objects.filter(pk=machine.pk).exists()
+            claimed_disks.append(machine.disk_filename)
+            return True
+
+        machine = VmInstance.build_vm('spare_vm', 'test_image',
+                                      claim_disk=claim_disk)
+        assert machine.current_state == VM_IS_STOPPED
+        assert claimed_disks == ['test.img_spare_vm.dsk']
+        machine = VmInstance.build_vm('cloned_vm', 'test_image',
+                                      claim_disk=lambda machine: False)
+        assert machine.current_state == VM_IN_CLONING
+
+    def test_port_reservation_is_unique(self):
+        machine = VmInstance.objects.get(name='test_vm')
+        PortReservation.objects.create(port=10020, instance=machine,
+                                       service='ssh')
+        try:
+            with transaction.atomic():
+                PortReservation.objects.create(port=10020, instance=machine,
+                                               service='vnc')
+        except IntegrityError:
+            pass
+        else:
+            raise AssertionError('Port was reserved twice.')
+
+
+    def test_status_is_conditional(self):
+        User.objects.create_user('admin', password='secret')
+        self.client.login(username='admin', password='secret')
+        response = self.client.get('/status/')
+        assert response.status_code == 200
+        status = json.loads(response.content)
+        assert [instance['name'] for instance in status['instances']] == \
+            ['test_vm']
+        etag = response['ETag']
+        response = self.client.get('/status/', HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        # Bulk updates do not send signals, version is bumped explicitly.
+        VmInstance.objects.filter(name='test_vm').update(
+            current_state=VM_IS_RUNNING)
+        InstanceTableVersion.bump()
+        response = self.client.get('/status/', HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        status = json.loads(response.content)
+        assert status['instances'][0]['state'] == VM_IS_RUNNING
+        assert status['version'] > 0
+
+    def test_events_are_sent_on_change(self):
+        events = generate_instance_events(novnc_prefix='/novnc?token=')
+        assert events.next().startswith('retry:')
+        event = events.next().split('\n')
+        assert event[0] == 'event: instance'
+        assert json.loads(event[2][len('data: '):])['state'] == VM_IN_CLONING
+        machine = VmInstance.objects.get(name='test_vm')
+        machine.change_state(VM_IS_STOPPED)
+        event = events.next().split('\n')
+        assert json.loads(event[2][len('data: '):])['state'] == VM_IS_STOPPED
+        machine.delete()
+        assert events.next().startswith('event: removed')
+
+    def test_event_streams_are_limited(self):
+        User.objects.create_user('admin', password='secret')
+        self.client.login(username='admin', password='secret')
+        max_streams = picostack.settings.EVENTS_MAX_STREAMS
+        picostack.settings.EVENTS_MAX_STREAMS = 1
+        try:
+            stream = self.client.get('/events/')
+            assert stream.status_code == 200
+            response = self.client.get('/events/')
+            assert response.status_code == 503
+            # Closed stream gives its slot back.
+            stream.close()
+            stream = self.client.get('/events/')
+            assert stream.status_code == 200
+            stream.close()
+        finally:
+            picostack.settings.EVENTS_MAX_STREAMS = max_streams
+
+    def test_instance_action(self):
+        User.objects.create_user('admin', password='secret')
+        self.client.login(username='admin', password='secret')
+        machine = VmInstance.objects.get(name='test_vm')
+        url = '/instances/%d/start/' % machine.pk
+        # Not cloned yet.
+        response = self.client.post(url,
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        assert response.status_code == 409
+        assert json.loads(response.content)['state'] == VM_IN_CLONING
+        machine.change_state(VM_IS_STOPPED)
+        response = self.client.post(url,
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        assert response.status_code == 200
+        assert json.loads(response.content)['state'] == VM_IS_LAUNCHED
+        # Second click does not launch the machine again.
+        assert self.client.post(url).status_code == 302
+        assert VmInstance.request_action(machine.pk, 'start') == \
+            (False, VM_IS_LAUNCHED)
+        assert self.client.get(url).status_code == 405
+        assert self.client.post('/instances/0/stop/').status_code == 404
+
+    def test_bulk_instance_action(self):
+        User.objects.create_user('ci', password='secret')
+        machine = VmInstance.objects.get(name='test_vm')
+        for name in ('ci_1', 'ci_2'):
+            VmInstance.objects.create(name=name, image=machine.image,
+                                      flavour=machine.flavour,
+                                      current_state=VM_IS_RUNNING)
+
+        def post(body, password='secret'):
+            return self.client.post(
+                '/instances/bulk/', json.dumps(body),
+                content_type='application/json',
+                HTTP_AUTHORIZATION='Basic %s' % base64.b64encode(
+                    'ci:%s' % password))
+
+        assert post({'action': 'stop', 'names': ['ci_1']},
+                    password='wrong').status_code == 401
+        assert post({'action': 'reboot', 'names': ['ci_1']}).status_code == \
+            400
+        for body in ({'action': 'stop', 'names': 'ci_1'},
+                     {'action': 'stop', 'names': [['ci_1']]},
+                     {'action': 'stop', 'filter': {'image': ['test_image']}},
+                     {'action': 'stop', 'filter': ['image']},
+                     {'action': ['stop'], 'names': ['ci_1']}):
+            assert post(body).status_code == 400
+        response = post({'action': 'stop',
+                         'filter': {'image': 'test_image'}})
+        assert response.status_code == 200
+        result = json.loads(response.content)
+        assert result['changed'] == 2
+        assert [(instance['name'], instance['changed'], instance['state'])
+                for instance in result['instances']] == [
+            ('ci_1', True, VM_IS_TERMINATING),
+            ('ci_2', True, VM_IS_TERMINATING),
+            ('test_vm', False, VM_IN_CLONING)]
+        result = json.loads(post({'action': 'stop',
+                                  'names': ['ci_1', 'gone']}).content)
+        assert result['changed'] == 0
+        assert result['instances'][1]['error']
+
+    def test_writes_only_changed_fields(self):
+        VmInstance.objects.filter(name='test_vm').update(has_ssh=True)
+        daemon_copy = VmInstance.objects.get(name='test_vm')
+        web_copy = VmInstance.objects.get(name='test_vm')
+        daemon_copy.map_port('ssh', 10022)
+        # Stale copy must not undo the port mapping.
+        web_copy.change_state(VM_IS_STOPPED)
+        machine = VmInstance.objects.get(name='test_vm')
+        assert machine.ssh_mapping == 10022
+        assert machine.current_state == VM_IS_STOPPED
+
+    def test_launches_are_admitted_by_capacity(self):
+        config = ConfigParser()
+        config.add_section('vm_manager')
+        # Host has room for two machines of the 1 GB flavour.
+        config.set('vm_manager', 'memory_reserve',
+                   str(read_total_memory() - 2048))
+        config.set('vm_manager', 'cpu_overcommit', '100')
+        kvm = Kvm(config)
+        dispatched = list()
+        kvm.dispatch = lambda operation, machine, method: dispatched.append(
+            machine.name)
+        machine = VmInstance.objects.get(name='test_vm')
+        machine.change_state(VM_IS_RUNNING)
+        for name in ('vm_a', 'vm_b', 'vm_c'):
+            VmInstance.objects.create(name=name, image=machine.image,
+                                      flavour=machine.flavour,
+                                      current_state=VM_IS_LAUNCHED)
+        kvm.start_machines()
+        assert dispatched == ['vm_a']
+        states = dict(VmInstance.objects.values_list('name',
+                                                     'current_state'))
+        assert states['vm_b'] == states['vm_c'] == VM_IS_QUEUED
+        # Capacity frees up, priority beats the order of queueing.
+        VmInstance.objects.get(name='vm_a').change_state(VM_IS_RUNNING)
+        machine.change_state(VM_IS_STOPPED)
+        VmInstance.objects.filter(name='vm_c').update(priority=1)
+        kvm.start_machines()
+        assert dispatched == ['vm_a', 'vm_c']
+        assert VmInstance.objects.get(name='vm_c').current_state == \
+            VM_IS_LAUNCHED
+        assert VmInstance.objects.get(name='vm_b').current_state == \
+            VM_IS_QUEUED
+        # Flavour bigger than the host never starts.
+        huge = Flavour.objects.create(name='huge', memory_size=4096)
+        VmInstance.objects.create(name='vm_huge', image=machine.image,
+                                  flavour=huge, current_state=VM_IS_QUEUED)
+        kvm.start_machines()
+        machine = VmInstance.objects.get(name='vm_huge')
+        assert machine.current_state == VM_HAS_FAILED
+        assert 'does not fit' in machine.last_error
+
+    def test_pinned_flavour_beyond_host_cpus_fails(self):
+        cpus = sorted(cpu for cores in read_cpu_topology().values()
+                      for core in cores for cpu in core)
+        config = ConfigParser()
+        config.add_section('vm_manager')
+        config.set('vm_manager', 'memory_reserve', '0')
+        config.set('vm_manager', 'cpu_overcommit', '100')
+        # A single CPU is left to pinned machines.
+        config.set('vm_manager', 'host_cpus', format_cpu_list(cpus[1:]))
+        kvm = Kvm(config)
+        dispatched = list()
+        kvm.dispatch = lambda operation, machine, method: dispatched.append(
+            machine.name)
+        image = VmImage.objects.get(name='test_image')
+        pinned = Flavour.objects.create(name='pinned', memory_size=64,
+                                        num_of_cores=2, pin_cpus=True)
+        small = Flavour.objects.create(name='small', memory_size=64)
+        VmInstance.objects.create(name='vm_pinned', image=image,
+                                  flavour=pinned, current_state=VM_IS_QUEUED)
+        VmInstance.objects.create(name='vm_small', image=image,
+                                  flavour=small, current_state=VM_IS_LAUNCHED)
+        kvm.start_machines()
+        machine = VmInstance.objects.get(name='vm_pinned')
+        assert machine.current_state == VM_HAS_FAILED
+        assert 'can be pinned' in machine.last_error
+        # The queue is not blocked by it.
+        assert dispatched == ['vm_small']
+
+    def test_memory_backing_of_flavour(self):
+        config = ConfigParser()
+        config.add_section('vm_manager')
+        config.set('vm_manager', 'hugepages_mount', '/nonexistent/hugepages')
+        kvm = Kvm(config)
+        machine = VmInstance.objects.get(name='test_vm')
+        assert kvm.reserve_memory_backing(machine) == {}
+        # No hugetlbfs there: fall back, or refuse with the reason.
+        machine.flavour.memory_backing = MEMORY_HUGEPAGES_PREFERRED
+        assert kvm.reserve_memory_backing(machine) == {}
+        machine.flavour.memory_backing = MEMORY_HUGEPAGES
+        with self.assertRaisesRegexp(VmSpawnError, 'not mounted'):
+            kvm.reserve_memory_backing(machine)
+        kvm.hugepage_pool.get_shortage = lambda memory_size: None
+        machine.flavour.hugepages_prealloc = True
+        assert kvm.reserve_memory_backing(machine) == {
+            'mem-path': '/nonexistent/hugepages', 'mem-prealloc': ''}
+        assert kvm.hugepage_pool.pending == {machine.pk: 512}
+        kvm.release_memory_backing(machine)
+        assert kvm.hugepage_pool.pending == {}
+
+    def test_disk_settings_are_validated(self):
+        vm_image = VmImage.objects.get(name='test_image')
+        vm_image.full_clean()
+        vm_image.disk_aio = 'native'
+        self.assertRaises(ValidationError, vm_image.full_clean)
+        vm_image.disk_cache = 'none'
+        vm_image.full_clean()
+        vm_image.disk_iothread = True
+        self.assertRaises(ValidationError, vm_image.full_clean)
+        vm_image.disk_bus = 'virtio-scsi'
+        vm_image.full_clean()
+
 
 if __name__ == "__main__":
     unittest.main()
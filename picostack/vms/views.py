@@ -1,16 +1,37 @@
+import json
+import time
+import threading
+import base64
 import urllib
+from functools import wraps
 from urlparse import urlparse
 from django.shortcuts import render
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import (HttpResponseRedirect, HttpResponse,
+                         StreamingHttpResponse, Http404)
 from django import forms
 from django.forms.models import modelformset_factory, ModelForm
-from django.contrib.auth import logout
+from django.contrib.auth import logout, authenticate
 from django.contrib.auth.decorators import login_required
-from picostack.vms.models import (VmInstance, VM_IS_LAUNCHED,
-                                  VM_IS_TERMINATING, VM_IS_TRASHED)
+from django.middleware.csrf import CsrfViewMiddleware
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST
+from picostack.vms.models import VmInstance, InstanceTableVersion, VM_ACTIONS
+from picostack.wakeup import wake_daemon
+from picostack.metrics import load_snapshot
 import picostack.settings
 
 
+# Instance events: how often the change version is checked, how often an idle
+# stream gets a comment (keeps proxies from closing it) and after how long
+# the stream ends (browsers reconnect, the worker is given back meanwhile).
+EVENTS_POLL_INTERVAL = 1.0
+EVENTS_KEEPALIVE_INTERVAL = 15.0
+EVENTS_MAX_DURATION = 300.0
+EVENTS_RETRY_MS = 2000
+# Seconds a browser refused a stream waits before it polls /status/.
+EVENTS_REFUSED_RETRY_AFTER = 5
+
+
 class VmInstanceForm(ModelForm):
     class Meta:
         model = VmInstance
@@ -33,18 +54,10 @@ class VmInstancesFormSet(DefaultVmInstancesFormSet):
         return enumerate(self.forms)
 
 
-def get_vm_instance(request, submit_id):
-    # Initialize form set and pick the index.
-    formset = VmInstancesFormSet(
-        request.POST, request.FILES,
-        queryset=VmInstance.objects.all(),
-    )
+def get_posted_instance_pk(request, submit_id):
+    # Submit button carries the index of the form, which carries the pk.
     form_index = int(request.POST[submit_id][len(submit_id):])
-    assert form_index < len(formset.forms) and form_index >= 0
-    # Obtain corresponding model instance without saving anything.
-    form = formset.forms[form_index]
-    assert form.is_valid()
-    return form.save(commit=False)
+    return int(request.POST['form-%d-id' % form_index])
 
 
 def get_view_context():
@@ -131,27 +144,160 @@ def manage_instances(request):
             )
             if formset.is_valid():
                 formset.save()  # FIXME: do we need to save?
-        elif '_start' in request.POST:
-            vm_instance = get_vm_instance(request, submit_id='_start')
-            # Schedule VM for start.
-            vm_instance.change_state(VM_IS_LAUNCHED)
-        elif '_stop' in request.POST:
-            vm_instance = get_vm_instance(request, submit_id='_stop')
-            # Schedule VM for stop.
-            vm_instance.change_state(VM_IS_TERMINATING)
-        elif '_trash' in request.POST:
-            vm_instance = get_vm_instance(request, submit_id='_trash')
-            # Schedule VM for complete removal.
-            vm_instance.change_state(VM_IS_TRASHED)
+        else:
+            # Buttons post to instance_action(), this is left for scripts.
+            for action in ('start', 'stop', 'trash'):
+                submit_id = '_%s' % action
+                if submit_id in request.POST:
+                    VmInstance.request_action(
+                        get_posted_instance_pk(request, submit_id), action)
+        wake_daemon()
         return HttpResponseRedirect('/instances/')
     # Otherwise view instances. Render the template as response.
     return render(request, 'instances/view.html', get_view_context())
 
 
+@login_required
+@require_POST
+def instance_action(request, pk, action):
+    '''
+    Schedule start, stop or removal of a single instance. If the instance is
+    in a state the action does not apply to, nothing is changed (409 for
+    AJAX requests).
+    '''
+    try:
+        changed, state = VmInstance.request_action(int(pk), action)
+    except VmInstance.DoesNotExist:
+        raise Http404('VM instance #%s does not exist.' % pk)
+    if changed:
+        wake_daemon()
+    if not request.is_ajax():
+        return HttpResponseRedirect('/instances/')
+    return HttpResponse(json.dumps({
+        'id': int(pk),
+        'action': action,
+        'changed': changed,
+        'state': state,
+    }), content_type='application/json', status=200 if changed else 409)
+
+
+def json_response(data, status=200):
+    return HttpResponse(json.dumps(data), content_type='application/json',
+                        status=status)
+
+
+def get_basic_auth_user(request):
+    auth = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(auth) != 2 or auth[0].lower() != 'basic':
+        return None
+    try:
+        username, password = base64.b64decode(auth[1]).split(':', 1)
+    except (TypeError, ValueError):
+        return None
+    user = authenticate(username=username, password=password)
+    if user is None or not user.is_active:
+        return None
+    return user
+
+
+def api_login_required(view_func):
+    '''
+    Scripts authenticate by HTTP basic auth, browsers by their session (and
+    a CSRF token, as usual). Unauthenticated requests get 401, no redirect.
+    '''
+    @csrf_exempt
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        user = get_basic_auth_user(request)
+        if user is not None:
+            request.user = user
+        elif request.user.is_authenticated():
+            rejected = CsrfViewMiddleware().process_view(request, None, (), {})
+            if rejected is not None:
+                return rejected
+        else:
+            response = json_response({'error': 'Authentication required.'},
+                                     status=401)
+            response['WWW-Authenticate'] = 'Basic realm="picostack"'
+            return response
+        return view_func(request, *args, **kwargs)
+    return wrapper
+
+
+def is_list_of_strings(value):
+    return isinstance(value, list) and \
+        all(isinstance(item, basestring) for item in value)
+
+
+@api_login_required
+@require_POST
+def bulk_instance_action(request):
+    '''
+    Apply an action to many instances at once. JSON body:
+    {"action": "start"|"stop"|"trash", "names": [...],
+     "filter": {"image": ..., "flavour": ..., "state": ...}}
+    Names, filter or both select the instances.
+    '''
+    try:
+        body = json.loads(request.body)
+        action = body['action']
+        names = body.get('names')
+        instance_filter = body.get('filter') or dict()
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return json_response({'error': 'Expected JSON with an action.'}, 400)
+    if not isinstance(action, basestring) or action not in VM_ACTIONS:
+        return json_response({'error': 'Unknown action: %s' % action}, 400)
+    if names is not None and not is_list_of_strings(names) or \
+            not isinstance(instance_filter, dict) or \
+            not is_list_of_strings(instance_filter.values()):
+        return json_response({'error': 'Expected a list of names and a '
+                                       'filter with text values.'}, 400)
+    unknown_keys = set(instance_filter) - set(['image', 'flavour', 'state'])
+    if names is None and not instance_filter or unknown_keys:
+        return json_response({'error': 'Expected names or a filter by '
+                                       'image, flavour and state.'}, 400)
+    instances = VmInstance.objects.all()
+    if names is not None:
+        instances = instances.filter(name__in=names)
+    if 'image' in instance_filter:
+        instances = instances.filter(image__name=instance_filter['image'])
+    if 'flavour' in instance_filter:
+        instances = instances.filter(flavour__name=instance_filter['flavour'])
+    if 'state' in instance_filter:
+        instances = instances.filter(current_state=instance_filter['state'])
+    results = VmInstance.request_bulk_action(instances, action)
+    num_of_changed = sum(1 for changed, _ in results.values() if changed)
+    if num_of_changed:
+        # Daemon picks up the whole batch in a single pass.
+        wake_daemon()
+    instance_results = [
+        {'name': name, 'changed': changed, 'state': state}
+        for name, (changed, state) in sorted(results.items())]
+    for name in sorted(set(names or []) - set(results)):
+        instance_results.append({'name': name, 'changed': False,
+                                 'error': 'VM instance does not exist.'})
+    return json_response({
+        'action': action,
+        'changed': num_of_changed,
+        'instances': instance_results,
+    })
+
+
+def get_latest_metrics():
+    snapshot = load_snapshot(picostack.settings.METRICS_SNAPSHOT)
+    if snapshot is None:
+        return dict()
+    return dict((vm_name, history['latest']) for vm_name, history
+                in snapshot['instances'].items())
+
+
 @login_required
 def list_instances(request):
     # Render the template as response.
     context = get_view_context()
+    latest_metrics = get_latest_metrics()
+    for form in context['formset'].forms:
+        form.metrics = latest_metrics.get(form.instance.name)
     context.update({
         'connect_url': request.build_absolute_uri('/connect_instance/'),
         'novnc_url': get_novnc_prefix(request),
@@ -159,6 +305,173 @@ def list_instances(request):
     return render(request, 'instances/list.html', context)
 
 
+@login_required
+def instance_metrics(request):
+    '''Resource usage history as collected by the daemon.'''
+    snapshot = load_snapshot(picostack.settings.METRICS_SNAPSHOT)
+    if snapshot is None:
+        snapshot = {'instances': {}}
+    if 'name' in request.GET:
+        snapshot['instances'] = dict(
+            (vm_name, history) for vm_name, history
+            in snapshot['instances'].items()
+            if vm_name == request.GET['name'])
+    return HttpResponse(json.dumps(snapshot),
+                        content_type='application/json')
+
+
+def get_instance_states(novnc_prefix):
+    '''State, port mappings and VNC target of all instances in one query.'''
+    instances = list()
+    for values in VmInstance.objects.order_by('name').values(
+            'pk', 'name', 'current_state', 'ssh_mapping', 'rdp_mapping',
+            'vnc_mapping', 'has_vnc', 'localhost_vnc_port', 'pinned_cpus'):
+        instances.append({
+            'id': values['pk'],
+            'name': values['name'],
+            'state': values['current_state'],
+            'ports': {
+                'ssh': values['ssh_mapping'],
+                'rdp': values['rdp_mapping'],
+                'vnc': values['vnc_mapping'],
+            },
+            'pinned_cpus': values['pinned_cpus'],
+            'vnc': {
+                'localhost_port': values['localhost_vnc_port'],
+                'url': novnc_prefix + values['name'],
+            } if values['has_vnc'] else None,
+        })
+    return instances
+
+
+def get_table_version(request):
+    # Both ETag and Last-Modified come from the same row, read it once.
+    if not hasattr(request, 'instance_table_version'):
+        request.instance_table_version = InstanceTableVersion.get_current()
+    return request.instance_table_version
+
+
+def get_status_etag(request):
+    return str(get_table_version(request).version)
+
+
+def get_status_last_modified(request):
+    return get_table_version(request).changed_at
+
+
+@login_required
+@condition(etag_func=get_status_etag,
+           last_modified_func=get_status_last_modified)
+def instance_status(request):
+    '''
+    State of all instances for pollers. Unless something has changed since
+    the last poll, 304 Not Modified is returned.
+    '''
+    table_version = get_table_version(request)
+    return HttpResponse(json.dumps({
+        'version': table_version.version,
+        'instances': get_instance_states(get_novnc_prefix(request)),
+    }), content_type='application/json')
+
+
+def format_event(event, data, event_id=None):
+    lines = ['event: %s' % event]
+    if event_id is not None:
+        lines.append('id: %s' % event_id)
+    lines.append('data: %s' % json.dumps(data))
+    return '\n'.join(lines) + '\n\n'
+
+
+def generate_instance_events(novnc_prefix):
+    '''
+    Yield server-sent events: one per added or changed instance and one per
+    removed instance. Everything is sent once the stream (re)connects.
+    '''
+    yield 'retry: %d\n\n' % EVENTS_RETRY_MS
+    known = dict()
+    last_version = None
+    started_at = last_sent_at = time.time()
+    while time.time() - started_at < EVENTS_MAX_DURATION:
+        version = InstanceTableVersion.get_current().version
+        if version != last_version:
+            instances = dict((instance['name'], instance) for instance
+                             in get_instance_states(novnc_prefix))
+            for name, instance in sorted(instances.items()):
+                if known.get(name) != instance:
+                    yield format_event('instance', instance, version)
+            for name in sorted(set(known) - set(instances)):
+                yield format_event('removed', {'name': name}, version)
+            known = instances
+            last_version = version
+            last_sent_at = time.time()
+        elif time.time() - last_sent_at >= EVENTS_KEEPALIVE_INTERVAL:
+            yield ': keepalive\n\n'
+            last_sent_at = time.time()
+        time.sleep(EVENTS_POLL_INTERVAL)
+
+
+class EventStreamSlots(object):
+    '''Count of event streams open in this process, up to a limit.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_of_open = 0
+
+    def acquire(self, limit):
+        with self.lock:
+            if self.num_of_open >= limit:
+                return False
+            self.num_of_open += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.num_of_open -= 1
+
+
+event_stream_slots = EventStreamSlots()
+
+
+class EventStream(object):
+    '''Events that give their slot back once the response is closed.'''
+
+    def __init__(self, events):
+        self.events = events
+        self.closed = False
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.events.close()
+        event_stream_slots.release()
+
+
+@login_required
+def instance_events(request):
+    '''
+    Stream of instance changes (server-sent events). The daemon bumps the
+    change version, a single row is read per poll interval while idle.
+    Every stream holds a worker thread, beyond EVENTS_MAX_STREAMS the stream
+    is refused and the page polls /status/ instead.
+    '''
+    if not event_stream_slots.acquire(picostack.settings.EVENTS_MAX_STREAMS):
+        response = HttpResponse('Too many event streams, poll /status/.',
+                                status=503, content_type='text/plain')
+        response['Retry-After'] = str(EVENTS_REFUSED_RETRY_AFTER)
+        return response
+    response = StreamingHttpResponse(
+        EventStream(generate_instance_events(get_novnc_prefix(request))),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the stream.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @login_required
 def novnc(request):
     return render(request, 'novnc.html', {})
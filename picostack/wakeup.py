@@ -0,0 +1,95 @@
+'''
+Notification channel used to wake up the picostack daemon as soon as the web
+interface or the command line changes something in the DB. The daemon binds
+a local unix datagram socket and blocks on it between the ticks, clients just
+drop a single byte into it. Everybody uses DAEMON_WAKEUP_SOCKET of settings.
+'''
+import os
+import time
+import errno
+import select
+import socket
+import logging
+import picostack.settings
+
+
+logger = logging.getLogger(__name__)
+WAKEUP_MESSAGE = 'w'
+# Sent by worker threads of the daemon once an operation is done.
+WORK_DONE_MESSAGE = 'd'
+
+
+class WakeupChannel(object):
+    '''Daemon side of the notification channel.'''
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.sock = None
+
+    def open(self):
+        if os.path.exists(self.socket_path):
+            # Left over by a daemon that was killed.
+            os.unlink(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.socket_path)
+        self.sock.setblocking(0)
+        # Web server user is expected to share the group with the daemon.
+        os.chmod(self.socket_path, 0o770)
+        logger.info('Listening for wakeups on %s' % self.socket_path)
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.sock.close()
+        self.sock = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def drain(self):
+        '''Consume all pending wakeups - one pass serves them all.'''
+        messages = set()
+        while True:
+            try:
+                messages.add(self.sock.recv(64))
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return messages
+                raise
+
+    def wait(self, timeout):
+        '''
+        Block until somebody wakes us up or the timeout (in seconds) expires.
+        Return the set of received messages, empty if nobody woke us up.
+        '''
+        if self.sock is None:
+            time.sleep(timeout)
+            return set()
+        try:
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+        except select.error as error:
+            if error.args[0] == errno.EINTR:
+                return set()
+            raise
+        if not readable:
+            return set()
+        return self.drain()
+
+
+def wake_daemon(socket_path=None, message=WAKEUP_MESSAGE):
+    '''
+    Tell the daemon that something has changed. Never blocks and never fails:
+    if nobody is listening the change is picked up on the next idle tick.
+    '''
+    if socket_path is None:
+        socket_path = picostack.settings.DAEMON_WAKEUP_SOCKET
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    try:
+        sock.sendto(message, socket_path)
+    except socket.error as error:
+        logger.debug('Failed to wake up the daemon via %s: %s' %
+                     (socket_path, error))
+        return False
+    finally:
+        sock.close()
+    return True
@@ -0,0 +1,85 @@
+'''
+Pool of worker threads used by the VM manager to clone, start, stop and trash
+machines in parallel. Every operation type gets its own workers, so a long
+clone never holds back starts and stops. A machine is handled by at most one
+worker at a time.
+'''
+import Queue
+import logging
+import threading
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+
+    def __init__(self, workers_per_operation, on_done=None):
+        '''
+        workers_per_operation maps operation name to number of worker threads.
+        Operations with no workers are executed right away by the caller.
+        on_done is called (from the worker thread) after every finished task.
+        '''
+        self.on_done = on_done
+        self.queues = dict()
+        self.busy = set()
+        self.busy_lock = threading.Lock()
+        self.threads = list()
+        for operation, num_of_workers in workers_per_operation.items():
+            if num_of_workers < 1:
+                continue
+            queue = Queue.Queue()
+            self.queues[operation] = queue
+            for index in xrange(num_of_workers):
+                thread = threading.Thread(
+                    target=self.work, args=(operation, queue),
+                    name='%s-worker-%d' % (operation, index))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def is_busy(self, key):
+        with self.busy_lock:
+            return key in self.busy
+
+    def submit(self, operation, key, func, *args):
+        '''
+        Schedule func(*args) as given operation over the object identified by
+        key. Return False if that object is already being handled.
+        '''
+        with self.busy_lock:
+            if key in self.busy:
+                return False
+            self.busy.add(key)
+        if operation in self.queues:
+            self.queues[operation].put((key, func, args))
+        else:
+            self.execute(operation, key, func, args)
+        return True
+
+    def execute(self, operation, key, func, args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Failed to %s %s' % (operation, key))
+        finally:
+            with self.busy_lock:
+                self.busy.discard(key)
+
+    def work(self, operation, queue):
+        while True:
+            key, func, args = queue.get()
+            try:
+                self.execute(operation, key, func, args)
+            finally:
+                # Every thread has its own DB connection. Do not leak them.
+                connection.close()
+                queue.task_done()
+            if self.on_done is not None:
+                self.on_done()
+
+    def join(self):
+        '''Block until all queued tasks are done.'''
+        for queue in self.queues.values():
+            queue.join()
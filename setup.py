@@ -40,7 +40,8 @@ setup(
     license='MIT',
     scripts=['picostk', 'picostk-django', 'picostk-sockify'],
     packages=[
-        'picostack', 'picostack.vms', 'picostack.vms.templatetags',
+        'picostack', 'picostack.vms', 'picostack.vms.migrations',
+        'picostack.vms.templatetags',
     ],
     package_data={
         '': ['*.html', '*.svg', '*.js', '*.png', '*.css'],
@@ -48,7 +49,6 @@ setup(
     include_package_data=True,
     download_url='https://github.com/ewiger/picostack/tarball/master',
     install_requires=[
-        'sh >= 1.11',
         'daemoncxt >= 1.5.7',
         'Django >= 1.8.2',
         'psutil >= 2.1.1',
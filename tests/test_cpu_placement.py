@@ -0,0 +1,93 @@
+import os
+import sys
+import shutil
+import tempfile
+import psutil
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.cpu_placement import (
+    CpuPlacement, CpuPlacementError, parse_cpu_list, format_cpu_list,
+    read_cpu_topology, find_vcpu_threads, apply_affinity)
+
+
+def write_file(path, text):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as sys_file:
+        sys_file.write(text + '\n')
+
+
+def test_cpu_lists():
+    assert parse_cpu_list('0-3,8\n') == [0, 1, 2, 3, 8]
+    assert parse_cpu_list('') == []
+    assert format_cpu_list([8, 2, 0, 1, 3]) == '0-3,8'
+
+
+def test_read_topology():
+    sys_path = tempfile.mkdtemp()
+    try:
+        cpu_path = os.path.join(sys_path, 'cpu')
+        node_path = os.path.join(sys_path, 'node')
+        # Two sockets, two cores each, hyperthreads are cpu N and N + 4.
+        write_file(os.path.join(cpu_path, 'online'), '0-7')
+        for cpu in xrange(8):
+            topology_path = os.path.join(cpu_path, 'cpu%d' % cpu, 'topology')
+            write_file(os.path.join(topology_path, 'physical_package_id'),
+                       str(cpu % 4 // 2))
+            write_file(os.path.join(topology_path, 'core_id'), str(cpu % 2))
+        write_file(os.path.join(node_path, 'node0', 'cpulist'), '0-1,4-5')
+        write_file(os.path.join(node_path, 'node1', 'cpulist'), '2-3,6-7')
+        assert read_cpu_topology(cpu_path, node_path) == {
+            0: [[0, 4], [1, 5]],
+            1: [[2, 6], [3, 7]],
+        }
+    finally:
+        shutil.rmtree(sys_path)
+
+
+def test_placement():
+    placement = CpuPlacement({0: [[0, 4], [1, 5]], 1: [[2, 6], [3, 7]]},
+                             excluded_cpus=[0])
+    assert placement.num_of_pinnable == 7
+    # Best fit: node 0 has 3 free CPUs. Whole core 1, not the sibling of
+    # the CPU of the host.
+    assert placement.assign('a', 2) == [1, 5]
+    # Node 1 is the only one with enough, its second core is split.
+    assert placement.assign('b', 3) == [2, 3, 6]
+    assert placement.assign('b', 3) == [2, 3, 6]
+    # Spread over nodes.
+    assert placement.assign('c', 2) == [4, 7]
+    assert not placement.can_assign(1)
+    try:
+        placement.assign('d', 1)
+    except CpuPlacementError:
+        pass
+    else:
+        raise AssertionError('CPUs were assigned twice.')
+    assert placement.get_shared_cpus() == [0]
+    assert placement.release('a') == [1, 5]
+    assert placement.free[0] == [1, 5]
+    assert placement.get_shared_cpus() == [0, 1, 5]
+    placement.restore('e', [5, 0])
+    assert placement.free[0] == [1]
+    assert placement.assignments['e'] == [5]
+
+
+def test_split_cores_go_last():
+    placement = CpuPlacement({0: [[0, 4], [1, 5], [2, 6], [3, 7]]},
+                             excluded_cpus=[0])
+    assert placement.assign('a', 1) == [4]
+    # Whole core first, core 2 is split only for the rest.
+    assert placement.assign('b', 3) == [1, 2, 5]
+    # Whole core, not the halves of the split ones.
+    assert placement.assign('c', 2) == [3, 7]
+    assert placement.assign('d', 1) == [6]
+
+
+def test_affinity_of_threads():
+    pid = os.getpid()
+    # Not a VM, no vCPU threads.
+    assert find_vcpu_threads(pid) == {}
+    cpus = psutil.Process(pid).cpu_affinity()
+    apply_affinity(pid, cpus, {})
+    assert psutil.Process(pid).cpu_affinity() == cpus
@@ -0,0 +1,50 @@
+import os
+import sys
+import stat
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.disk_image import (QCOW2_HEADER, get_backing_file,
+                                  protect_image, unprotect_image)
+
+
+def write_qcow2_header(disk_path, backing_file):
+    header = QCOW2_HEADER.pack('QFI\xfb', 3, 0, 0)
+    if backing_file:
+        header = QCOW2_HEADER.pack('QFI\xfb', 3, 512, len(backing_file))
+    with open(disk_path, 'wb') as disk:
+        disk.write(header.ljust(512, '\0'))
+        disk.write(backing_file)
+
+
+def test_backing_file():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        overlay = os.path.join(temp_dir, 'overlay.dsk')
+        write_qcow2_header(overlay, '/images/base.img')
+        assert get_backing_file(overlay) == '/images/base.img'
+        write_qcow2_header(overlay, '../images/base.img')
+        assert get_backing_file(overlay) == os.path.join(
+            os.path.dirname(temp_dir), 'images', 'base.img')
+        write_qcow2_header(overlay, '')
+        assert get_backing_file(overlay) is None
+        raw_disk = os.path.join(temp_dir, 'raw.dsk')
+        with open(raw_disk, 'wb') as disk:
+            disk.write('\0' * 1024)
+        assert get_backing_file(raw_disk) is None
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_image_protection():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        image = os.path.join(temp_dir, 'base.img')
+        open(image, 'w').close()
+        protect_image(image)
+        assert not os.stat(image).st_mode & stat.S_IWUSR
+        unprotect_image(image)
+        assert os.stat(image).st_mode & stat.S_IWUSR
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,37 @@
+import os
+import sys
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.file_copy import copy_file, COPY_METHODS, CHUNK_SIZE
+
+
+def make_sparse_file(path):
+    with open(path, 'wb') as sparse:
+        sparse.write('head' * 1024)
+        sparse.seek(3 * CHUNK_SIZE + 17)
+        sparse.write('middle' * 4096)
+        # Trailing hole.
+        sparse.truncate(6 * CHUNK_SIZE)
+
+
+def check_copy(methods):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        src_path = os.path.join(temp_dir, 'image.img')
+        dst_path = os.path.join(temp_dir, 'disk.dsk')
+        make_sparse_file(src_path)
+        method = copy_file(src_path, dst_path, methods=methods)
+        assert method in methods
+        assert open(src_path, 'rb').read() == open(dst_path, 'rb').read()
+        # Holes are not expanded.
+        assert os.stat(dst_path).st_blocks <= \
+            os.stat(src_path).st_blocks + 8 * 1024
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_copy_methods():
+    for index in range(len(COPY_METHODS)):
+        yield check_copy, COPY_METHODS[index:]
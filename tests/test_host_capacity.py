@@ -0,0 +1,35 @@
+import os
+import sys
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.host_capacity import HostCapacity, read_total_memory
+
+
+def test_read_total_memory():
+    state_path = tempfile.mkdtemp()
+    try:
+        meminfo_path = os.path.join(state_path, 'meminfo')
+        with open(meminfo_path, 'w') as meminfo:
+            meminfo.write('MemTotal:        8167848 kB\n'
+                          'MemFree:         1930344 kB\n')
+        assert read_total_memory(meminfo_path) == 7976
+    finally:
+        shutil.rmtree(state_path)
+    assert read_total_memory() > 0
+
+
+def test_admission():
+    capacity = HostCapacity(memory_reserve=1024, cpu_reserve=1,
+                            memory_overcommit=1.0, cpu_overcommit=2.0,
+                            total_memory=4096, num_of_cpus=3)
+    assert capacity.memory_limit == 3072 and capacity.cores_limit == 4
+    capacity.reserve(1024, 1)
+    assert capacity.admit(1024, 2)
+    # Out of cores.
+    assert not capacity.admit(512, 2)
+    assert capacity.admit(1024, 1)
+    # Out of memory.
+    assert not capacity.admit(1, 0)
+    assert capacity.exceeds_host(4096, 1) and not capacity.exceeds_host(512, 1)
@@ -0,0 +1,67 @@
+import os
+import sys
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.hugepages import (HugepagePool, read_hugepage_counters,
+                                 is_hugetlbfs_mounted)
+
+
+def make_sysfs(sys_path, nr, free, resv):
+    pool_path = os.path.join(sys_path, 'hugepages-2048kB')
+    if not os.path.exists(pool_path):
+        os.makedirs(pool_path)
+    for name, value in (('nr_hugepages', nr), ('free_hugepages', free),
+                        ('resv_hugepages', resv)):
+        with open(os.path.join(pool_path, name), 'w') as counter:
+            counter.write('%d\n' % value)
+
+
+def test_counters_and_mounts():
+    sys_path = tempfile.mkdtemp()
+    try:
+        make_sysfs(sys_path, 512, 300, 44)
+        assert read_hugepage_counters(2048, sys_path) == {
+            'nr_hugepages': 512, 'free_hugepages': 300, 'resv_hugepages': 44}
+        # No pool of 1 GB pages.
+        assert read_hugepage_counters(1048576, sys_path)['free_hugepages'] \
+            == 0
+        mounts_path = os.path.join(sys_path, 'mounts')
+        with open(mounts_path, 'w') as mounts:
+            mounts.write('proc /proc proc rw 0 0\n'
+                         'hugetlbfs /dev/hugepages hugetlbfs rw 0 0\n')
+        assert is_hugetlbfs_mounted('/dev/hugepages', mounts_path)
+        assert not is_hugetlbfs_mounted('/proc', mounts_path)
+        assert not is_hugetlbfs_mounted('/dev/hugepages',
+                                        os.path.join(sys_path, 'missing'))
+    finally:
+        shutil.rmtree(sys_path)
+
+
+def test_pool_accounting():
+    sys_path = tempfile.mkdtemp()
+    try:
+        mounts_path = os.path.join(sys_path, 'mounts')
+        pool = HugepagePool(2048, '/dev/hugepages', sys_path, mounts_path)
+        assert pool.pages_needed(1024) == 512
+        assert pool.pages_needed(1025) == 513
+        make_sysfs(sys_path, 1024, 1024, 0)
+        assert 'not mounted' in pool.reserve('a', 512)
+        with open(mounts_path, 'w') as mounts:
+            mounts.write('nodev /dev/hugepages hugetlbfs rw 0 0\n')
+        assert pool.reserve('a', 1024) is None
+        # Pages of "a" are promised even before its QEMU maps them.
+        assert pool.reserve('b', 1024) is None
+        assert pool.reserve('c', 2) == \
+            '1 hugepages of 2048 kB needed, 0 of 1024 available'
+        # "a" has mapped its memory, the kernel reserves its pages now.
+        make_sysfs(sys_path, 1024, 1024, 512)
+        pool.release('a')
+        pool.release('a')
+        assert pool.reserve('c', 2) == \
+            '1 hugepages of 2048 kB needed, 0 of 1024 available'
+        pool.release('b')
+        assert pool.reserve('c', 2) is None
+    finally:
+        shutil.rmtree(sys_path)
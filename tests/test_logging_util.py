@@ -0,0 +1,167 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import struct
+import logging
+import tempfile
+import threading
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.logging_util import BatchingSocketHandler, serialize_records
+from picostack.socket_logger import (decode_records, FrameReader,
+                                     LogRecordSocketReceiver)
+
+
+def make_record(levelno, msg):
+    return logging.LogRecord('picostack.test', levelno, __file__, 1, msg,
+                             None, None)
+
+
+def queued_messages(handler):
+    return [prepared['msg'] for _, prepared in handler.records]
+
+
+def test_overflow_drops_debug_first():
+    handler = BatchingSocketHandler('localhost', 0, queue_size=2)
+    # Keep the records queued, no listener is running.
+    handler.ensure_listener = lambda: None
+    handler.emit(make_record(logging.DEBUG, 'debug'))
+    handler.emit(make_record(logging.INFO, 'info'))
+    handler.emit(make_record(logging.DEBUG, 'new debug'))
+    assert queued_messages(handler) == ['debug', 'info']
+    assert handler.num_of_debug == 1
+    handler.emit(make_record(logging.ERROR, 'error'))
+    assert queued_messages(handler) == ['info', 'error']
+    assert handler.num_of_debug == 0
+    handler.emit(make_record(logging.ERROR, 'another error'))
+    assert queued_messages(handler) == ['error', 'another error']
+    assert handler.num_of_dropped == 3
+    batch = handler.take_batch()
+    assert '3 records were dropped' in batch[-1]['msg']
+
+
+def test_records_are_decoded():
+    records = [make_record(logging.INFO, 'one %s' % serializer).__dict__
+               for serializer in ('json', 'pickle')]
+    for serializer in ('json', 'pickle'):
+        decoded = decode_records(serialize_records(records, serializer),
+                                 'pickle')
+        assert [record['msg'] for record in decoded] == \
+            ['one json', 'one pickle']
+    # Single records of the plain SocketHandler.
+    handler = logging.handlers.SocketHandler('localhost', 0)
+    data = handler.makePickle(make_record(logging.WARN, 'plain'))
+    assert decode_records(data[4:], 'pickle')[0]['msg'] == 'plain'
+
+
+def test_pickles_are_refused_in_json_mode():
+    data = serialize_records([make_record(logging.INFO, 'pickled').__dict__],
+                             'pickle')
+    try:
+        decode_records(data)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Pickled frame was decoded.')
+    receiver = LogRecordSocketReceiver(port=0)
+    receiver.timeout = 0.05
+    received = list()
+    receiver.handleLogRecord = lambda record: received.append(
+        record.getMessage())
+    thread = threading.Thread(target=receiver.serve_until_stopped)
+    thread.start()
+    client = socket.create_connection(receiver.server_address)
+    try:
+        client.sendall(struct.pack('>L', len(data)) + data)
+        client.settimeout(5)
+        # Server hangs up on the client.
+        assert client.recv(1) == ''
+        assert received == []
+    finally:
+        client.close()
+        receiver.abort = 1
+        thread.join()
+
+
+def test_batch_is_sent_in_one_frame():
+    server = socket.socket()
+    server.bind(('localhost', 0))
+    server.listen(1)
+    handler = BatchingSocketHandler('localhost', server.getsockname()[1],
+                                    flush_interval=0.05)
+    try:
+        for index in xrange(3):
+            handler.emit(make_record(logging.INFO, 'message %d' % index))
+        server.settimeout(5)
+        connection, _ = server.accept()
+        stream = connection.makefile('rb')
+        length = struct.unpack('>L', stream.read(4))[0]
+        records = decode_records(stream.read(length))
+        assert [record['msg'] for record in records] == \
+            ['message 0', 'message 1', 'message 2']
+        connection.close()
+    finally:
+        handler.close()
+        server.close()
+
+
+class FakeSocket(object):
+
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    def recv_into(self, view):
+        chunk = self.data[:min(self.chunk_size, len(view))]
+        self.data = self.data[len(chunk):]
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def test_frames_are_reassembled():
+    payloads = ['x' * 3, 'y' * 40, '', 'z' * 5]
+    data = ''.join(struct.pack('>L', len(payload)) + payload
+                   for payload in payloads)
+    # Frames are split among reads and bigger than the initial buffer.
+    sock = FakeSocket(data, chunk_size=7)
+    reader = FrameReader(size=16)
+    frames = list()
+    while reader.recv_from(sock):
+        frames.extend(reader.frames())
+    assert frames == payloads
+    assert reader.start == reader.end == 0
+    # Buffer is back to its size after the big frame.
+    assert len(reader.buffer) == 16
+
+
+def test_receiver_serves_tcp_and_unix_clients():
+    state_path = tempfile.mkdtemp()
+    socket_path = os.path.join(state_path, 'logging.sock')
+    receiver = LogRecordSocketReceiver(port=0, socket_path=socket_path,
+                                       serializer='pickle')
+    receiver.timeout = 0.05
+    received = list()
+    receiver.handleLogRecord = lambda record: received.append(
+        record.getMessage())
+    thread = threading.Thread(target=receiver.serve_until_stopped)
+    thread.start()
+    handlers = [
+        BatchingSocketHandler(*receiver.server_address, flush_interval=0.05),
+        BatchingSocketHandler(None, None, flush_interval=0.05,
+                              serializer='pickle', socket_path=socket_path),
+    ]
+    try:
+        for index, handler in enumerate(handlers):
+            handler.emit(make_record(logging.INFO, 'client %d' % index))
+            handler.close()
+        deadline = time.time() + 5
+        while len(received) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert sorted(received) == ['client 0', 'client 1']
+    finally:
+        receiver.abort = 1
+        thread.join()
+        shutil.rmtree(state_path)
+    assert not os.path.exists(socket_path)
@@ -0,0 +1,56 @@
+import os
+import sys
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.metrics import (RingBuffer, MetricHistory, MetricsCollector,
+                               read_counters, load_snapshot, METRIC_FIELDS)
+
+
+def test_ring_buffer_wraps_around():
+    ring = RingBuffer(3)
+    assert ring.values() == [] and ring.last() is None
+    for value in xrange(5):
+        ring.append(value)
+    assert len(ring) == 3
+    assert ring.values() == [2.0, 3.0, 4.0]
+    assert ring.last() == 4.0
+
+
+def test_history_is_downsampled():
+    history = MetricHistory(tiers=((1, 4), (2, 4)))
+    for second in xrange(10):
+        sample = dict.fromkeys(METRIC_FIELDS, float(second))
+        history.add(second, sample)
+    raw, averaged = history.as_dict(interval=1)['tiers']
+    assert raw['cpu_percent'] == [6.0, 7.0, 8.0, 9.0]
+    assert averaged['step'] == 2
+    assert averaged['cpu_percent'] == [2.5, 4.5, 6.5, 8.5]
+    assert history.latest()['rss_bytes'] == 9.0
+
+
+def test_collector_snapshot():
+    state_path = tempfile.mkdtemp()
+    try:
+        snapshot_path = os.path.join(state_path, 'metrics.json')
+        processes = {'vm': os.getpid()}
+        collector = MetricsCollector(lambda: processes, interval=1,
+                                     snapshot_path=snapshot_path)
+        assert read_counters(os.getpid())['rss_bytes'] > 0
+        collector.collect(now=100)
+        # Rates need two samples.
+        assert 'vm' not in collector.histories
+        collector.collect(now=101)
+        collector.write_snapshot()
+        snapshot = load_snapshot(snapshot_path)
+        latest = snapshot['instances']['vm']['latest']
+        assert latest['timestamp'] == 101
+        assert latest['rss_bytes'] > 0
+        assert latest['cpu_percent'] >= 0
+        # Machines that are gone are forgotten.
+        processes.clear()
+        collector.collect(now=102)
+        assert not collector.histories
+    finally:
+        shutil.rmtree(state_path)
@@ -0,0 +1,40 @@
+import os
+import sys
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from nose.tools import raises
+from picostack.port_allocator import (PortAllocator, PortAllocationError,
+                                      parse_listening_ports)
+
+
+TCP_TABLE = '''\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt
+   0: 0100007F:2712 00000000:0000 0A 00000000:00000000 00:00000000 00000000
+   1: 00000000:0016 00000000:0000 0A 00000000:00000000 00:00000000 00000000
+   2: 0100007F:2713 0100007F:C350 01 00000000:00000000 00:00000000 00000000
+'''
+
+
+def test_parse_listening_ports():
+    ports = parse_listening_ports(TCP_TABLE.splitlines())
+    # Established connections do not count.
+    assert ports == set([10002, 22])
+
+
+def test_allocate_and_release():
+    allocator = PortAllocator(10000, 10004, occupied_ports=[10001, 22])
+    assert allocator.allocate() == 10000
+    allocator.mark_taken(10002)
+    assert allocator.allocate() == 10003
+    allocator.release(10000)
+    assert not allocator.is_taken(10000)
+    assert allocator.allocate() == 10000
+    assert allocator.is_taken(10001)
+
+
+@raises(PortAllocationError)
+def test_exhausted_range():
+    allocator = PortAllocator(10000, 10002)
+    allocator.allocate()
+    allocator.allocate()
+    allocator.allocate()
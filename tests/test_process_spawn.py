@@ -0,0 +1,43 @@
+import os
+import sys
+import shutil
+import tempfile
+from subprocess import Popen, PIPE
+from collections import deque
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.process_spawn import RotatingReport, stream_output
+
+
+def test_report_rotation():
+    log_path = tempfile.mkdtemp()
+    try:
+        report_filename = os.path.join(log_path, 'vm.log')
+        report = RotatingReport(report_filename, max_size=10, backups=2)
+        for index in xrange(4):
+            report.write('line %d...\n' % index)
+        report.close()
+        assert open(report_filename).read() == 'line 3...\n'
+        assert open(report_filename + '.1').read() == 'line 2...\n'
+        assert open(report_filename + '.2').read() == 'line 1...\n'
+        # Oldest report is dropped.
+        assert not os.path.exists(report_filename + '.3')
+    finally:
+        shutil.rmtree(log_path)
+
+
+def test_output_is_streamed():
+    log_path = tempfile.mkdtemp()
+    try:
+        report_filename = os.path.join(log_path, 'vm.log')
+        report = RotatingReport(report_filename)
+        tail = deque(maxlen=2)
+        proc = Popen(['sh', '-c', 'echo one; echo two >&2; printf three; '
+                      'exit 3'], stdout=PIPE, stderr=PIPE)
+        assert stream_output(proc, report, tail) == 3
+        report.close()
+        assert sorted(open(report_filename).read().split()) == \
+            ['one', 'three', 'two']
+        assert len(tail) == 2
+    finally:
+        shutil.rmtree(log_path)
@@ -0,0 +1,33 @@
+import os
+import sys
+from subprocess import Popen
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.process_table import ProcessTable, ProcessInfo
+
+
+def test_process_info():
+    process = ProcessInfo(1, ['/usr/bin/kvm', '-name', 'guest=foo,debug',
+                              '-drive', 'file=/disks/foo.dsk,if=none',
+                              '-hda', '/disks/bar.dsk'])
+    assert process.vm_name == 'foo'
+    assert process.disk_paths == ['/disks/foo.dsk', '/disks/bar.dsk']
+    assert ProcessInfo(2, ['sleep', '1']).vm_name is None
+
+
+def test_snapshot_index():
+    table = ProcessTable(max_age=60)
+    table.snapshot()
+    process = Popen([sys.executable, '-c', 'import time; time.sleep(5)',
+                     '-name', 'test_vm', '-hda', '/disks/../disks/test.dsk'])
+    try:
+        # Snapshot is reused until invalidated.
+        assert table.find_by_name('test_vm') is None
+        table.invalidate()
+        found = table.find_by_name('test_vm')
+        assert found.pid == process.pid
+        assert table.find_by_disk('/disks/test.dsk') is found
+        assert found in table.find_matching('/disks/')
+    finally:
+        process.kill()
+        process.wait()
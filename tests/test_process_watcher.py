@@ -0,0 +1,25 @@
+import os
+import sys
+import Queue
+from subprocess import Popen
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from nose.plugins.skip import SkipTest
+from picostack.process_watcher import ProcessWatcher
+
+
+def test_exit_notification():
+    if not ProcessWatcher.is_supported():
+        raise SkipTest('pidfd_open() is not supported')
+    exits = Queue.Queue()
+    watcher = ProcessWatcher(
+        on_exit=lambda key, pid, status, exited_at: exits.put((key, status)))
+    watcher.start()
+    succeeding = Popen(['sleep', '0.1'])
+    failing = Popen(['sh', '-c', 'sleep 0.2; exit 3'])
+    assert watcher.watch('succeeding', succeeding.pid)
+    assert watcher.watch('failing', failing.pid)
+    assert watcher.is_watched('failing')
+    assert exits.get(timeout=5) == ('succeeding', 0)
+    assert exits.get(timeout=5) == ('failing', 3)
+    assert not watcher.is_watched('failing')
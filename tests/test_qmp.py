@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+import Queue
+import socket
+import shutil
+import tempfile
+import threading
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.qmp import QmpPool, QmpError
+
+
+def serve_qmp(server, events):
+    '''Fake QEMU: answers every command, sends events before the reply.'''
+    connection, _ = server.accept()
+    connection.sendall(json.dumps({'QMP': {'version': {}}}) + '\n')
+    reader = connection.makefile('rb')
+    for line in iter(reader.readline, ''):
+        request = json.loads(line)
+        if request['execute'] == 'query-status':
+            for event in events:
+                connection.sendall(json.dumps({'event': event}) + '\n')
+            reply = {'return': {'running': True, 'status': 'running'}}
+        elif request['execute'] == 'qmp_capabilities':
+            reply = {'return': {}}
+        else:
+            reply = {'error': {'class': 'CommandNotFound',
+                               'desc': 'Unknown command'}}
+        reply['id'] = request['id']
+        connection.sendall(json.dumps(reply) + '\n')
+    connection.close()
+
+
+def test_commands_and_events():
+    state_path = tempfile.mkdtemp()
+    try:
+        socket_path = os.path.join(state_path, 'vm.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(1)
+        thread = threading.Thread(target=serve_qmp,
+                                  args=(server, ['STOP', 'SHUTDOWN']))
+        thread.daemon = True
+        thread.start()
+        received = Queue.Queue()
+        pool = QmpPool(timeout=5)
+        pool.subscribe('SHUTDOWN',
+                       lambda key, event: received.put((key, event['event'])))
+        pool.start()
+        pool.add('vm', socket_path)
+        assert pool.query_status('vm')['status'] == 'running'
+        assert received.get(timeout=5) == ('vm', 'SHUTDOWN')
+        try:
+            pool.execute('vm', 'no-such-command')
+            assert False
+        except QmpError:
+            pass
+        pool.remove('vm')
+        assert not pool.has('vm')
+        pool.stop()
+        server.close()
+    finally:
+        shutil.rmtree(state_path)
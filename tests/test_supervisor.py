@@ -0,0 +1,36 @@
+import os
+import sys
+import Queue
+import shutil
+import signal
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.supervisor import Supervisor
+
+
+def test_children_are_reaped():
+    log_path = tempfile.mkdtemp()
+    try:
+        exits = Queue.Queue()
+        supervisor = Supervisor(
+            on_exit=lambda key, pid, status, exited_at: exits.put(
+                (key, status)))
+        supervisor.start()
+        report_filename = os.path.join(log_path, 'failing.log')
+        pidfile_path = os.path.join(log_path, 'failing.pid')
+        child = supervisor.spawn('failing', 'false', report_filename,
+                                 pidfile_path)
+        assert int(open(pidfile_path).read()) == child.pid
+        assert exits.get(timeout=5) == ('failing', 1)
+        assert child.exited.is_set() and child.returncode == 1
+        assert not supervisor.is_supervised('failing')
+        assert 'exit status 1' in open(report_filename).read()
+        child = supervisor.spawn('stopped', 'sleep 10',
+                                 os.path.join(log_path, 'stopped.log'),
+                                 os.path.join(log_path, 'stopped.pid'))
+        assert supervisor.is_supervised('stopped')
+        os.kill(child.pid, signal.SIGTERM)
+        assert exits.get(timeout=5) == ('stopped', -signal.SIGTERM)
+    finally:
+        shutil.rmtree(log_path)
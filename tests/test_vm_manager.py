@@ -8,9 +8,14 @@ Quick start with nose tests:
 '''
 import os
 import sys
+import shutil
+import tempfile
+from ConfigParser import ConfigParser
+from subprocess import Popen
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from picostack import vm_manager
+from picostack.supervisor import Supervisor
 
 
 def test_call_builder():
@@ -23,3 +28,190 @@ def test_call_builder():
         'nic,model=virtio -net nic,model=virtio -cpu qemu64'
     assert expected_str == call_str
 
+
+def test_call_overrides():
+    kvm_builder = vm_manager.DebianKvm()
+    call_str = kvm_builder.get_call(
+        {'disk_path': 'disk.img', 'memory_size': 512, 'num_of_cores': 1},
+        {'mem-path': '/dev/hugepages', 'mem-prealloc': ''})
+    assert ' -mem-path /dev/hugepages' in call_str
+    assert ' -mem-prealloc ' in call_str + ' '
+    assert ' -m 512' in call_str
+    # Only that call has them.
+    assert 'mem-path' not in kvm_builder.build_params()
+
+
+class FakeImage(object):
+    disk_bus = 'ide'
+    disk_cache = 'writeback'
+    disk_aio = 'threads'
+    disk_discard = False
+    disk_iothread = False
+
+    def __init__(self, **settings):
+        self.__dict__.update(settings)
+
+
+def get_disk_argv(image, disk_format='qcow2'):
+    kvm_builder = vm_manager.DebianKvm()
+    call_str = kvm_builder.get_call(
+        {'disk_path': '/disks/vm.img', 'memory_size': 512, 'num_of_cores': 1},
+        kvm_builder.get_disk_params(image, disk_format))
+    argv = call_str.split()
+    return sorted(' '.join(argv[index:index + 2])
+                  for index, arg in enumerate(argv)
+                  if arg in ('-hda', '-drive', '-device', '-object'))
+
+
+def test_disk_params():
+    # Defaults keep the plain IDE disk.
+    assert get_disk_argv(FakeImage()) == ['-hda /disks/vm.img']
+    assert get_disk_argv(FakeImage(disk_cache='none', disk_aio='native')) == [
+        '-drive file=/disks/vm.img,if=ide,index=0,media=disk,format=qcow2,'
+        'cache=none,aio=native',
+    ]
+    assert get_disk_argv(FakeImage(disk_bus='virtio-blk')) == [
+        '-device virtio-blk-pci,drive=disk0,bootindex=0',
+        '-drive file=/disks/vm.img,if=none,id=disk0,format=qcow2,'
+        'cache=writeback,aio=threads',
+    ]
+    assert get_disk_argv(FakeImage(
+        disk_bus='virtio-blk', disk_cache='none', disk_aio='io_uring',
+        disk_discard=True, disk_iothread=True)) == [
+        '-device virtio-blk-pci,drive=disk0,bootindex=0,iothread=iothread0',
+        '-drive file=/disks/vm.img,if=none,id=disk0,format=qcow2,'
+        'cache=none,aio=io_uring,discard=unmap,detect-zeroes=unmap',
+        '-object iothread,id=iothread0',
+    ]
+    assert get_disk_argv(FakeImage(
+        disk_bus='virtio-scsi', disk_cache='directsync', disk_aio='native',
+        disk_iothread=True)) == [
+        '-device scsi-hd,drive=disk0,bus=scsi0.0,bootindex=0',
+        '-device virtio-scsi-pci,id=scsi0,iothread=iothread0',
+        '-drive file=/disks/vm.img,if=none,id=disk0,format=qcow2,'
+        'cache=directsync,aio=native',
+        '-object iothread,id=iothread0',
+    ]
+
+
+class FakeMachine(object):
+    name = 'test_vm'
+    localhost_vnc_port = 3
+
+
+def test_raw_image_disk_params():
+    state_path = tempfile.mkdtemp()
+    config = ConfigParser()
+    config.add_section('vm_manager')
+    config.set('vm_manager', 'vm_image_path', state_path)
+    config.set('vm_manager', 'vm_disk_path', state_path)
+    kvm = vm_manager.Kvm(config)
+    machine = FakeMachine()
+    machine.disk_filename = 'vm.img'
+    machine.image = FakeImage(name='raw', image_filename='raw.img',
+                              image_format='', clone_mode='copy',
+                              disk_bus='virtio-blk')
+    try:
+        with open(os.path.join(state_path, 'raw.img'), 'wb') as image:
+            image.write('\0' * 512)
+        # Full copy of a raw image is raw, whatever the default format was.
+        disk_format = kvm.get_disk_format(machine)
+        assert disk_format == 'raw'
+        assert get_disk_argv(machine.image, disk_format) == [
+            '-device virtio-blk-pci,drive=disk0,bootindex=0',
+            '-drive file=/disks/vm.img,if=none,id=disk0,format=raw,'
+            'cache=writeback,aio=threads',
+        ]
+        with open(os.path.join(state_path, 'raw.img'), 'wb') as image:
+            image.write('QFI\xfb' + '\0' * 508)
+        assert kvm.get_disk_format(machine) == 'qcow2'
+        # Format set by the admin wins.
+        machine.image.image_format = 'raw'
+        assert kvm.get_disk_format(machine) == 'raw'
+    finally:
+        shutil.rmtree(state_path)
+
+
+def test_option_defaults():
+    # Same defaults as PicoStackApp.init_config() sets.
+    kvm = vm_manager.Kvm(ConfigParser())
+    assert kvm.spawn_mode == 'supervisor'
+    assert kvm.host_cpus == [0]
+    assert kvm.get_num_of_workers('clone') == 2
+    assert kvm.get_num_of_workers('start') == 4
+    config = ConfigParser()
+    config.add_section('vm_manager')
+    config.set('vm_manager', 'host_cpus', '0-1')
+    assert vm_manager.Kvm(config).host_cpus == [0, 1]
+
+
+def test_vnc_port_lookup():
+    pidfiles_path = tempfile.mkdtemp()
+    config = ConfigParser()
+    config.add_section('app')
+    config.set('app', 'pidfiles_path', pidfiles_path)
+    kvm = vm_manager.Kvm(config)
+    machine = FakeMachine()
+    process = None
+    try:
+        launch_record = kvm.write_launch_record(
+            machine, '/usr/bin/kvm -m 512  -vnc localhost:3')
+        assert launch_record['argv'] == ['/usr/bin/kvm', '-m', '512', '-vnc',
+                                         'localhost:3']
+        assert kvm.get_vnc_port(machine) == 5903
+        # Without the record, look at the command line of the VM process.
+        os.unlink(kvm.get_launch_record_file(machine))
+        process = Popen([sys.executable, '-c', 'import time; time.sleep(5)',
+                         '-vnc', 'localhost:4'])
+        with open(kvm.get_proc_pid_file(machine), 'w') as pidfile:
+            pidfile.write('%d' % process.pid)
+        assert kvm.get_vnc_port(machine) == 5904
+    finally:
+        if process is not None:
+            process.kill()
+            process.wait()
+        shutil.rmtree(pidfiles_path)
+
+
+FAKE_QEMU = '''
+import sys, json, socket
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(sys.argv[1])
+server.listen(1)
+connection, _ = server.accept()
+connection.sendall(json.dumps({'QMP': {}}) + '\\n')
+request = json.loads(connection.makefile().readline())
+connection.sendall(json.dumps({'return': {}, 'id': request['id']}) + '\\n')
+'''
+
+
+def test_readiness_handshake():
+    state_path = tempfile.mkdtemp()
+    config = ConfigParser()
+    config.add_section('app')
+    config.set('app', 'statepath', state_path)
+    kvm = vm_manager.Kvm(config)
+    supervisor = Supervisor()
+    supervisor.start()
+    machine = FakeMachine()
+    try:
+        script_path = os.path.join(state_path, 'fake_qemu.py')
+        with open(script_path, 'w') as script:
+            script.write(FAKE_QEMU)
+        report_path = os.path.join(state_path, 'report.log')
+        child = supervisor.spawn(
+            machine.name, '%s %s %s' % (sys.executable, script_path,
+                                        kvm.get_qmp_socket_path(machine)),
+            report_path, os.path.join(state_path, 'ready.pid'))
+        kvm.wait_until_ready(machine, child.pid, child)
+        # Fast failing VM is reported with its output.
+        child = supervisor.spawn(
+            machine.name, 'ls /no/such/disk', report_path,
+            os.path.join(state_path, 'failing.pid'))
+        try:
+            kvm.wait_until_ready(machine, child.pid, child)
+            assert False
+        except vm_manager.VmSpawnError as error:
+            assert '/no/such/disk' in str(error)
+    finally:
+        shutil.rmtree(state_path)
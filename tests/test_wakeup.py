@@ -0,0 +1,31 @@
+import os
+import sys
+import shutil
+import tempfile
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.wakeup import (WakeupChannel, wake_daemon, WAKEUP_MESSAGE,
+                              WORK_DONE_MESSAGE)
+
+
+def test_wakeup_channel():
+    temp_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(temp_dir, 'test.wakeup')
+    channel = WakeupChannel(socket_path)
+    channel.open()
+    try:
+        assert not channel.wait(0)
+        # Several wakeups are served by a single pass.
+        assert wake_daemon(socket_path)
+        assert wake_daemon(socket_path)
+        assert channel.wait(1) == set([WAKEUP_MESSAGE])
+        assert not channel.wait(0)
+        assert wake_daemon(socket_path, WORK_DONE_MESSAGE)
+        assert wake_daemon(socket_path)
+        assert channel.wait(1) == set([WAKEUP_MESSAGE, WORK_DONE_MESSAGE])
+    finally:
+        channel.close()
+        shutil.rmtree(temp_dir)
+    assert not os.path.exists(socket_path)
+    # Nobody listens - should not fail.
+    assert not wake_daemon(socket_path)
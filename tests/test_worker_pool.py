@@ -0,0 +1,30 @@
+import os
+import sys
+import threading
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "picostack.settings")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from picostack.worker_pool import WorkerPool
+
+
+def test_operations_do_not_block_each_other():
+    release_clone = threading.Event()
+    started = threading.Event()
+    pool = WorkerPool({'clone': 1, 'start': 1})
+    assert pool.submit('clone', 1, release_clone.wait)
+    # Same machine is never handled twice at once.
+    assert not pool.submit('start', 1, started.set)
+    # Other machines keep going while the clone hangs.
+    assert pool.submit('start', 2, started.set)
+    assert started.wait(5)
+    assert pool.is_busy(1)
+    release_clone.set()
+    pool.join()
+    assert not pool.is_busy(1)
+
+
+def test_inline_operations():
+    done = list()
+    pool = WorkerPool({'trash': 0})
+    assert pool.submit('trash', 1, done.append, 1)
+    assert done == [1]
+    assert not pool.is_busy(1)